@@ -0,0 +1,385 @@
+"""
+Backends that store locks. The backend is chosen with the ``DB_MUTEX_BACKEND`` setting, which is the
+dotted path of a :class:`BaseLockBackend` subclass and defaults to :class:`TableBackend`. The
+``DB_MUTEX_BACKEND_OPTIONS`` setting holds keyword arguments for the backend class.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import DBMutex, reclaimed_locks
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+DEFAULT_BACKEND = 'db_mutex.backends.TableBackend'
+
+
+class BaseLockBackend(object):
+    """
+    The protocol of lock backends. Every acquisition of a lock is identified by a random owner token, and
+    ``using`` is the alias of the database the lock belongs to. Backends must implement ``acquire``,
+    ``release``, ``extend`` and ``is_held``. The methods for several locks at once fall back to calling
+    these for every lock, and can be overridden by backends that support doing it in one go.
+    """
+    def acquire(self, lock_id, token, ttl_seconds, using):
+        """
+        Acquires a lock with the given owner token, taking over the lock if it expired.
+
+        :type ttl_seconds: float
+        :param ttl_seconds: The number of seconds until the lock expires or None if it never expires
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        raise NotImplementedError
+
+    def release(self, lock_id, token, using):
+        """
+        Releases a lock if it is still held with the given owner token.
+
+        :rtype: bool
+        :returns: True if the lock was released
+        """
+        raise NotImplementedError
+
+    def extend(self, lock_id, token, ttl_seconds, using):
+        """
+        Renews the lease of a lock that is held with the given owner token.
+
+        :rtype: bool
+        :returns: True if the lock is still held
+        """
+        raise NotImplementedError
+
+    def is_held(self, lock_id, using):
+        """
+        Returns whether a lock is held and has not expired.
+
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def acquire_many(self, lock_ids, token, ttl_seconds, using):
+        """
+        Acquires all of the locks or none of them.
+
+        :rtype: bool
+        :returns: True if all of the locks were acquired
+        """
+        acquired = []
+        for lock_id in lock_ids:
+            if not self.acquire(lock_id, token, ttl_seconds, using):
+                self.release_many(acquired, token, using)
+                return False
+            acquired.append(lock_id)
+        return True
+
+    def release_many(self, lock_ids, token, using):
+        """
+        Releases the locks that are still held with the given owner token.
+
+        :rtype: int
+        :returns: the number of released locks
+        """
+        return sum(self.release(lock_id, token, using) for lock_id in lock_ids)
+
+    def extend_many(self, lock_ids, token, ttl_seconds, using):
+        """
+        Renews the leases of the locks that are held with the given owner token.
+
+        :rtype: int
+        :returns: the number of locks that are still held
+        """
+        return sum(self.extend(lock_id, token, ttl_seconds, using) for lock_id in lock_ids)
+
+    def acquire_slot(self, slot_ids, token, ttl_seconds, using):
+        """
+        Acquires the first free one of several slot locks.
+
+        :rtype: bool
+        :returns: True if a slot was acquired
+        """
+        return any(self.acquire(slot_id, token, ttl_seconds, using) for slot_id in slot_ids)
+
+    def reclaim_dead(self, lock_ids, using):
+        """
+        Releases the locks whose holders provably died. Backends whose locks are released when their
+        holder dies do not need to implement this.
+
+        :rtype: int
+        :returns: the number of released locks
+        """
+        return 0
+
+
+class TableBackend(BaseLockBackend):
+    """
+    Stores locks as rows of the ``DBMutex`` table. Locks are shared by all hosts that use the database.
+    """
+    def get_queryset(self, using):
+        return DBMutex.objects.using(using)
+
+    def acquire(self, lock_id, token, ttl_seconds, using):
+        return self.get_queryset(using).acquire(lock_id, token, ttl_seconds)
+
+    def release(self, lock_id, token, using):
+        return self.get_queryset(using).release(lock_id, token)
+
+    def extend(self, lock_id, token, ttl_seconds, using):
+        return self.get_queryset(using).extend(lock_id, token, ttl_seconds)
+
+    def is_held(self, lock_id, using):
+        return self.get_queryset(using).is_held(lock_id)
+
+    def acquire_many(self, lock_ids, token, ttl_seconds, using):
+        return self.get_queryset(using).acquire_many(lock_ids, token, ttl_seconds)
+
+    def release_many(self, lock_ids, token, using):
+        return self.get_queryset(using).release_many(lock_ids, token)
+
+    def extend_many(self, lock_ids, token, ttl_seconds, using):
+        return self.get_queryset(using).extend_many(lock_ids, token, ttl_seconds)
+
+    def acquire_slot(self, slot_ids, token, ttl_seconds, using):
+        return self.get_queryset(using).acquire_slot(slot_ids, token, ttl_seconds)
+
+    def reclaim_dead(self, lock_ids, using):
+        return self.get_queryset(using).delete_dead(lock_ids)
+
+
+class FileLockBackend(BaseLockBackend):
+    """
+    Stores locks as ``flock`` locks on files in a local directory. Acquiring and releasing a lock only
+    takes a couple of system calls, but locks are only shared by the processes of a single host, which
+    makes this backend suited for single host deployments and test runs.
+
+    Locks are held by an open file, so they are released when the process that holds them exits, and
+    they never expire. The lock files are left in place when locks are released.
+    """
+    def __init__(self, directory=None):
+        """
+        :type directory: str
+        :param directory: The directory of the lock files. Defaults to a ``db_mutex`` directory in the
+            temporary directory of the system.
+        """
+        if fcntl is None:
+            raise ImproperlyConfigured('FileLockBackend requires fcntl, which is not available on this platform')
+
+        self.directory = directory or os.path.join(tempfile.gettempdir(), 'db_mutex')
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # Maps the paths of the lock files held by this process to their file descriptors and owner tokens
+        self.held = {}
+
+    def get_path(self, lock_id, using):
+        """
+        Returns the path of the lock file of a lock. Lock ids are hashed since they can contain any
+        characters.
+
+        :rtype: str
+        """
+        digest = hashlib.sha256('{0}\0{1}'.format(using, lock_id).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '{0}.lock'.format(digest))
+
+    def try_lock(self, path):
+        """
+        Opens a lock file and locks it without blocking.
+
+        :rtype: int
+        :returns: the file descriptor of the locked file or None if the file is locked by someone else
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def acquire(self, lock_id, token, ttl_seconds, using):
+        path = self.get_path(lock_id, using)
+        with self.lock:
+            if path in self.held:
+                return False
+            fd = self.try_lock(path)
+            if fd is None:
+                return False
+            self.held[path] = (fd, token)
+            return True
+
+    def release(self, lock_id, token, using):
+        path = self.get_path(lock_id, using)
+        with self.lock:
+            fd, held_token = self.held.get(path, (None, None))
+            if fd is None or held_token != token:
+                return False
+            del self.held[path]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return True
+
+    def extend(self, lock_id, token, ttl_seconds, using):
+        with self.lock:
+            return self.held.get(self.get_path(lock_id, using), (None, None))[1] == token
+
+    def is_held(self, lock_id, using):
+        path = self.get_path(lock_id, using)
+        with self.lock:
+            if path in self.held:
+                return True
+            fd = self.try_lock(path)
+            if fd is None:
+                return True
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+            return False
+
+
+class MemoryBackend(BaseLockBackend):
+    """
+    Stores locks in the memory of the process. This is meant for test suites, which can use locks without
+    querying the database and check the state of locks directly. Locks behave like the locks of
+    :class:`TableBackend`, including their expiration, but they are only shared by the threads of the
+    process.
+    """
+    def __init__(self, clock=None):
+        """
+        :type clock: callable or str
+        :param clock: A function, or the dotted path of a function, that returns the current time in
+            seconds. Defaults to :func:`time.monotonic`. Tests can pass a fake clock to expire locks
+            without sleeping.
+        """
+        if isinstance(clock, str):
+            clock = import_string(clock)
+        self.clock = clock or time.monotonic
+        self.lock = threading.Lock()
+        # Maps the database aliases and lock ids of locks to their owner tokens and expiration times
+        self.locks = {}
+
+    def get_expiration_time(self, ttl_seconds):
+        return None if ttl_seconds is None else self.clock() + ttl_seconds
+
+    def get_live_lock(self, lock_id, using):
+        """
+        Returns the owner token and expiration time of a lock that has not expired, or None.
+        """
+        lock = self.locks.get((using, lock_id))
+        if lock is None or (lock[1] is not None and lock[1] <= self.clock()):
+            return None
+        return lock
+
+    def acquire(self, lock_id, token, ttl_seconds, using):
+        return self.acquire_many([lock_id], token, ttl_seconds, using)
+
+    def acquire_many(self, lock_ids, token, ttl_seconds, using):
+        with self.lock:
+            if any(self.get_live_lock(lock_id, using) is not None for lock_id in lock_ids):
+                return False
+            # Released locks are removed, so the remaining locks have expired
+            reclaimed_locks.set(reclaimed_locks.get() + sum((using, lock_id) in self.locks for lock_id in lock_ids))
+            expires_at = self.get_expiration_time(ttl_seconds)
+            for lock_id in lock_ids:
+                self.locks[(using, lock_id)] = (token, expires_at)
+            return True
+
+    def release(self, lock_id, token, using):
+        with self.lock:
+            lock = self.locks.get((using, lock_id))
+            if lock is None or lock[0] != token:
+                return False
+            del self.locks[(using, lock_id)]
+            return True
+
+    def extend(self, lock_id, token, ttl_seconds, using):
+        with self.lock:
+            lock = self.locks.get((using, lock_id))
+            if lock is None or lock[0] != token:
+                return False
+            self.locks[(using, lock_id)] = (token, self.get_expiration_time(ttl_seconds))
+            return True
+
+    def is_held(self, lock_id, using):
+        with self.lock:
+            return self.get_live_lock(lock_id, using) is not None
+
+    def get_locks(self, using=DEFAULT_DB_ALIAS):
+        """
+        Returns the locks of a database that are held and have not expired.
+
+        :rtype: dict
+        :returns: the owner tokens of the locks by lock id
+        """
+        with self.lock:
+            return {
+                lock_id: self.locks[(alias, lock_id)][0]
+                for alias, lock_id in self.locks
+                if alias == using and self.get_live_lock(lock_id, alias) is not None
+            }
+
+    def clear(self):
+        """
+        Forgets about all locks.
+        """
+        with self.lock:
+            self.locks.clear()
+
+
+# Holds the backend instance once it is loaded, see get_backend
+backend_cache = {}
+# Makes sure that threads that load the backend at the same time share one instance
+backend_cache_lock = threading.Lock()
+
+
+def load_backend(path, options=None):
+    """
+    Returns a new instance of a backend class.
+
+    :type path: str
+    :param path: The dotted path of the backend class
+    :type options: dict
+    :param options: The keyword arguments of the backend class
+    """
+    return import_string(path)(**(options or {}))
+
+
+def get_backend():
+    """
+    Returns the backend configured with the ``DB_MUTEX_BACKEND`` and ``DB_MUTEX_BACKEND_OPTIONS`` settings.
+    The backend is instantiated once per process, since backends can hold state such as the open files of
+    held locks. It is instantiated again when one of the settings is changed, e.g. with ``override_settings``.
+
+    :rtype: :class:`BaseLockBackend`
+    """
+    backend = backend_cache.get('backend')
+    if backend is None:
+        with backend_cache_lock:
+            backend = backend_cache.get('backend')
+            if backend is None:
+                backend = backend_cache['backend'] = load_backend(
+                    getattr(settings, 'DB_MUTEX_BACKEND', DEFAULT_BACKEND),
+                    getattr(settings, 'DB_MUTEX_BACKEND_OPTIONS', None)
+                )
+    return backend
+
+
+@receiver(setting_changed)
+def clear_backend_cache(setting, **kwargs):
+    """
+    Reloads the backend when its settings change.
+    """
+    if setting in ('DB_MUTEX_BACKEND', 'DB_MUTEX_BACKEND_OPTIONS'):
+        with backend_cache_lock:
+            backend_cache.clear()
@@ -0,0 +1,101 @@
+"""
+Helpers for choosing the database and the connection that lock queries run on.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+
+# Holds the dedicated lock connections of the current thread by database alias
+lock_connections = threading.local()
+
+
+def get_lock_databases():
+    """
+    Returns the aliases of the databases that hold the lock table. This is configured with the
+    ``DB_MUTEX_DATABASE`` setting, which is either a single alias or a list of aliases that locks are
+    sharded across. Defaults to the default database.
+
+    :rtype: list
+    :returns: the database aliases
+    """
+    databases = getattr(settings, 'DB_MUTEX_DATABASE', None) or DEFAULT_DB_ALIAS
+    if isinstance(databases, str):
+        return [databases]
+    return list(databases)
+
+
+def get_lock_database(lock_id, using=None):
+    """
+    Returns the alias of the database that holds a lock. When locks are sharded across several databases,
+    the database is chosen by hashing the lock id, so every process agrees on where a lock lives.
+
+    :type lock_id: str
+    :param lock_id: The ID of the lock
+    :type using: str
+    :param using: An explicit database alias that overrides the ``DB_MUTEX_DATABASE`` setting
+
+    :rtype: str
+    :returns: the database alias
+    """
+    if using is not None:
+        return using
+
+    databases = get_lock_databases()
+    if len(databases) == 1:
+        return databases[0]
+    digest = hashlib.sha256(lock_id.encode('utf-8')).digest()
+    return databases[int.from_bytes(digest[:8], byteorder='big') % len(databases)]
+
+
+def get_separate_connection_enabled():
+    """
+    Returns whether lock queries run on a dedicated autocommit connection instead of the connection that
+    is shared with the rest of the application. This is configured with the ``DB_MUTEX_SEPARATE_CONNECTION``
+    setting and is disabled by default.
+
+    :rtype: bool
+    """
+    return getattr(settings, 'DB_MUTEX_SEPARATE_CONNECTION', False)
+
+
+def get_lock_connection(using):
+    """
+    Returns the connection that lock queries for a database alias run on. When separate connections are
+    enabled, this is a connection that is dedicated to locks for the current thread. It always stays in
+    autocommit mode, so locks are visible to others as soon as they are acquired and are not rolled back
+    with the transaction of the caller.
+
+    :type using: str
+    :param using: The alias of the database
+
+    :rtype: :class:`BaseDatabaseWrapper <django.db.backends.base.base.BaseDatabaseWrapper>`
+    """
+    if not get_separate_connection_enabled():
+        return connections[using]
+
+    connection = getattr(lock_connections, using, None)
+    if connection is None:
+        connection = connections.create_connection(using)
+        setattr(lock_connections, using, connection)
+    elif connection.connection is not None and connection.errors_occurred:
+        # Reconnect if the connection broke, e.g. because the database was restarted
+        if not connection.is_usable():
+            connection.close()
+        connection.errors_occurred = False
+    return connection
+
+
+def close_lock_connections():
+    """
+    Closes the dedicated lock connections of the current thread. This should be called when a thread that
+    acquired locks with separate connections finishes. The connections of the rest of the application are
+    left alone.
+    """
+    for alias in connections:
+        connection = getattr(lock_connections, alias, None)
+        if connection is not None:
+            connection.close()
+            delattr(lock_connections, alias)
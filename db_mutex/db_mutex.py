@@ -1,17 +1,54 @@
 from datetime import timedelta
+import asyncio
+import contextlib
+import copy
+import contextvars
 import functools
 import logging
+import random
+import secrets
+import threading
+import time
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.db import transaction, IntegrityError
-from django.utils import timezone
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, DatabaseError, OperationalError, transaction
+from django.db.transaction import TransactionManagementError
 
+from . import postgres, signals
+from .backends import get_backend
+from .databases import close_lock_connections, get_lock_connection, get_lock_database, get_lock_databases
 from .exceptions import DBMutexError, DBMutexTimeoutError
-from .models import DBMutex
+from .local import local_locks
+from .models import DBMutex, reclaimed_locks
 
 
 LOG = logging.getLogger(__name__)
 
+# Locks with this scope are held until the current transaction ends
+TRANSACTION_SCOPE = 'transaction'
+
+# The default number of seconds after which locks expire
+DEFAULT_MUTEX_TTL_SECONDS = timedelta(minutes=30).total_seconds()
+
+# Maps the reentrant locks held by the current thread or task to their owner and hold count. The dict is
+# replaced instead of modified, so that tasks that copied the context do not share changes.
+held_locks = contextvars.ContextVar('db_mutex_held_locks', default={})
+
+
+def get_owner():
+    """
+    Returns the asyncio task that is running, or the current thread outside of tasks. Tasks copy the
+    context of the task that created them, so reentrant locks record their owner to not be reentered by
+    the tasks that their holder spawned.
+    """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task or threading.current_thread()
+
 
 class db_mutex(object):
     """
@@ -19,8 +56,19 @@ class db_mutex(object):
     DB mutex lock.
     """
     mutex_ttl_seconds_settings_key = 'DB_MUTEX_TTL_SECONDS'
+    mutex_notify_settings_key = 'DB_MUTEX_NOTIFY'
+    # Whether locks of this class can be held for the length of a transaction
+    supports_transaction_scope = True
+    # Whether locks of this class can reclaim the locks of dead holders
+    supports_reclaim_dead = True
+    # Whether locks of this class can be acquired from async code
+    supports_async = True
 
-    def __init__(self, lock_id, suppress_acquisition_exceptions=False):
+    def __init__(
+        self, lock_id, suppress_acquisition_exceptions=False, wait=False, timeout=None, poll_interval=0.05,
+        max_poll_interval=2, ttl=None, heartbeat=False, using=None, reentrant=False,
+        local=False, scope=None, reclaim_dead=False
+    ):
         """
         This context manager/function decorator can be used in the following way
 
@@ -51,12 +99,66 @@ class db_mutex(object):
             except DBMutexTimeoutError:
                 print('Task completed but the lock timed out')
 
+            # Wait up to ten seconds for the lock to be released by another process
+            with db_mutex('lock_id', wait=True, timeout=10) as lock:
+                print('Acquired the lock in {0} seconds'.format(lock.acquire_time))
+
+            # Lock a critical section of async code or a coroutine function
+            async with db_mutex('lock_id'):
+                # Run critical code here
+                pass
+
+            @db_mutex('lock_id')
+            async def critical_coroutine_function():
+                # Critical code goes here
+                pass
+
         :type lock_id: str
         :param lock_id: The ID of the lock one is trying to acquire
         :type suppress_acquisition_exceptions: bool
         :param suppress_acquisition_exceptions: Suppress exceptions when acquiring the lock and instead
             log an error message. Note that this is only applicable when using this as a decorator and
             not a context manager.
+        :type wait: bool
+        :param wait: Retry acquiring the lock until it is obtained or ``timeout`` elapses instead of
+            failing right away. Retries are spaced out with capped exponential backoff and jitter so that
+            waiters do not all hit the database at the same time.
+        :type timeout: float
+        :param timeout: The maximum number of seconds to wait for the lock. Implies ``wait``. Waits forever
+            when ``wait`` is set and no timeout is given.
+        :type poll_interval: float
+        :param poll_interval: The number of seconds to wait before the first retry. The delay doubles
+            after every failed attempt.
+        :type max_poll_interval: float
+        :param max_poll_interval: The maximum number of seconds to wait between two attempts
+        :type ttl: float or timedelta
+        :param ttl: The lease of this lock. Once it ends, the lock can be taken over by others. Defaults
+            to the ``DB_MUTEX_TTL_SECONDS`` setting.
+        :type heartbeat: bool
+        :param heartbeat: Renew the lease of the lock in a background thread every third of its ttl while
+            the lock is held. This allows keeping the ttl short for long running code, so that the locks of
+            crashed processes are reclaimed quickly.
+        :type using: str
+        :param using: The alias of the database that holds the lock. Defaults to the ``DB_MUTEX_DATABASE``
+            setting.
+        :type reentrant: bool
+        :param reentrant: Allow the thread or task that holds the lock to acquire it again. Nested
+            acquisitions only count the holds in memory without querying the database, and the lock is
+            released when the outermost holder exits. Tasks spawned by the holder do not hold the lock.
+        :type local: bool
+        :param local: Register the lock in a process local registry before acquiring it, so that only one
+            thread of the process queries the database for the lock at a time. Other threads of the
+            process fail right away or wait on a condition variable without querying the database.
+        :type scope: str
+        :param scope: Pass ``'transaction'`` to hold the lock until the current transaction commits or rolls
+            back instead of until the context manager or decorated function exits. This has to be used
+            inside of an atomic block. The lock is created in the lock table in the transaction and deleted
+            once it commits, whatever the ``DB_MUTEX_BACKEND`` setting.
+        :type reclaim_dead: bool
+        :param reclaim_dead: Take over a held lock right away when its holder ran on the same host and
+            provably died, e.g. because it was killed, instead of waiting for the lock to expire. Every
+            lock records the hostname, pid, process start marker and thread of its holder. Holders are only
+            considered dead on Linux, see :mod:`db_mutex.holders`.
 
         :raises:
             * :class:`DBMutexError <db_mutex.exceptions.DBMutexError>` when the lock cannot be obtained
@@ -65,66 +167,773 @@ class db_mutex(object):
 
         """
         self.lock_id = lock_id
-        self.lock = None
         self.suppress_acquisition_exceptions = suppress_acquisition_exceptions
+        self.wait = wait or timeout is not None
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.ttl = ttl.total_seconds() if isinstance(ttl, timedelta) else ttl
+        self.heartbeat = heartbeat
+        self.using = using
+        self.reentrant = reentrant
+        self.local = local
+        if scope not in (None, TRANSACTION_SCOPE):
+            raise ValueError('Unknown lock scope: {0}'.format(scope))
+        if scope is not None and not self.supports_transaction_scope:
+            raise ValueError('{0} does not support the {1} scope'.format(type(self).__name__, scope))
+        self.scope = scope
+        if reclaim_dead and not self.supports_reclaim_dead:
+            raise ValueError('{0} does not support reclaiming the locks of dead holders'.format(type(self).__name__))
+        self.reclaim_dead = reclaim_dead
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the state of the current acquisition of the lock.
+        """
+        # The owner token of the current acquisition of the lock
+        self.token = None
+        # The number of nested acquisitions of this object that did not query the database
+        self.reentered = 0
+        self.local_held = False
+        # Whether receivers are connected to the signals of the lock, and the number of queries counted for them
+        self.instrumented = False
+        self.queries = 0
+        self.started_at = None
+        self.acquired_at = None
+        # The number of expired locks that were taken over when acquiring the lock
+        self.reclaimed = 0
+        self.heartbeat_thread = None
+        self.heartbeat_stopped = threading.Event()
+        self.heartbeat_task = None
+        # The number of seconds it took to acquire the lock
+        self.acquire_time = None
+        self.listening = False
+
+    def copy(self):
+        """
+        Returns a copy of this lock with the same options that is not acquired. Decorated functions acquire
+        a copy of the lock on every call, so that concurrent calls do not share the state of an acquisition.
+
+        :rtype: :class:`db_mutex`
+        """
+        lock = copy.copy(self)
+        lock.reset()
+        return lock
 
     def get_mutex_ttl_seconds(self):
         """
-        Returns a TTL for mutex locks. It defaults to 30 minutes. If the user specifies None
-        as the TTL, locks never expire.
+        Returns a TTL for mutex locks. It defaults to the ``ttl`` of this lock and then to the
+        ``DB_MUTEX_TTL_SECONDS`` setting, which defaults to 30 minutes. If the user specifies None
+        in the setting, locks never expire.
 
         :rtype: int
         :returns: the mutex's ttl in seconds
         """
-        return getattr(settings, self.mutex_ttl_seconds_settings_key, timedelta(minutes=30).total_seconds())
+        if self.ttl is not None:
+            return self.ttl
+        return getattr(settings, self.mutex_ttl_seconds_settings_key, DEFAULT_MUTEX_TTL_SECONDS)
 
     def delete_expired_locks(self):
         """
-        Deletes all expired mutex locks if a ttl is provided.
+        Deletes all expired mutex locks of the database of this lock, or of all lock databases if
+        no database was given with ``using``. This is not done when acquiring a lock. Use the
+        ``delete_expired_locks`` management command to periodically clean up expired locks instead.
+
+        :rtype: int
+        :returns: the number of deleted locks
+        """
+        databases = [self.using] if self.using is not None else get_lock_databases()
+        return sum(DBMutex.objects.using(database).delete_expired() for database in databases)
+
+    def get_database(self):
+        """
+        Returns the alias of the database that holds this lock.
+
+        :rtype: str
+        """
+        return get_lock_database(self.lock_id, self.using)
+
+    def get_queryset(self):
+        """
+        Returns a queryset of locks on the database that holds this lock.
+        """
+        return DBMutex.objects.using(self.get_database())
+
+    def get_backend(self):
+        """
+        Returns the backend that stores the lock, which is configured with the ``DB_MUTEX_BACKEND`` setting.
+
+        :rtype: :class:`BaseLockBackend <db_mutex.backends.BaseLockBackend>`
+        """
+        return get_backend()
+
+    def get_connection(self):
+        """
+        Returns the connection that the queries of this lock run on. This is a dedicated autocommit
+        connection when the ``DB_MUTEX_SEPARATE_CONNECTION`` setting is enabled.
+        """
+        return get_lock_connection(self.get_database())
+
+    def get_notify_enabled(self, connection=None):
+        """
+        Returns whether releases of locks are announced with NOTIFY and waiters LISTEN for them
+        instead of only polling. This is only supported on PostgreSQL and is disabled by default.
+
+        :param connection: The connection to check, defaults to the connection of this lock
+
+        :rtype: bool
+        :returns: True if LISTEN/NOTIFY is used
+        """
+        connection = connection or self.get_connection()
+        return getattr(settings, self.mutex_notify_settings_key, False) and connection.vendor == 'postgresql'
+
+    def notify_release(self):
+        """
+        Wakes up any waiters for the lock if LISTEN/NOTIFY is enabled.
+        """
+        if self.get_notify_enabled():
+            postgres.notify(self.get_connection(), postgres.get_notify_channel(self.lock_id))
+
+    def wait_for_release(self, delay):
+        """
+        Waits up to ``delay`` seconds before retrying to acquire the lock. When LISTEN/NOTIFY is enabled,
+        this returns as soon as the holder announces that the lock was released. The delay still acts as
+        a fallback poll so that a lost notification cannot make waiters hang.
+
+        :type delay: float
+        :param delay: The maximum number of seconds to wait
+        """
+        if not self.get_notify_enabled():
+            time.sleep(delay)
+            return
+
+        channel = postgres.get_notify_channel(self.lock_id)
+        if not self.listening:
+            postgres.listen(self.get_connection(), channel)
+            self.listening = True
+        postgres.wait_for_notify(self.get_connection(), channel, delay)
+
+    def extend(self):
+        """
+        Renews the lease of the held lock so that it expires one ttl from now.
+
+        :rtype: bool
+        :returns: False if the lock was lost
+        """
+        return self.get_backend().extend(self.lock_id, self.token, self.get_mutex_ttl_seconds(), self.get_database())
+
+    def run_heartbeat(self, interval):
+        """
+        Renews the lease of the lock every ``interval`` seconds until the heartbeat is stopped or the
+        lock is lost. This runs in its own thread and thus with its own database connection.
+        """
+        try:
+            while not self.heartbeat_stopped.wait(interval):
+                try:
+                    if not self.extend():
+                        LOG.error('Lock {0} expired before its lease could be renewed'.format(self.lock_id))
+                        return
+                except DatabaseError:
+                    LOG.exception('Could not renew the lease of lock {0}'.format(self.lock_id))
+        finally:
+            close_lock_connections()
+            connections.close_all()
+
+    def get_heartbeat_interval(self):
+        """
+        Returns the number of seconds between renewals of the lease of the lock, or None if the heartbeat
+        is disabled or the lock does not expire.
+
+        :rtype: float
         """
         ttl_seconds = self.get_mutex_ttl_seconds()
-        if ttl_seconds is not None:
-            DBMutex.objects.filter(creation_time__lte=timezone.now() - timedelta(seconds=ttl_seconds)).delete()
+        if self.heartbeat and ttl_seconds is not None and ttl_seconds > 0 and self.scope is None:
+            return ttl_seconds / 3
+        return None
+
+    def start_heartbeat(self):
+        """
+        Starts renewing the lease of the lock in the background if the heartbeat is enabled and the
+        lock expires.
+        """
+        interval = self.get_heartbeat_interval()
+        if interval is not None:
+            self.heartbeat_stopped.clear()
+            self.heartbeat_thread = threading.Thread(
+                target=self.run_heartbeat, args=(interval,), name='db_mutex heartbeat', daemon=True
+            )
+            self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """
+        Stops renewing the lease of the lock and waits for the heartbeat thread to finish.
+        """
+        if self.heartbeat_thread is not None:
+            self.heartbeat_stopped.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    async def arun_heartbeat(self, interval):
+        """
+        Renews the lease of the lock every ``interval`` seconds until the task is cancelled or the lock
+        is lost. This is the heartbeat of locks that are acquired from async code.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if not await sync_to_async(self.extend)():
+                    LOG.error('Lock {0} expired before its lease could be renewed'.format(self.lock_id))
+                    return
+            except DatabaseError:
+                LOG.exception('Could not renew the lease of lock {0}'.format(self.lock_id))
+
+    def astart_heartbeat(self):
+        """
+        Starts a task that renews the lease of the lock if the heartbeat is enabled and the lock expires.
+        """
+        interval = self.get_heartbeat_interval()
+        if interval is not None:
+            self.heartbeat_task = asyncio.ensure_future(self.arun_heartbeat(interval))
+
+    async def astop_heartbeat(self):
+        """
+        Cancels the task that renews the lease of the lock and waits for it to finish.
+        """
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            try:
+                await self.heartbeat_task
+            except asyncio.CancelledError:
+                pass
+            self.heartbeat_task = None
 
     def __call__(self, func):
         return self.decorate_callable(func)
 
     def __enter__(self):
         self.start()
+        return self
 
     def __exit__(self, *args):
         self.stop()
 
+    async def __aenter__(self):
+        await self.astart()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.astop()
+
+    def get_local_key(self):
+        """
+        Returns the key of this lock among the reentrant locks held by the current thread or task and among
+        the locks held by the current process.
+
+        :rtype: tuple
+        """
+        return (type(self).__name__, self.get_database(), self.lock_id)
+
+    def reenter(self):
+        """
+        Acquires the lock again without querying the database if it is reentrant and already held by the
+        current thread or task.
+
+        :rtype: bool
+        :returns: True if the lock was held already
+        """
+        if not self.reentrant:
+            return False
+
+        key = self.get_local_key()
+        locks = held_locks.get()
+        owner, count = locks.get(key, (None, 0))
+        if owner is not get_owner():
+            return False
+        held_locks.set({**locks, key: (owner, count + 1)})
+        self.reentered += 1
+        self.acquire_time = 0
+        return True
+
+    def get_local_limit(self):
+        """
+        Returns the number of threads of a process that can hold the lock at the same time, or None if the
+        lock is never contended.
+
+        :rtype: int
+        """
+        return 1
+
+    def acquire_local(self, elapsed=0, cancelled=None):
+        """
+        Registers the lock in the process local registry if ``local`` is enabled. Waits for other threads of
+        the process to release the lock when waiting for the lock, or fails right away otherwise.
+
+        :type elapsed: float
+        :param elapsed: The number of seconds already spent on acquiring the lock
+        :type cancelled: :class:`threading.Event`
+        :param cancelled: An event that stops waiting when it is set with :meth:`LocalLocks.cancel
+            <db_mutex.local.LocalLocks.cancel>`
+
+        :rtype: bool
+        :returns: False if other threads of the process hold the lock
+        """
+        limit = self.get_local_limit()
+        if not self.local or limit is None:
+            return True
+
+        timeout = 0
+        if self.wait:
+            timeout = None if self.timeout is None else max(self.timeout - elapsed, 0)
+        if not local_locks.acquire(self.get_local_key(), limit, timeout, cancelled):
+            return False
+        self.local_held = True
+        return True
+
+    async def aacquire_local(self):
+        """
+        Registers the lock in the process local registry from async code. Waiting for other threads runs in
+        a thread pool, so that it does not block the thread that runs the queries of all async holders.
+        When the task is cancelled, the waiting thread is woken up and a registration it made anyway is
+        released before the cancellation is raised.
+
+        :rtype: bool
+        :returns: False if other threads of the process hold the lock
+        """
+        cancelled = threading.Event()
+        future = asyncio.ensure_future(
+            sync_to_async(self.acquire_local, thread_sensitive=False)(cancelled=cancelled)
+        )
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            local_locks.cancel(self.get_local_key(), cancelled)
+            await asyncio.wait([future])
+            if not future.exception() and future.result():
+                self.release_local()
+            raise
+
+    def release_local(self):
+        """
+        Unregisters the lock from the process local registry.
+        """
+        if self.local_held:
+            self.local_held = False
+            local_locks.release(self.get_local_key())
+
+    def hold(self):
+        """
+        Records that the current thread or task holds the lock if it is reentrant.
+        """
+        if self.reentrant:
+            held_locks.set({**held_locks.get(), self.get_local_key(): (get_owner(), 1)})
+
+    def unhold(self):
+        """
+        Records that a hold of the lock ended.
+
+        :rtype: bool
+        :returns: True if the lock is still held by an outer holder
+        """
+        if not self.reentrant:
+            return False
+
+        key = self.get_local_key()
+        locks = dict(held_locks.get())
+        if self.reentered:
+            self.reentered -= 1
+            if key in locks:
+                owner, count = locks[key]
+                locks[key] = (owner, count - 1)
+            held_locks.set(locks)
+            return True
+        locks.pop(key, None)
+        held_locks.set(locks)
+        return False
+
+    def get_retry_delay(self, attempt, elapsed):
+        """
+        Returns how long to sleep before retrying to acquire the lock, or None if no more attempts
+        should be made. The delay grows exponentially with the number of failed attempts up to
+        ``max_poll_interval`` and is jittered so that contending waiters spread out their retries.
+
+        :type attempt: int
+        :param attempt: The number of failed attempts so far, starting at 1
+        :type elapsed: float
+        :param elapsed: The number of seconds spent trying to acquire the lock so far
+
+        :rtype: float
+        :returns: the number of seconds to sleep or None
+        """
+        if not self.wait:
+            return None
+
+        delay = min(self.poll_interval * 2 ** (attempt - 1), self.max_poll_interval)
+        delay = random.uniform(delay / 2, delay)
+        if self.timeout is not None:
+            remaining = self.timeout - elapsed
+            if remaining <= 0:
+                return None
+            delay = min(delay, remaining)
+        return delay
+
+    def try_acquire(self):
+        """
+        Makes a single attempt at acquiring the db mutex lock. An expired lock of the same lock id is
+        taken over. On PostgreSQL and SQLite this is done with a single query that neither needs a
+        savepoint nor raises an IntegrityError when the lock is held.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        if self.scope == TRANSACTION_SCOPE:
+            return self.try_acquire_for_transaction()
+        # The token is only stored once the lock is acquired, so that a failed attempt does not overwrite the
+        # token of a holder of the same object
+        token = secrets.token_hex(16)
+        backend = self.get_backend()
+        acquired = backend.acquire(self.lock_id, token, self.get_mutex_ttl_seconds(), self.get_database())
+        if not acquired and self.reclaim_dead_holders([self.lock_id], self.get_database()):
+            acquired = backend.acquire(self.lock_id, token, self.get_mutex_ttl_seconds(), self.get_database())
+        if acquired:
+            self.token = token
+        return acquired
+
+    def reclaim_dead_holders(self, lock_ids, database):
+        """
+        Releases the held locks among ``lock_ids`` whose holders provably died if ``reclaim_dead`` is set.
+
+        :rtype: bool
+        :returns: True if any lock was released, so that acquiring can be retried right away
+        """
+        if not self.reclaim_dead:
+            return False
+        reclaimed = self.get_backend().reclaim_dead(lock_ids, database)
+        if reclaimed:
+            LOG.warning('Reclaimed {0} locks of dead holders for lock {1}'.format(reclaimed, self.lock_id))
+        return reclaimed > 0
+
+    def try_acquire_for_transaction(self):
+        """
+        Makes a single attempt at acquiring the lock until the current transaction ends. This runs on the
+        connection of the transaction and always stores the lock in the lock table, whatever the
+        ``DB_MUTEX_BACKEND`` setting, so that it excludes the other locks of the same lock id.
+
+        The lock is created in the transaction, so it disappears if the transaction rolls back, and it is
+        deleted after the transaction commits. While the transaction is open, others that try to acquire
+        the lock block until it ends, whatever their ``timeout``. On PostgreSQL, this attempt itself only
+        waits for another transaction that holds the lock until the timeout of this lock elapses. The lock
+        expires after its ttl like other locks, but its lease is not renewed by the heartbeat.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        database = self.get_database()
+        connection = connections[database]
+        if not connection.in_atomic_block:
+            raise TransactionManagementError('Locks with the transaction scope must be acquired in an atomic block')
+
+        token = secrets.token_hex(16)
+        queryset = self.get_queryset()
+        lock_timeout = self.get_lock_timeout()
+        if connection.vendor == 'postgresql' and lock_timeout is not None:
+            acquired = self.acquire_with_lock_timeout(queryset, token, connection, lock_timeout)
+        else:
+            acquired = queryset.acquire(self.lock_id, token, self.get_mutex_ttl_seconds(), connection=connection)
+        if not acquired:
+            return False
+        self.token = token
+
+        def release():
+            queryset.release(self.lock_id, token)
+            self.notify_release()
+
+        transaction.on_commit(release, using=database)
+        return True
+
+    def get_lock_timeout(self):
+        """
+        Returns how many seconds an attempt may wait for a lock that another transaction holds, or None to
+        wait until the transaction ends.
+
+        :rtype: float
+        """
+        if not self.wait:
+            return 0
+        if self.timeout is None:
+            return None
+        return max(self.timeout - (time.monotonic() - self.started_at), 0)
+
+    def acquire_with_lock_timeout(self, queryset, token, connection, lock_timeout):
+        """
+        Acquires the lock in a savepoint in which PostgreSQL waits at most ``lock_timeout`` seconds for
+        another transaction that holds the lock. Running out of time counts as a failed attempt and leaves
+        the transaction usable.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        try:
+            with transaction.atomic(using=connection.alias):
+                with postgres.lock_timeout(connection, lock_timeout):
+                    return queryset.acquire(self.lock_id, token, self.get_mutex_ttl_seconds(), connection=connection)
+        except OperationalError as error:
+            if not postgres.is_lock_timeout(error):
+                raise
+            return False
+
     def start(self):
         """
-        Acquires the db mutex lock. Takes the necessary steps to delete any stale locks.
+        Acquires the db mutex lock, retrying until the timeout elapses when waiting for the lock.
         Throws a DBMutexError if it can't acquire the lock.
+
+        When the ``DB_MUTEX_NOTIFY`` setting is enabled on PostgreSQL, waiters LISTEN for the release
+        of the lock and retry as soon as they are notified instead of sleeping for the full delay.
         """
-        # Delete any expired locks first
-        self.delete_expired_locks()
+        if self.reenter():
+            return
+
+        start_time = self.starting()
+        if not self.acquire_local():
+            raise self.failed(0, start_time)
+
+        attempt = 0
         try:
-            with transaction.atomic():
-                self.lock = DBMutex.objects.create(lock_id=self.lock_id)
-        except IntegrityError:
-            raise DBMutexError('Could not acquire lock: {0}'.format(self.lock_id))
+            while not self.attempt_acquire(attempt + 1, start_time):
+                attempt += 1
+                delay = self.get_retry_delay(attempt, time.monotonic() - start_time)
+                if delay is None:
+                    raise self.failed(attempt, start_time)
+                self.wait_for_release(delay)
+        except BaseException:
+            self.abandon()
+            self.release_local()
+            raise
+        finally:
+            if self.listening:
+                postgres.unlisten(self.get_connection(), postgres.get_notify_channel(self.lock_id))
+                self.listening = False
 
-    def stop(self):
+        self.acquired(attempt, start_time)
+        self.hold()
+        self.start_heartbeat()
+
+    async def astart(self):
+        """
+        Acquires the db mutex lock from async code. Every attempt runs the query in a thread with
+        ``sync_to_async``, while waiting between attempts is an ``asyncio.sleep`` so that waiters do not
+        hold on to a thread. Waiters always poll since LISTEN/NOTIFY would block the event loop.
+        Throws a DBMutexError if it can't acquire the lock.
+        """
+        if not self.supports_async:
+            raise NotImplementedError('{0} cannot be acquired from async code'.format(type(self).__name__))
+        if self.reenter():
+            return
+
+        start_time = self.starting()
+        if not await self.aacquire_local():
+            raise self.failed(0, start_time)
+
+        attempt = 0
+        try:
+            while not await self.aattempt_acquire(attempt + 1, start_time):
+                attempt += 1
+                delay = self.get_retry_delay(attempt, time.monotonic() - start_time)
+                if delay is None:
+                    raise self.failed(attempt, start_time)
+                await asyncio.sleep(delay)
+        except BaseException:
+            await sync_to_async(self.abandon)()
+            self.release_local()
+            raise
+
+        self.acquired(attempt, start_time)
+        self.hold()
+        self.astart_heartbeat()
+
+    async def aattempt_acquire(self, attempt, start_time):
+        """
+        Makes a single attempt at acquiring the lock from async code. The query keeps running in its thread
+        when the task is cancelled, so the attempt is awaited and a lock that it acquired is released before
+        the cancellation is raised.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        future = asyncio.ensure_future(sync_to_async(self.attempt_acquire)(attempt, start_time))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.wait([future])
+            # Locks with the transaction scope are released when the transaction ends
+            if not future.exception() and future.result() and self.scope is None:
+                await sync_to_async(self.release)()
+            raise
+
+    def send(self, signal, **kwargs):
+        """
+        Sends one of the signals in :mod:`db_mutex.signals` for this lock.
         """
-        Releases the db mutex lock. Throws an error if the lock was released before the function finished.
+        if self.instrumented:
+            signal.send(sender=type(self), lock=self, lock_id=self.lock_id, **kwargs)
+
+    def get_query_connections(self):
+        """
+        Returns the connections that the queries of this lock run on.
+
+        :rtype: list
+        """
+        lock_connection = self.get_connection()
+        connection = connections[self.get_database()]
+        if self.scope == TRANSACTION_SCOPE and connection is not lock_connection:
+            return [lock_connection, connection]
+        return [lock_connection]
+
+    def count_query(self, execute, sql, params, many, context):
+        """
+        An execute wrapper that counts the queries of this lock.
+        """
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def count_queries(self, func, *args):
+        """
+        Calls a function and counts the queries it runs on the connections of this lock if the lock is
+        instrumented.
+        """
+        if not self.instrumented:
+            return func(*args)
+        with contextlib.ExitStack() as stack:
+            for connection in self.get_query_connections():
+                stack.enter_context(connection.execute_wrapper(self.count_query))
+            return func(*args)
+
+    def starting(self):
+        """
+        Prepares for acquiring the lock.
+
+        :rtype: float
+        :returns: the start time of the acquisition
+        """
+        self.instrumented = signals.has_listeners(type(self))
+        self.queries = 0
+        self.started_at = time.monotonic()
+        return self.started_at
+
+    def attempt_acquire(self, attempt, start_time):
+        """
+        Makes a single attempt at acquiring the lock and reports it.
+
+        :type attempt: int
+        :param attempt: The number of the attempt, starting at 1
+
+        :rtype: bool
+        :returns: True if the lock was acquired
         """
-        if not DBMutex.objects.filter(id=self.lock.id).exists():
+        self.send(signals.lock_acquire_attempted, attempt=attempt)
+        reclaimed_token = reclaimed_locks.set(0)
+        try:
+            acquired = self.count_queries(self.try_acquire)
+            self.reclaimed = reclaimed_locks.get()
+        finally:
+            reclaimed_locks.reset(reclaimed_token)
+        if not acquired:
+            self.send(signals.lock_contended, attempt=attempt, wait_time=time.monotonic() - start_time)
+        return acquired
+
+    def failed(self, attempt, start_time):
+        """
+        Reports that acquiring the lock failed.
+
+        :rtype: :class:`DBMutexError <db_mutex.exceptions.DBMutexError>`
+        :returns: the error to raise
+        """
+        self.send(
+            signals.lock_acquire_failed, attempts=attempt, wait_time=time.monotonic() - start_time,
+            queries=self.queries
+        )
+        return DBMutexError('Could not acquire lock: {0}'.format(self.lock_id))
+
+    def abandon(self):
+        """
+        Cleans up after acquiring the lock failed. Locks that keep state between attempts release it here.
+        """
+
+    def acquired(self, attempt, start_time):
+        """
+        Records how long it took to acquire the lock and reports it.
+        """
+        self.acquired_at = time.monotonic()
+        self.acquire_time = self.acquired_at - start_time
+        if attempt:
+            LOG.debug('Acquired lock {0} after {1} attempts in {2:.3f} seconds'.format(
+                self.lock_id, attempt + 1, self.acquire_time
+            ))
+        self.send(signals.lock_acquired, attempts=attempt + 1, wait_time=self.acquire_time, queries=self.queries)
+        if self.reclaimed:
+            self.send(signals.lock_reclaimed, reclaimed=self.reclaimed)
+
+    def release(self):
+        """
+        Releases the db mutex lock with a single query. Throws an error if the lock was released before
+        the function finished. The lock is only deleted if it is still held with the owner token of this
+        acquisition, so a lock that expired and was acquired by someone else is left alone.
+        """
+        if not self.get_backend().release(self.lock_id, self.token, self.get_database()):
             raise DBMutexTimeoutError('Lock {0} expired before function completed'.format(self.lock_id))
-        else:
-            self.lock.delete()
+        self.notify_release()
+
+    def release_and_report(self):
+        """
+        Releases the lock and reports how long it was held, or that it expired.
+        """
+        self.queries = 0
+        try:
+            self.count_queries(self.release)
+        except DBMutexTimeoutError:
+            self.send(signals.lock_expired, hold_time=time.monotonic() - self.acquired_at, queries=self.queries)
+            raise
+        self.send(signals.lock_released, hold_time=time.monotonic() - self.acquired_at, queries=self.queries)
+
+    def stop(self):
+        """
+        Stops the heartbeat and releases the db mutex lock. Nested holders of a reentrant lock only
+        decrement the hold count.
+        """
+        if self.unhold():
+            return
+        try:
+            # Locks with the transaction scope are released when the transaction ends
+            if self.scope is None:
+                self.stop_heartbeat()
+                self.release_and_report()
+        finally:
+            self.release_local()
+
+    async def astop(self):
+        """
+        Stops the heartbeat and releases the db mutex lock from async code.
+        """
+        if self.unhold():
+            return
+        try:
+            if self.scope is None:
+                await self.astop_heartbeat()
+                await sync_to_async(self.release_and_report)()
+        finally:
+            self.release_local()
 
     def decorate_callable(self, func):
         """
         Decorates a function with the db_mutex decorator by using this class as a context manager around
-        it.
+        it. Coroutine functions are decorated by using this class as an async context manager.
         """
+        if asyncio.iscoroutinefunction(func):
+            return self.decorate_coroutine_function(func)
+
         def wrapper(*args, **kwargs):
             try:
-                with self:
+                with self.copy():
                     result = func(*args, **kwargs)
                 return result
             except DBMutexError as e:
@@ -134,3 +943,485 @@ class db_mutex(object):
                     raise e
         functools.update_wrapper(wrapper, func)
         return wrapper
+
+    def decorate_coroutine_function(self, func):
+        """
+        Decorates a coroutine function with the db_mutex decorator by using this class as an async context
+        manager around it.
+        """
+        async def wrapper(*args, **kwargs):
+            try:
+                async with self.copy():
+                    result = await func(*args, **kwargs)
+                return result
+            except DBMutexError as e:
+                if self.suppress_acquisition_exceptions:
+                    LOG.error(e)
+                else:
+                    raise e
+        functools.update_wrapper(wrapper, func)
+        return wrapper
+
+
+class db_mutex_many(db_mutex):
+    """
+    A db_mutex that holds several locks at once, e.g. one per account that a transfer touches. The locks
+    are acquired all or nothing with a single bulk insert and released with a single DELETE, instead of
+    two round trips per lock when nesting ``db_mutex``. Since a failed attempt never holds on to some of
+    the locks while waiting for the others, waiters for overlapping sets of locks cannot deadlock.
+
+    .. code-block:: python
+
+        from db_mutex.db_mutex import db_mutex_many
+
+        with db_mutex_many(['account-1', 'account-2'], timeout=10):
+            # Run critical code here
+            pass
+
+    All of the options of ``db_mutex`` are supported. When locks are sharded across several databases,
+    the locks are acquired with one query per database in the order of the database aliases, and waiters
+    poll instead of using LISTEN/NOTIFY.
+    """
+    supports_transaction_scope = False
+
+    def __init__(self, lock_ids, **kwargs):
+        """
+        :type lock_ids: list
+        :param lock_ids: The IDs of the locks one is trying to acquire
+        """
+        self.lock_ids = sorted(set(lock_ids))
+        super(db_mutex_many, self).__init__(', '.join(self.lock_ids), **kwargs)
+
+    def get_lock_ids_by_database(self):
+        """
+        Groups the lock ids by the database that holds them.
+
+        :rtype: list
+        :returns: tuples of a database alias and the sorted lock ids on it, sorted by database alias
+        """
+        lock_ids_by_database = {}
+        for lock_id in self.lock_ids:
+            lock_ids_by_database.setdefault(get_lock_database(lock_id, self.using), []).append(lock_id)
+        return sorted(lock_ids_by_database.items())
+
+    def try_acquire(self):
+        """
+        Makes a single attempt at acquiring all of the locks. If one of the databases holds a lock that
+        cannot be acquired, the locks acquired on the other databases are released again.
+
+        :rtype: bool
+        :returns: True if all of the locks were acquired
+        """
+        token = secrets.token_hex(16)
+        backend = self.get_backend()
+        ttl_seconds = self.get_mutex_ttl_seconds()
+        acquired = []
+        for database, lock_ids in self.get_lock_ids_by_database():
+            if not backend.acquire_many(lock_ids, token, ttl_seconds, database) and not (
+                self.reclaim_dead_holders(lock_ids, database)
+                and backend.acquire_many(lock_ids, token, ttl_seconds, database)
+            ):
+                for acquired_database, acquired_lock_ids in acquired:
+                    backend.release_many(acquired_lock_ids, token, acquired_database)
+                return False
+            acquired.append((database, lock_ids))
+        self.token = token
+        return True
+
+    def get_query_connections(self):
+        """
+        The locks can be spread across the connections of several databases.
+        """
+        return [get_lock_connection(database) for database, lock_ids in self.get_lock_ids_by_database()]
+
+    def wait_for_release(self, delay):
+        """
+        Waits ``delay`` seconds before retrying to acquire the locks.
+        """
+        time.sleep(delay)
+
+    def notify_release(self):
+        """
+        Wakes up any waiters for the released locks if LISTEN/NOTIFY is enabled.
+        """
+        for database, lock_ids in self.get_lock_ids_by_database():
+            connection = get_lock_connection(database)
+            if self.get_notify_enabled(connection):
+                for lock_id in lock_ids:
+                    postgres.notify(connection, postgres.get_notify_channel(lock_id))
+
+    def extend(self):
+        """
+        Renews the leases of all of the held locks with one query per database.
+
+        :rtype: bool
+        :returns: False if any of the locks was lost
+        """
+        backend = self.get_backend()
+        ttl_seconds = self.get_mutex_ttl_seconds()
+        return all(
+            backend.extend_many(lock_ids, self.token, ttl_seconds, database) == len(lock_ids)
+            for database, lock_ids in self.get_lock_ids_by_database()
+        )
+
+    def release(self):
+        """
+        Releases all of the locks with one query per database. Throws an error if any of the locks expired
+        before the function finished.
+        """
+        backend = self.get_backend()
+        released = sum(
+            backend.release_many(lock_ids, self.token, database)
+            for database, lock_ids in self.get_lock_ids_by_database()
+        )
+        if released != len(self.lock_ids):
+            raise DBMutexTimeoutError('Locks {0} expired before function completed'.format(self.lock_id))
+        self.notify_release()
+
+
+class db_semaphore(db_mutex):
+    """
+    A db_mutex that allows up to ``limit`` concurrent holders of the same lock id, e.g. to run at most
+    eight exports per tenant at the same time. Every holder claims one of ``limit`` slots, which are
+    locks with the ids ``'<lock_id>:0'`` through ``'<lock_id>:<limit - 1>'``. A free or expired slot is
+    claimed with a single query instead of trying the slots one by one.
+
+    .. code-block:: python
+
+        from db_mutex.db_mutex import db_semaphore
+
+        with db_semaphore('exports-tenant-1', limit=8, timeout=60):
+            # Run the export here
+            pass
+
+    All of the options of ``db_mutex`` are supported. Slots are tried in a random order so that
+    concurrent claimants rarely race for the same slot. When they do, the attempt of one of them fails
+    even though another slot may be free, so use ``wait`` or a ``timeout`` under contention.
+    """
+    supports_transaction_scope = False
+
+    def __init__(self, lock_id, limit, **kwargs):
+        """
+        :type limit: int
+        :param limit: The maximum number of concurrent holders
+        """
+        if limit < 1:
+            raise ValueError('The limit of a semaphore must be at least 1')
+        self.limit = limit
+        super(db_semaphore, self).__init__(lock_id, **kwargs)
+
+    def get_local_limit(self):
+        """
+        Up to ``limit`` threads of a process can hold the semaphore.
+        """
+        return self.limit
+
+    def get_slot_ids(self):
+        """
+        Returns the lock ids of the slots of the semaphore.
+
+        :rtype: list
+        """
+        return ['{0}:{1}'.format(self.lock_id, slot) for slot in range(self.limit)]
+
+    def try_acquire(self):
+        """
+        Makes a single attempt at claiming a free slot.
+
+        :rtype: bool
+        :returns: True if a slot was claimed
+        """
+        token = secrets.token_hex(16)
+        slot_ids = self.get_slot_ids()
+        random.shuffle(slot_ids)
+        backend = self.get_backend()
+        acquired = backend.acquire_slot(slot_ids, token, self.get_mutex_ttl_seconds(), self.get_database())
+        if not acquired and self.reclaim_dead_holders(slot_ids, self.get_database()):
+            acquired = backend.acquire_slot(slot_ids, token, self.get_mutex_ttl_seconds(), self.get_database())
+        if acquired:
+            self.token = token
+        return acquired
+
+    def extend(self):
+        """
+        Renews the lease of the claimed slot.
+
+        :rtype: bool
+        :returns: False if the slot was lost
+        """
+        return self.get_backend().extend_many(
+            self.get_slot_ids(), self.token, self.get_mutex_ttl_seconds(), self.get_database()
+        ) == 1
+
+    def release(self):
+        """
+        Releases the claimed slot with a single query. Throws an error if the slot expired before the
+        function finished.
+        """
+        if self.get_backend().release_many(self.get_slot_ids(), self.token, self.get_database()) != 1:
+            raise DBMutexTimeoutError('Lock {0} expired before function completed'.format(self.lock_id))
+        self.notify_release()
+
+
+class db_rw_mutex(db_mutex):
+    """
+    A reader-writer lock. Any number of readers that pass ``shared=True`` can hold the lock at the same
+    time, while a writer excludes readers and other writers.
+
+    .. code-block:: python
+
+        from db_mutex.db_mutex import db_rw_mutex
+
+        with db_rw_mutex('lock_id', shared=True):
+            # Read the shared state here
+            pass
+
+        with db_rw_mutex('lock_id', timeout=10):
+            # Modify the shared state here
+            pass
+
+    The writer holds the lock ``lock_id`` and every reader holds a lock of its own, ``'<lock_id>:r:<token>'``,
+    so lock ids can be at most 221 characters long.
+    Both sides first create their lock and then check for the other side, so that a reader and a writer
+    cannot both miss each other. A writer claims ``lock_id`` right away and then waits for the current
+    readers to finish, while new readers back off as soon as a writer claimed the lock, so writers do
+    not starve. A writer that gives up on waiting releases its claim again.
+
+    All of the options of ``db_mutex`` are supported. Note that a plain ``db_mutex`` of the same lock id
+    excludes writers but not readers. Since writers look up readers by the prefix of their lock ids,
+    reader-writer locks are always stored in the lock table, whatever the ``DB_MUTEX_BACKEND`` setting.
+    The locks of dead readers and writers are not reclaimed early, so ``reclaim_dead`` is not supported.
+    """
+    supports_transaction_scope = False
+    supports_reclaim_dead = False
+
+    def __init__(self, lock_id, shared=False, **kwargs):
+        """
+        :type shared: bool
+        :param shared: Acquire the lock as a reader instead of a writer
+        """
+        self.shared = shared
+        super(db_rw_mutex, self).__init__(lock_id, **kwargs)
+        # Readers store their locks as '<lock_id>:r:<token>', which has to fit into the lock id column
+        suffix_length = len(self.get_reader_prefix()) - len(lock_id) + len(secrets.token_hex(16))
+        max_length = DBMutex._meta.get_field('lock_id').max_length - suffix_length
+        if len(lock_id) > max_length:
+            raise ValueError('The lock id of a reader-writer lock can be at most {0} characters long'.format(
+                max_length
+            ))
+
+    def reset(self):
+        """
+        Also resets the claim of a writer.
+        """
+        super(db_rw_mutex, self).reset()
+        # True while a writer holds lock_id but still waits for readers to finish
+        self.pending = False
+
+    def get_local_key(self):
+        """
+        Readers and writers reenter the lock separately.
+        """
+        return super(db_rw_mutex, self).get_local_key() + (self.shared,)
+
+    def get_local_limit(self):
+        """
+        Readers do not exclude each other.
+        """
+        return None if self.shared else 1
+
+    def get_reader_prefix(self):
+        """
+        Returns the prefix of the lock ids of the readers.
+
+        :rtype: str
+        """
+        return '{0}:r:'.format(self.lock_id)
+
+    def get_held_lock_id(self, token=None):
+        """
+        Returns the lock id of the lock that is held by this reader or writer.
+
+        :type token: str
+        :param token: The owner token of the reader, defaults to the token of the current acquisition
+
+        :rtype: str
+        """
+        if self.shared:
+            return self.get_reader_prefix() + (token or self.token)
+        return self.lock_id
+
+    def try_acquire(self):
+        """
+        Makes a single attempt at acquiring the lock as a reader or a writer.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        if self.shared:
+            return self.try_acquire_shared()
+        return self.try_acquire_exclusive()
+
+    def try_acquire_shared(self):
+        """
+        Creates the lock of this reader and releases it again if a writer holds or waits for the lock.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        token = secrets.token_hex(16)
+        lock_id = self.get_held_lock_id(token)
+        queryset = self.get_queryset()
+        if not queryset.acquire(lock_id, token, self.get_mutex_ttl_seconds()):
+            return False
+        if not queryset.is_held(self.lock_id):
+            self.token = token
+            return True
+        queryset.release(lock_id, token)
+        return False
+
+    def try_acquire_exclusive(self):
+        """
+        Claims the lock as a writer unless it was already claimed by a previous attempt, and checks
+        whether all readers finished. The claim is kept while waiting for readers, and its lease is
+        renewed on every attempt.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        queryset = self.get_queryset()
+        if self.pending and not self.extend():
+            self.pending = False
+        if not self.pending:
+            token = secrets.token_hex(16)
+            if not queryset.acquire(self.lock_id, token, self.get_mutex_ttl_seconds()):
+                return False
+            self.token = token
+            self.pending = True
+
+        if not queryset.is_held(self.get_reader_prefix(), prefix=True):
+            self.pending = False
+            return True
+        if not self.wait:
+            self.abandon()
+        return False
+
+    def abandon(self):
+        """
+        Releases the claim of a writer that gave up waiting for readers.
+        """
+        if self.pending:
+            self.pending = False
+            self.get_queryset().release(self.lock_id, self.token)
+            self.notify_release()
+
+    def extend(self):
+        """
+        Renews the lease of the held lock.
+
+        :rtype: bool
+        :returns: False if the lock was lost
+        """
+        return self.get_queryset().extend(self.get_held_lock_id(), self.token, self.get_mutex_ttl_seconds())
+
+    def release(self):
+        """
+        Releases the lock of this reader or writer with a single query. Throws an error if the lock
+        expired before the function finished.
+        """
+        if not self.get_queryset().release(self.get_held_lock_id(), self.token):
+            raise DBMutexTimeoutError('Lock {0} expired before function completed'.format(self.lock_id))
+        self.notify_release()
+
+
+class db_advisory_mutex(db_mutex):
+    """
+    A db_mutex that is backed by a PostgreSQL session level advisory lock instead of a row in the
+    ``DBMutex`` table. Acquiring and releasing the lock each take a single query and nothing is
+    written to disk.
+
+    .. code-block:: python
+
+        from db_mutex.db_mutex import db_advisory_mutex
+
+        with db_advisory_mutex('lock_id'):
+            # Run critical code here
+            pass
+
+    Advisory locks are held by the database connection, so they are released if the connection is
+    closed and they do not expire. Since PostgreSQL advisory locks are reentrant for the connection
+    that holds them, acquiring the same lock twice from the same thread does not raise an error.
+
+    Pass ``shared=True`` to take a shared advisory lock, which can be held by any number of connections
+    while it excludes the exclusive lock. Unlike ``db_rw_mutex``, a waiting writer does not keep new
+    readers from acquiring the lock, so writers can starve under a steady stream of readers.
+
+    Advisory locks cannot be acquired from async code, since the queries of all tasks of an event loop
+    run on the connection of the same thread and would not exclude each other.
+    """
+    supports_transaction_scope = False
+    # Advisory locks are released by the database as soon as the connection of a dead holder is closed
+    supports_reclaim_dead = False
+    supports_async = False
+
+    def __init__(self, lock_id, shared=False, **kwargs):
+        """
+        :type shared: bool
+        :param shared: Take a shared instead of an exclusive advisory lock
+        """
+        self.shared = shared
+        super(db_advisory_mutex, self).__init__(lock_id, **kwargs)
+
+    def get_local_limit(self):
+        """
+        Shared advisory locks do not exclude each other.
+        """
+        return None if self.shared else 1
+
+    def get_mutex_ttl_seconds(self):
+        """
+        Advisory locks never expire, so they do not have a TTL.
+        """
+        return None
+
+    def get_advisory_lock_key(self):
+        """
+        Hashes the lock id into the signed 64 bit key space of PostgreSQL advisory locks.
+
+        :rtype: int
+        :returns: the advisory lock key for the lock id
+        """
+        return postgres.get_advisory_lock_key(self.lock_id)
+
+    def try_acquire(self):
+        """
+        Makes a single attempt at acquiring the advisory lock.
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        connection = self.get_connection()
+        if connection.vendor != 'postgresql':
+            raise ImproperlyConfigured('db_advisory_mutex requires a PostgreSQL database')
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_try_advisory_lock{0}(%s)'.format('_shared' if self.shared else ''),
+                [self.get_advisory_lock_key()]
+            )
+            return cursor.fetchone()[0]
+
+    def release(self):
+        """
+        Releases the advisory lock. Throws an error if the lock was released before the function finished.
+        """
+        with self.get_connection().cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_unlock{0}(%s)'.format('_shared' if self.shared else ''),
+                [self.get_advisory_lock_key()]
+            )
+            released = cursor.fetchone()[0]
+
+        if not released:
+            raise DBMutexTimeoutError('Lock {0} was released before function completed'.format(self.lock_id))
+        self.notify_release()
@@ -0,0 +1,110 @@
+"""
+Helpers for identifying the process and thread that hold a lock, and for telling whether the holder of a
+lock is dead. Every lock records the hostname, pid, process start marker and thread name of its holder.
+
+The process start marker is ``'<boot id>:<pid namespace>:<start time>'``, read from ``/proc`` on Linux.
+It tells a dead holder apart from a new process that reuses its pid, and it only matches processes whose
+pids are comparable, i.e. processes that run since the same boot in the same pid namespace. On platforms
+without ``/proc``, the marker is empty and holders are never considered dead.
+"""
+import os
+import socket
+import threading
+
+
+# Holds the hostname and process start marker of the current process by pid, so forked processes look
+# up their own
+process_cache = {}
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read().strip()
+
+
+def get_host_marker():
+    """
+    Returns the boot id and pid namespace of the current process, the part of the process start marker that
+    is shared by all processes whose pids can be compared.
+
+    :rtype: str
+    :returns: the marker or an empty string if it cannot be read
+    """
+    try:
+        return '{0}:{1}'.format(
+            read_file('/proc/sys/kernel/random/boot_id'), os.readlink('/proc/self/ns/pid')
+        )
+    except OSError:
+        return ''
+
+
+def get_start_time(pid):
+    """
+    Returns the time a process started at in clock ticks since boot.
+
+    :rtype: str
+    :returns: the start time or None if there is no process with the pid
+
+    :raises OSError: when the start time cannot be read for another reason
+    """
+    try:
+        stat = read_file('/proc/{0}/stat'.format(pid))
+    except FileNotFoundError:
+        return None
+    # The command name in parentheses can contain spaces, so the fields are counted from its end
+    return stat[stat.rindex(')') + 2:].split()[19]
+
+
+def get_process():
+    """
+    Returns the hostname and process start marker of the current process.
+
+    :rtype: tuple
+    """
+    pid = os.getpid()
+    process = process_cache.get(pid)
+    if process is None:
+        marker = get_host_marker()
+        if marker:
+            try:
+                marker = '{0}:{1}'.format(marker, get_start_time(pid))
+            except OSError:
+                marker = ''
+        process = process_cache[pid] = (socket.gethostname()[:255], marker)
+    return process
+
+
+def get_holder():
+    """
+    Returns the metadata of the current thread that is recorded on the locks it acquires.
+
+    :rtype: dict
+    :returns: the ``hostname``, ``pid``, ``process_start`` and ``thread`` of the holder
+    """
+    hostname, process_start = get_process()
+    return {
+        'hostname': hostname,
+        'pid': os.getpid(),
+        'process_start': process_start,
+        'thread': threading.current_thread().name[:255],
+    }
+
+
+def is_dead(hostname, pid, process_start):
+    """
+    Returns whether the holder of a lock provably died. This is only the case for holders on the same host
+    whose pid refers to the same pid namespace as the current process, and either no longer exists or
+    belongs to a process that started later.
+
+    :rtype: bool
+    """
+    own_hostname, own_process_start = get_process()
+    if hostname != own_hostname or pid is None or not process_start or not own_process_start:
+        return False
+    host_marker, _, start_time = process_start.rpartition(':')
+    if host_marker != own_process_start.rpartition(':')[0]:
+        return False
+    try:
+        return get_start_time(pid) != start_time
+    except OSError:
+        return False
@@ -0,0 +1,104 @@
+"""
+A process local registry of held locks that lets threads of the same process contend for a lock without
+querying the database.
+"""
+import threading
+import time
+
+
+class LocalLockEntry(object):
+    """
+    The holders and waiters of a lock in the current process.
+    """
+    def __init__(self, lock):
+        self.holders = 0
+        self.waiters = 0
+        self.condition = threading.Condition(lock)
+
+
+class LocalLocks(object):
+    """
+    Keeps track of the number of threads of the current process that hold a lock. Threads that wait for
+    a lock sleep on a condition of their own lock id, so releasing a lock only wakes up its waiters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def acquire(self, key, limit=1, timeout=None, cancelled=None):
+        """
+        Registers a holder of a lock once fewer than ``limit`` threads hold it.
+
+        :type key: tuple
+        :param key: The key of the lock
+        :type limit: int
+        :param limit: The maximum number of threads that can hold the lock at the same time
+        :type timeout: float
+        :param timeout: The maximum number of seconds to wait, 0 to not wait or None to wait forever
+        :type cancelled: :class:`threading.Event`
+        :param cancelled: An event that stops waiting when it is set with :meth:`cancel`
+
+        :rtype: bool
+        :returns: True if the lock was registered
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = LocalLockEntry(self.lock)
+
+            entry.waiters += 1
+            try:
+                while entry.holders >= limit:
+                    if cancelled is not None and cancelled.is_set():
+                        return False
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    entry.condition.wait(remaining)
+                entry.holders += 1
+                return True
+            finally:
+                entry.waiters -= 1
+                self.discard(key, entry)
+
+    def release(self, key):
+        """
+        Unregisters a holder of a lock and wakes up a thread waiting for it.
+        """
+        with self.lock:
+            entry = self.entries[key]
+            entry.holders -= 1
+            entry.condition.notify()
+            self.discard(key, entry)
+
+    def cancel(self, key, cancelled):
+        """
+        Sets the ``cancelled`` event of a thread waiting for a lock and wakes it up.
+        """
+        with self.lock:
+            cancelled.set()
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.condition.notify_all()
+
+    def discard(self, key, entry):
+        """
+        Forgets about a lock without holders and waiters.
+        """
+        if not entry.holders and not entry.waiters:
+            del self.entries[key]
+
+    def get_holders(self, key):
+        """
+        Returns the number of threads of the current process that hold a lock.
+
+        :rtype: int
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry.holders if entry is not None else 0
+
+
+# The registry of the locks held by the current process
+local_locks = LocalLocks()
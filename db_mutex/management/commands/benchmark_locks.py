@@ -0,0 +1,226 @@
+import math
+import multiprocessing
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+from django.test.utils import override_settings
+
+from db_mutex import signals
+from db_mutex.db_mutex import db_mutex
+from db_mutex.exceptions import DBMutexError
+
+
+LOCK_ID_PREFIX = 'db_mutex_benchmark:'
+
+
+def get_percentile(values, percent):
+    """
+    Returns a percentile of a list of values with the nearest rank method, or None if the list is empty.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * percent / 100) - 1, 0)]
+
+
+def get_hand_off_times(samples):
+    """
+    Returns the hand-off latencies of a benchmark run. A hand-off is the time from a holder starting to
+    release a lock until the next holder acquired it, counted only if the next holder was already waiting
+    for the lock.
+
+    :type samples: list
+    :param samples: The ``(lock_id, requested, acquired, released)`` wall clock times of every acquisition
+    """
+    hand_off_times = []
+    samples_by_lock_id = {}
+    for sample in samples:
+        samples_by_lock_id.setdefault(sample[0], []).append(sample)
+    for lock_samples in samples_by_lock_id.values():
+        lock_samples.sort(key=lambda sample: sample[2])
+        for previous, sample in zip(lock_samples, lock_samples[1:]):
+            if sample[1] < previous[3]:
+                hand_off_times.append(sample[2] - previous[3])
+    return hand_off_times
+
+
+def instrument(**kwargs):
+    """
+    A receiver of ``lock_acquired`` that makes locks count their queries while the benchmark runs.
+    """
+
+
+def run_thread(lock_id, options, results):
+    """
+    Acquires and releases a lock ``iterations`` times and appends the results to a list. Database errors
+    are counted instead of ending the thread, e.g. when SQLite reports a locked table.
+    """
+    samples, queries, failures, errors = [], 0, 0, 0
+    try:
+        for i in range(options['iterations']):
+            lock = db_mutex(
+                lock_id, wait=True, timeout=options['timeout'], poll_interval=options['poll_interval'],
+                using=options['database']
+            )
+            requested = time.time()
+            try:
+                lock.start()
+            except DBMutexError:
+                failures += 1
+                continue
+            except DatabaseError:
+                errors += 1
+                continue
+            acquired = time.time()
+            queries += lock.queries
+            if options['hold']:
+                time.sleep(options['hold'])
+            released = time.time()
+            try:
+                lock.stop()
+            except DatabaseError:
+                errors += 1
+                continue
+            samples.append((lock_id, requested, acquired, released))
+    finally:
+        connections.close_all()
+    results.append((samples, queries, failures, errors))
+
+
+def run_threads(lock_ids, options):
+    """
+    Runs a thread for every lock id and returns their results.
+
+    :rtype: list
+    """
+    results = []
+    threads = [threading.Thread(target=run_thread, args=(lock_id, options, results)) for lock_id in lock_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class Command(BaseCommand):
+    """
+    Measures the throughput and latency of locks on the configured database and lock backend. Workers
+    acquire and release locks in a loop, either all contending for a single lock or each using a lock of
+    its own, and the command reports acquisitions per second, acquire and hand-off latencies and the
+    number of queries per acquisition. Run it against every database that should be compared, e.g. with
+    ``DB_SETTINGS`` pointing to SQLite and then to PostgreSQL. The command fails after the report if any
+    database errors occurred, since the statistics then only cover part of the run.
+    """
+    help = 'Benchmarks acquiring and releasing db mutex locks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario', choices=['single', 'distinct', 'both'], default='both',
+            help='Whether workers contend for a single lock, use distinct locks, or both'
+        )
+        parser.add_argument('--threads', type=int, default=4, help='The number of worker threads per process')
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='The number of worker processes. More than one process requires the fork start method'
+        )
+        parser.add_argument(
+            '--iterations', type=int, default=100, help='The number of times every worker acquires its lock'
+        )
+        parser.add_argument('--hold', type=float, default=0, help='The number of seconds to hold the lock')
+        parser.add_argument(
+            '--timeout', type=float, default=30, help='The number of seconds to wait for a lock before failing'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=0.05, help='The initial number of seconds between attempts'
+        )
+        parser.add_argument('--database', help='The database of the locks. Defaults to DB_MUTEX_DATABASE')
+        parser.add_argument('--backend', help='The dotted path of the lock backend. Defaults to DB_MUTEX_BACKEND')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['processes'] < 1 or options['iterations'] < 1:
+            raise CommandError('--threads, --processes and --iterations must be positive')
+        if options['processes'] > 1:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise CommandError('Benchmarking with several processes requires the fork start method')
+            connection = connections[options['database'] or 'default']
+            if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+                raise CommandError('Processes cannot share an in-memory SQLite database')
+
+        scenarios = ['single', 'distinct'] if options['scenario'] == 'both' else [options['scenario']]
+        settings = {'DB_MUTEX_BACKEND': options['backend']} if options['backend'] else {}
+        errors = 0
+        signals.lock_acquired.connect(instrument)
+        try:
+            with override_settings(**settings):
+                for scenario in scenarios:
+                    errors += self.report(scenario, options, *self.run_scenario(scenario, options))
+        finally:
+            signals.lock_acquired.disconnect(instrument)
+        if errors:
+            raise CommandError('The results are incomplete because of {0} database errors'.format(errors))
+
+    def get_lock_ids(self, scenario, process, options):
+        """
+        Returns the lock ids of the worker threads of a process.
+        """
+        if scenario == 'single':
+            return [LOCK_ID_PREFIX + '0'] * options['threads']
+        first = process * options['threads']
+        return [LOCK_ID_PREFIX + str(worker) for worker in range(first, first + options['threads'])]
+
+    def run_scenario(self, scenario, options):
+        """
+        Runs the workers of a scenario.
+
+        :rtype: tuple
+        :returns: the results of every worker thread and the elapsed number of seconds
+        """
+        start_time = time.monotonic()
+        if options['processes'] == 1:
+            results = run_threads(self.get_lock_ids(scenario, 0, options), options)
+        else:
+            # Forked processes must not share the connections of the parent
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                results = sum(pool.starmap(run_threads, [
+                    (self.get_lock_ids(scenario, process, options), options)
+                    for process in range(options['processes'])
+                ]), [])
+        return results, time.monotonic() - start_time
+
+    def format_milliseconds(self, seconds):
+        return 'n/a' if seconds is None else '{0:.2f} ms'.format(seconds * 1000)
+
+    def report(self, scenario, options, results, elapsed):
+        """
+        Writes the statistics of a scenario.
+
+        :rtype: int
+        :returns: the number of database errors
+        """
+        samples = sum((result[0] for result in results), [])
+        queries = sum(result[1] for result in results)
+        failures = sum(result[2] for result in results)
+        errors = sum(result[3] for result in results)
+        acquire_times = [sample[2] - sample[1] for sample in samples]
+        hand_off_times = get_hand_off_times(samples)
+
+        self.stdout.write('{0} lock{1}, {2} processes x {3} threads x {4} iterations'.format(
+            'Single' if scenario == 'single' else 'Distinct',
+            '' if scenario == 'single' else 's', options['processes'], options['threads'], options['iterations']
+        ))
+        self.stdout.write('  Acquisitions/sec: {0:.1f}'.format(len(samples) / elapsed if elapsed else 0))
+        self.stdout.write('  Acquire latency: p50 {0}, p99 {1}'.format(
+            self.format_milliseconds(get_percentile(acquire_times, 50)),
+            self.format_milliseconds(get_percentile(acquire_times, 99)),
+        ))
+        self.stdout.write('  Hand-off latency: p50 {0}, p99 {1} ({2} hand-offs)'.format(
+            self.format_milliseconds(get_percentile(hand_off_times, 50)),
+            self.format_milliseconds(get_percentile(hand_off_times, 99)), len(hand_off_times)
+        ))
+        self.stdout.write('  Queries per acquire: {0:.2f}'.format(queries / len(samples) if samples else 0))
+        self.stdout.write('  Failed acquisitions: {0}'.format(failures))
+        self.stdout.write('  Database errors: {0}'.format(errors))
+        return errors
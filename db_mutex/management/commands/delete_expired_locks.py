@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from db_mutex.databases import get_lock_databases
+from db_mutex.models import DBMutex
+
+
+class Command(BaseCommand):
+    """
+    Deletes expired locks in batches. Acquiring a lock only cleans up the expired lock of its own lock
+    id, so this command should be run periodically (e.g. with cron or celery beat) to remove locks that
+    expired and were never acquired again.
+    """
+    help = 'Deletes expired db mutex locks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help='The number of locks to delete per query'
+        )
+        parser.add_argument(
+            '--database', help='The database to delete expired locks from. Defaults to all lock databases'
+        )
+
+    def handle(self, *args, **options):
+        databases = [options['database']] if options['database'] else get_lock_databases()
+        deleted = sum(
+            DBMutex.objects.using(database).delete_expired(batch_size=options['batch_size'])
+            for database in databases
+        )
+        self.stdout.write('Deleted {0} expired locks'.format(deleted))
@@ -0,0 +1,248 @@
+import csv
+import multiprocessing
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+from django.test.utils import override_settings
+
+from db_mutex.db_mutex import db_mutex
+from db_mutex.exceptions import DBMutexError, DBMutexTimeoutError
+
+
+LOCK_ID_PREFIX = 'db_mutex_stress:'
+
+# The fields of the records of every time a worker held a lock. The times are wall clock times, so records
+# of different processes can be compared. ``clean`` is False if the lock expired and was taken over
+# before the worker released it.
+RECORD_FIELDS = ['lock_id', 'token', 'requested', 'entered', 'exited', 'released', 'clean']
+
+# The number of seconds by which a holder may have acquired its lock before it recorded entering the
+# critical section
+CLOCK_TOLERANCE_SECONDS = 0.01
+
+
+def find_overlaps(records):
+    """
+    Returns the pairs of records whose holders were in the critical section of the same lock at the same
+    time although both of them released the lock cleanly. A holder that lost its lock to expiry is expected
+    to overlap with the holder that took the lock over.
+
+    :rtype: list
+    """
+    overlaps = []
+    records_by_lock_id = {}
+    for record in records:
+        if record['clean']:
+            records_by_lock_id.setdefault(record['lock_id'], []).append(record)
+    for lock_records in records_by_lock_id.values():
+        lock_records.sort(key=lambda record: record['entered'])
+        # Compares every holder with the holder that exited last of the ones that entered before it
+        latest = lock_records[0]
+        for record in lock_records[1:]:
+            if record['entered'] < latest['exited']:
+                overlaps.append((latest, record))
+            if record['exited'] > latest['exited']:
+                latest = record
+    return overlaps
+
+
+def find_early_expirations(records, ttl, tolerance=CLOCK_TOLERANCE_SECONDS):
+    """
+    Returns the holders that lost their lock although less than its TTL passed between entering the critical
+    section and the takeover, i.e. locks that were taken over before they expired. The lock was taken over
+    at the latest when the first other holder of the lock id entered while the holder had not released it
+    yet, or otherwise when the holder found that it lost the lock. The time spent waiting for the lock does
+    not count, since the lease only starts once the lock is acquired.
+
+    :type tolerance: float
+    :param tolerance: The number of seconds by which the lock may have been acquired before it was entered
+
+    :rtype: list
+    :returns: pairs of the record of a holder and the number of seconds after which it lost its lock
+    """
+    records_by_lock_id = {}
+    for record in records:
+        records_by_lock_id.setdefault(record['lock_id'], []).append(record)
+
+    early_expirations = []
+    for record in records:
+        if record['clean']:
+            continue
+        taken_over = min(
+            [record['released']] + [
+                other['entered'] for other in records_by_lock_id[record['lock_id']]
+                if record['entered'] < other['entered'] <= record['released']
+            ]
+        )
+        if taken_over - record['entered'] < ttl - tolerance:
+            early_expirations.append((record, taken_over - record['entered']))
+    return early_expirations
+
+
+def run_thread(lock_ids, options, records, failures, errors):
+    """
+    Acquires random locks of a set ``iterations`` times and records when the lock was held. Database errors
+    are collected instead of ending the thread, e.g. when SQLite reports a locked table.
+    """
+    rand = random.Random()
+    try:
+        for i in range(options['iterations']):
+            lock = db_mutex(
+                rand.choice(lock_ids), wait=True, timeout=options['timeout'], poll_interval=options['poll_interval'],
+                ttl=options['ttl'], using=options['database']
+            )
+            requested = time.time()
+            try:
+                lock.start()
+            except DBMutexError:
+                failures.append(lock.lock_id)
+                continue
+            except DatabaseError:
+                errors.append(lock.lock_id)
+                continue
+            entered = time.time()
+            # Some holders overrun their lease, so their lock expires and is taken over by a waiter
+            if rand.random() < options['overrun']:
+                time.sleep(options['ttl'] * 1.5)
+            else:
+                time.sleep(rand.uniform(0, options['hold']))
+            exited = time.time()
+            try:
+                lock.stop()
+                clean = True
+            except DBMutexTimeoutError:
+                clean = False
+            except DatabaseError:
+                # Whether the lock was released is unknown, so the holder is left out of the checks
+                errors.append(lock.lock_id)
+                continue
+            records.append(dict(zip(RECORD_FIELDS, [
+                lock.lock_id, lock.token, requested, entered, exited, time.time(), clean
+            ])))
+    finally:
+        connections.close_all()
+
+
+def run_threads(lock_ids, options):
+    """
+    Runs the worker threads of a process.
+
+    :rtype: tuple
+    :returns: the records of every held lock, and the lock ids of failed acquisitions and of database errors
+    """
+    records, failures, errors = [], [], []
+    threads = [
+        threading.Thread(target=run_thread, args=(lock_ids, options, records, failures, errors))
+        for i in range(options['threads'])
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, failures, errors
+
+
+class Command(BaseCommand):
+    """
+    Checks mutual exclusion under real concurrency. Worker processes and threads acquire random locks of a
+    shared set, hold them for a random time and log when they entered and exited the critical section
+    with their owner token. A fraction of the holders overrun the TTL of their lock, so expired locks are
+    taken over while their holder is still running. Afterwards, the command checks that no two holders
+    that released their lock cleanly overlapped, and that no lock was taken over before it expired. The
+    command fails if either check finds a violation, or if any database errors occurred, since the checks
+    then do not cover every holder.
+    """
+    help = 'Checks that db mutex locks are mutually exclusive under concurrency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--locks', type=int, default=4, help='The number of shared lock ids')
+        parser.add_argument(
+            '--processes', type=int, default=4,
+            help='The number of worker processes. More than one process requires the fork start method'
+        )
+        parser.add_argument('--threads', type=int, default=2, help='The number of worker threads per process')
+        parser.add_argument(
+            '--iterations', type=int, default=50, help='The number of locks every worker acquires'
+        )
+        parser.add_argument(
+            '--hold', type=float, default=0.01, help='The maximum number of seconds to hold a lock'
+        )
+        parser.add_argument('--ttl', type=float, default=1, help='The number of seconds until locks expire')
+        parser.add_argument(
+            '--overrun', type=float, default=0.05,
+            help='The fraction of holders that hold their lock for longer than its TTL'
+        )
+        parser.add_argument(
+            '--timeout', type=float, default=60, help='The number of seconds to wait for a lock before failing'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=0.01, help='The initial number of seconds between attempts'
+        )
+        parser.add_argument('--database', help='The database of the locks. Defaults to DB_MUTEX_DATABASE')
+        parser.add_argument('--backend', help='The dotted path of the lock backend. Defaults to DB_MUTEX_BACKEND')
+        parser.add_argument('--log', help='The path of a CSV file to write the records of every held lock to')
+
+    def handle(self, *args, **options):
+        if min(options['locks'], options['threads'], options['processes'], options['iterations']) < 1:
+            raise CommandError('--locks, --threads, --processes and --iterations must be positive')
+        if options['processes'] > 1:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise CommandError('Stress testing with several processes requires the fork start method')
+            connection = connections[options['database'] or 'default']
+            if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+                raise CommandError('Processes cannot share an in-memory SQLite database')
+
+        settings = {'DB_MUTEX_BACKEND': options['backend']} if options['backend'] else {}
+        with override_settings(**settings):
+            records, failures, errors = self.run_workers(options)
+        if options['log']:
+            self.write_log(options['log'], records)
+
+        overlaps = find_overlaps(records)
+        early_expirations = find_early_expirations(records, options['ttl'])
+        self.stdout.write('Held {0} locks of {1} lock ids in {2} processes x {3} threads'.format(
+            len(records), options['locks'], options['processes'], options['threads']
+        ))
+        self.stdout.write('  Expired and taken over: {0}'.format(sum(not record['clean'] for record in records)))
+        self.stdout.write('  Failed acquisitions: {0}'.format(len(failures)))
+        self.stdout.write('  Database errors: {0}'.format(len(errors)))
+        self.stdout.write('  Overlapping holders: {0}'.format(len(overlaps)))
+        self.stdout.write('  Taken over before expiring: {0}'.format(len(early_expirations)))
+        for previous, record in overlaps:
+            self.stdout.write('  Holder {0} entered {1} at {2:.6f} before holder {3} exited at {4:.6f}'.format(
+                record['token'], record['lock_id'], record['entered'], previous['token'], previous['exited']
+            ))
+        for record, lost_after in early_expirations:
+            self.stdout.write('  Holder {0} lost {1} after {2:.6f} seconds'.format(
+                record['token'], record['lock_id'], lost_after
+            ))
+        if overlaps or early_expirations:
+            raise CommandError('Mutual exclusion was violated')
+        if errors:
+            raise CommandError('The checks are incomplete because of {0} database errors'.format(len(errors)))
+
+    def run_workers(self, options):
+        """
+        Runs the worker threads of every process.
+
+        :rtype: tuple
+        :returns: the records of every held lock, and the lock ids of failed acquisitions and of database errors
+        """
+        lock_ids = [LOCK_ID_PREFIX + str(i) for i in range(options['locks'])]
+        if options['processes'] == 1:
+            return run_threads(lock_ids, options)
+
+        # Forked processes must not share the connections of the parent
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+            results = pool.starmap(run_threads, [(lock_ids, options)] * options['processes'])
+        return tuple(sum((result[i] for result in results), []) for i in range(3))
+
+    def write_log(self, path, records):
+        with open(path, 'w', newline='') as log_file:
+            writer = csv.DictWriter(log_file, RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(sorted(records, key=lambda record: record['entered']))
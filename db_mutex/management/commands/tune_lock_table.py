@@ -0,0 +1,90 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from db_mutex import postgres
+from db_mutex.databases import get_lock_databases
+from db_mutex.models import DBMutex
+
+
+class Command(BaseCommand):
+    """
+    Tunes the storage of the lock table on PostgreSQL for high churn. By default, the table is made
+    UNLOGGED so that acquiring and releasing locks is neither written to the WAL nor replicated, and its
+    fillfactor and autovacuum thresholds are lowered so that dead lock rows are cleaned up quickly. Pass
+    ``--reset`` to make the table logged again with the default storage parameters.
+
+    Unlogged tables are emptied when PostgreSQL recovers from a crash and are not available on replicas,
+    so locks that are held when the database crashes or fails over are lost. See the docs before using
+    this.
+    """
+    help = 'Makes the db mutex lock table UNLOGGED and tunes it for high churn on PostgreSQL'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true', help='Make the table logged again with the default storage parameters'
+        )
+        parser.add_argument(
+            '--logged', action='store_true', help='Only tune the storage parameters and keep the table logged'
+        )
+        parser.add_argument(
+            '--fillfactor', type=int, default=70, help='The percentage of every table page that inserts fill'
+        )
+        parser.add_argument(
+            '--autovacuum-threshold', type=int, default=1000,
+            help='The number of dead or changed rows after which autovacuum vacuums and analyzes the table'
+        )
+        parser.add_argument(
+            '--database', help='The database of the lock table. Defaults to all PostgreSQL lock databases'
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only print the statements')
+
+    def handle(self, *args, **options):
+        if options['database']:
+            if connections[options['database']].vendor != 'postgresql':
+                raise CommandError('Tuning the lock table requires PostgreSQL')
+            databases = [options['database']]
+        else:
+            databases = [
+                database for database in get_lock_databases() if connections[database].vendor == 'postgresql'
+            ]
+            if not databases:
+                raise CommandError('Tuning the lock table requires PostgreSQL')
+
+        for database in databases:
+            connection = connections[database]
+            table = DBMutex._meta.db_table
+            statements = postgres.get_alter_table_storage_sql(
+                connection, table, not options['reset'] and not options['logged'], self.get_parameters(options)
+            )
+            if options['dry_run']:
+                for statement in statements:
+                    self.stdout.write('{0};'.format(statement))
+                continue
+
+            with connection.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+            unlogged, parameters = postgres.get_table_storage(connection, table)
+            self.stdout.write('Lock table {0} on {1} is {2}{3}'.format(
+                table, database, 'unlogged' if unlogged else 'logged', ''.join(
+                    ', {0}={1}'.format(name, value) for name, value in sorted(parameters.items())
+                )
+            ))
+
+    def get_parameters(self, options):
+        """
+        Returns the storage parameters of the lock table. The lock table is small but most of its rows
+        are deleted within seconds, so autovacuum runs after a fixed number of dead rows instead of a
+        fraction of the table and is not throttled.
+        """
+        parameters = {
+            'fillfactor': options['fillfactor'],
+            'autovacuum_vacuum_scale_factor': 0,
+            'autovacuum_vacuum_threshold': options['autovacuum_threshold'],
+            'autovacuum_analyze_scale_factor': 0,
+            'autovacuum_analyze_threshold': options['autovacuum_threshold'],
+            'autovacuum_vacuum_cost_delay': 0,
+        }
+        if options['reset']:
+            return dict.fromkeys(parameters)
+        return parameters
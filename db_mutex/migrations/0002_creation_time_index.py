@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db_mutex', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dbmutex',
+            name='creation_time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
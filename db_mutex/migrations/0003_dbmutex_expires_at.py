@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, migrations
+from django.db.models import DateTimeField, ExpressionWrapper, F
+
+
+def set_expires_at(apps, schema_editor):
+    """
+    Sets the expiration time of existing locks from the globally configured ttl.
+    """
+    ttl_seconds = getattr(settings, 'DB_MUTEX_TTL_SECONDS', timedelta(minutes=30).total_seconds())
+    if ttl_seconds is not None:
+        DBMutex = apps.get_model('db_mutex', 'DBMutex')
+        DBMutex.objects.using(schema_editor.connection.alias).update(expires_at=ExpressionWrapper(
+            F('creation_time') + timedelta(seconds=ttl_seconds), output_field=DateTimeField()
+        ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db_mutex', '0002_creation_time_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dbmutex',
+            name='expires_at',
+            field=models.DateTimeField(null=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='dbmutex',
+            name='creation_time',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+        migrations.RunPython(set_expires_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db_mutex', '0003_dbmutex_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dbmutex',
+            name='token',
+            field=models.CharField(max_length=32, default=''),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Makes ``lock_id`` the primary key of the lock table instead of a surrogate ``id``, so acquiring a lock
+    only maintains a single unique index and no sequence.
+    """
+
+    dependencies = [
+        ('db_mutex', '0004_dbmutex_token'),
+    ]
+
+    operations = [
+        # The surrogate id is removed first, since a table cannot have two primary keys
+        migrations.RemoveField(
+            model_name='dbmutex',
+            name='id',
+        ),
+        migrations.AlterField(
+            model_name='dbmutex',
+            name='lock_id',
+            field=models.CharField(max_length=256, primary_key=True, serialize=False),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('db_mutex', '0005_lock_id_primary_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dbmutex',
+            name='hostname',
+            field=models.CharField(max_length=255, default=''),
+        ),
+        migrations.AddField(
+            model_name='dbmutex',
+            name='pid',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='dbmutex',
+            name='process_start',
+            field=models.CharField(max_length=128, default=''),
+        ),
+        migrations.AddField(
+            model_name='dbmutex',
+            name='thread',
+            field=models.CharField(max_length=255, default=''),
+        ),
+    ]
@@ -1,18 +1,471 @@
-from django.db import models
+from datetime import timedelta
+import contextvars
+
+from django.db import models, IntegrityError
+from django.db.models import DateTimeField, ExpressionWrapper
+from django.db.models.functions import Now
+from django.db.models.sql import Query
+from django.utils import timezone
+
+from .databases import get_lock_connection
+from .holders import get_holder, is_dead
+
+
+# The fields of the lock table that record the holder of a lock
+HOLDER_FIELDS = ('hostname', 'pid', 'process_start', 'thread')
+
+# Counts the expired locks that successful acquisitions of the current thread or task took over
+reclaimed_locks = contextvars.ContextVar('db_mutex_reclaimed_locks', default=0)
+
+
+def get_expiration_time(ttl_seconds):
+    """
+    Returns an expression for the time a lock acquired now expires. The time is computed by the
+    database so that the clocks of the hosts acquiring locks do not need to be in sync.
+
+    :type ttl_seconds: float
+    :param ttl_seconds: The number of seconds until the lock expires or None if it never expires
+    """
+    if ttl_seconds is None:
+        return None
+    return ExpressionWrapper(Now() + timedelta(seconds=ttl_seconds), output_field=DateTimeField())
+
+
+def supports_upsert(connection):
+    """
+    Returns whether locks can be acquired with ``INSERT ... ON CONFLICT ... RETURNING`` on a connection.
+    This is the case for PostgreSQL and SQLite 3.35 or newer.
+
+    :rtype: bool
+    """
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert
+
+
+class DBMutexQuerySet(models.QuerySet):
+    """
+    Provides queries for acquiring, releasing and cleaning up locks. The queries for acquiring, extending and
+    releasing locks run on the lock connection of the database (see
+    :func:`get_lock_connection <db_mutex.databases.get_lock_connection>`).
+    """
+    def get_lock_connection(self, connection=None):
+        return connection or get_lock_connection(self.db)
+
+    def compile(self, expression, connection):
+        """
+        Compiles an expression into SQL and parameters that can be used in raw queries on the lock table.
+        """
+        query = Query(self.model)
+        return query.get_compiler(connection=connection).compile(expression.resolve_expression(query))
+
+    def format_sql(self, sql, connection, **kwargs):
+        """
+        Formats a raw query on the lock table by filling in the quoted names of the table and its columns.
+        """
+        quote_name = connection.ops.quote_name
+        return sql.format(
+            table=quote_name(self.model._meta.db_table),
+            **{field.name: quote_name(field.column) for field in self.model._meta.concrete_fields},
+            **kwargs
+        )
+
+    def get_insert_sql(self, connection, lock_ids, token, ttl_seconds):
+        """
+        Returns the SQL and parameters for inserting locks with a single statement. The locks expire
+        ``ttl_seconds`` from now according to the database clock.
+        """
+        expires_at_sql, expires_at_params = '%s', [None]
+        if ttl_seconds is not None:
+            expires_at_sql, expires_at_params = self.compile(get_expiration_time(ttl_seconds), connection)
+        creation_time = self.model._meta.get_field('creation_time').get_db_prep_value(timezone.now(), connection)
+        holder = get_holder()
+
+        fields = [self.model._meta.get_field(name) for name in ('lock_id', 'creation_time', 'expires_at', 'token')]
+        fields += [self.model._meta.get_field(name) for name in HOLDER_FIELDS]
+        placeholder_rows = [['%s', '%s', expires_at_sql, '%s'] + ['%s'] * len(HOLDER_FIELDS) for lock_id in lock_ids]
+        sql = self.format_sql(
+            'INSERT INTO {table} ({lock_id}, {creation_time}, {expires_at}, {token}, {holder_sql}) ', connection,
+            holder_sql=self.get_holder_columns_sql(connection)
+        ) + connection.ops.bulk_insert_sql(fields, placeholder_rows)
+
+        params = []
+        for lock_id in lock_ids:
+            params.extend(
+                [lock_id, creation_time] + list(expires_at_params) + [token] + [holder[name] for name in HOLDER_FIELDS]
+            )
+        return sql, params
+
+    def get_holder_columns_sql(self, connection):
+        """
+        Returns the quoted columns of the metadata of the holder of a lock, separated by commas.
+        """
+        return ', '.join(
+            connection.ops.quote_name(self.model._meta.get_field(name).column) for name in HOLDER_FIELDS
+        )
+
+    def get_reclaim_sql(self, connection, now_sql):
+        """
+        Returns the ``ON CONFLICT`` clause that takes over expired locks with the values of the inserted row.
+        On PostgreSQL, the returned rows also tell whether they took over an expired lock, since the
+        ``xmax`` of updated rows is set while the ``xmax`` of inserted rows is 0.
+        """
+        return self.format_sql(
+            ' ON CONFLICT ({lock_id}) DO UPDATE SET {assignments} '
+            'WHERE {table}.{expires_at} <= {now_sql} '
+            'RETURNING {lock_id}{reclaimed_sql}',
+            connection, now_sql=now_sql, reclaimed_sql=', xmax <> 0' if connection.vendor == 'postgresql' else '',
+            assignments=', '.join(
+                '{0} = EXCLUDED.{0}'.format(connection.ops.quote_name(self.model._meta.get_field(name).column))
+                for name in ('creation_time', 'expires_at', 'token') + HOLDER_FIELDS
+            )
+        )
+
+    def count_reclaimed(self, rows):
+        """
+        Returns the number of rows returned by the ``ON CONFLICT`` clause that took over expired locks. Only
+        PostgreSQL tells whether a row was inserted or updated.
+
+        :rtype: int
+        """
+        return sum(1 for row in rows if len(row) > 1 and row[1])
+
+    def get_in_sql(self, lock_ids):
+        """
+        Returns the placeholders for matching a list of lock ids with ``IN``.
+        """
+        return '({0})'.format(', '.join(['%s'] * len(lock_ids)))
+
+    def acquire(self, lock_id, token, ttl_seconds, connection=None):
+        """
+        Creates a lock that is held with the given owner token, replacing the lock of the same lock id if
+        it expired.
+
+        :type ttl_seconds: float
+        :param ttl_seconds: The number of seconds until the lock expires or None if it never expires
+        :param connection: The connection to run the queries on instead of the lock connection
+
+        :rtype: bool
+        :returns: True if the lock was acquired
+        """
+        return self.acquire_many([lock_id], token, ttl_seconds, connection)
+
+    def acquire_many(self, lock_ids, token, ttl_seconds, connection=None):
+        """
+        Creates several locks at once that are all held with the given owner token, replacing expired locks.
+        Either all of the locks are acquired or none of them are. Contention is detected without raising an
+        IntegrityError where the database supports ``INSERT ... ON CONFLICT``. The locks that could be taken
+        are then deleted again if some of the others are held. Otherwise the expired locks are deleted and the
+        locks are created in a savepoint. The number of expired locks taken over is added to
+        ``reclaimed_locks``.
+
+        :type lock_ids: list
+        :param lock_ids: The distinct IDs of the locks
+        :type ttl_seconds: float
+        :param ttl_seconds: The number of seconds until the locks expire or None if they never expire
+        :param connection: The connection to run the queries on instead of the lock connection
+
+        :rtype: bool
+        :returns: True if all of the locks were acquired
+        """
+        connection = self.get_lock_connection(connection)
+        if supports_upsert(connection):
+            acquired, reclaimed = self.insert_or_reclaim(lock_ids, token, ttl_seconds, connection)
+            if 0 < acquired < len(lock_ids):
+                self.release_many(lock_ids, token, connection)
+            if acquired < len(lock_ids):
+                return False
+            reclaimed_locks.set(reclaimed_locks.get() + reclaimed)
+            return True
+
+        now_sql, now_params = self.compile(Now(), connection)
+        insert_sql, insert_params = self.get_insert_sql(connection, lock_ids, token, ttl_seconds)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.format_sql('DELETE FROM {table} WHERE {lock_id} IN {in_sql} AND {expires_at} <= {now_sql}',
+                                connection, in_sql=self.get_in_sql(lock_ids), now_sql=now_sql),
+                list(lock_ids) + list(now_params)
+            )
+            reclaimed = cursor.rowcount
+            savepoint_id = connection.savepoint()
+            try:
+                cursor.execute(insert_sql, insert_params)
+            except IntegrityError:
+                if savepoint_id:
+                    connection.savepoint_rollback(savepoint_id)
+                return False
+            if savepoint_id:
+                connection.savepoint_commit(savepoint_id)
+        reclaimed_locks.set(reclaimed_locks.get() + reclaimed)
+        return True
+
+    def insert_or_reclaim(self, lock_ids, token, ttl_seconds, connection=None):
+        """
+        Acquires locks with a single ``INSERT ... ON CONFLICT (lock_id) DO UPDATE ... WHERE expired``
+        statement. Free locks are inserted, expired locks are taken over and held locks are left alone,
+        in which case no row is returned for them.
+
+        :rtype: tuple
+        :returns: the number of acquired locks and the number of expired locks among them
+        """
+        connection = self.get_lock_connection(connection)
+        insert_sql, insert_params = self.get_insert_sql(connection, lock_ids, token, ttl_seconds)
+        now_sql, now_params = self.compile(Now(), connection)
+
+        with connection.cursor() as cursor:
+            cursor.execute(insert_sql + self.get_reclaim_sql(connection, now_sql), insert_params + list(now_params))
+            rows = cursor.fetchall()
+            return len(rows), self.count_reclaimed(rows)
+
+    def acquire_slot(self, slot_ids, token, ttl_seconds):
+        """
+        Claims one of several slot locks with a single ``INSERT ... SELECT`` statement that picks the first
+        slot without a live lock, in the order of ``slot_ids``. Where the database supports ``INSERT ... ON
+        CONFLICT``, an expired slot is taken over in the same statement. Otherwise expired slots are deleted
+        first and the slot is claimed in a savepoint. Two claimants that pick the same free slot at the same
+        time cannot both get it, so one of them fails this attempt.
+
+        :type slot_ids: list
+        :param slot_ids: The lock ids of the slots
+        :type ttl_seconds: float
+        :param ttl_seconds: The number of seconds until the slot expires or None if it never expires
+
+        :rtype: bool
+        :returns: True if a slot was claimed
+        """
+        connection = self.get_lock_connection()
+        upsert = supports_upsert(connection)
+        expires_at_sql, expires_at_params = '%s', [None]
+        if ttl_seconds is not None:
+            expires_at_sql, expires_at_params = self.compile(get_expiration_time(ttl_seconds), connection)
+        creation_time = self.model._meta.get_field('creation_time').get_db_prep_value(timezone.now(), connection)
+        now_sql, now_params = self.compile(Now(), connection)
+        holder = get_holder()
+
+        sql = self.format_sql(
+            'INSERT INTO {table} ({lock_id}, {creation_time}, {expires_at}, {token}, {holder_sql}) '
+            'SELECT slots.{lock_id}, %s, {expires_at_sql}, %s, {holder_placeholders} FROM ({slots_sql}) slots '
+            'WHERE NOT EXISTS (SELECT 1 FROM {table} held WHERE held.{lock_id} = slots.{lock_id} '
+            'AND (held.{expires_at} IS NULL OR held.{expires_at} > {now_sql})) {limit_sql}',
+            connection,
+            expires_at_sql=expires_at_sql,
+            holder_sql=self.get_holder_columns_sql(connection),
+            holder_placeholders=', '.join(['%s'] * len(HOLDER_FIELDS)),
+            slots_sql=' UNION ALL '.join(
+                [self.format_sql('SELECT %s AS {lock_id}', connection)] * len(slot_ids)
+            ),
+            now_sql=now_sql,
+            limit_sql=connection.ops.limit_offset_sql(0, 1),
+        )
+        params = [creation_time] + list(expires_at_params) + [token] + [holder[name] for name in HOLDER_FIELDS]
+        params += list(slot_ids) + list(now_params)
+
+        with connection.cursor() as cursor:
+            if upsert:
+                cursor.execute(sql + self.get_reclaim_sql(connection, now_sql), params + list(now_params))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                reclaimed_locks.set(reclaimed_locks.get() + self.count_reclaimed([row]))
+                return True
+
+            cursor.execute(
+                self.format_sql('DELETE FROM {table} WHERE {lock_id} IN {in_sql} AND {expires_at} <= {now_sql}',
+                                connection, in_sql=self.get_in_sql(slot_ids), now_sql=now_sql),
+                list(slot_ids) + list(now_params)
+            )
+            reclaimed = cursor.rowcount
+            savepoint_id = connection.savepoint()
+            try:
+                cursor.execute(sql, params)
+            except IntegrityError:
+                if savepoint_id:
+                    connection.savepoint_rollback(savepoint_id)
+                return False
+            if savepoint_id:
+                connection.savepoint_commit(savepoint_id)
+            if cursor.rowcount != 1:
+                return False
+            reclaimed_locks.set(reclaimed_locks.get() + reclaimed)
+            return True
+
+    def extend(self, lock_id, token, ttl_seconds):
+        """
+        Renews the lease of a lock that is held with the given owner token so that it expires
+        ``ttl_seconds`` from now.
+
+        :rtype: bool
+        :returns: True if the lock is still held
+        """
+        return self.extend_many([lock_id], token, ttl_seconds) == 1
+
+    def extend_many(self, lock_ids, token, ttl_seconds):
+        """
+        Renews the leases of the locks that are held with the given owner token with a single UPDATE.
+
+        :rtype: int
+        :returns: the number of locks that are still held
+        """
+        connection = self.get_lock_connection()
+        expires_at_sql, expires_at_params = '%s', [None]
+        if ttl_seconds is not None:
+            expires_at_sql, expires_at_params = self.compile(get_expiration_time(ttl_seconds), connection)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.format_sql('UPDATE {table} SET {expires_at} = {expires_at_sql} '
+                                'WHERE {lock_id} IN {in_sql} AND {token} = %s', connection,
+                                expires_at_sql=expires_at_sql, in_sql=self.get_in_sql(lock_ids)),
+                list(expires_at_params) + list(lock_ids) + [token]
+            )
+            return cursor.rowcount
+
+    def release(self, lock_id, token):
+        """
+        Deletes a lock if it is still held with the given owner token. This is a single DELETE statement, so
+        that a holder whose lock expired and was acquired by someone else cannot delete the new lock.
+
+        :rtype: bool
+        :returns: True if the lock was released
+        """
+        return self.release_many([lock_id], token) == 1
+
+    def release_many(self, lock_ids, token, connection=None):
+        """
+        Deletes the locks that are still held with the given owner token with a single DELETE statement.
+
+        :rtype: int
+        :returns: the number of released locks
+        """
+        connection = self.get_lock_connection(connection)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.format_sql('DELETE FROM {table} WHERE {lock_id} IN {in_sql} AND {token} = %s', connection,
+                                in_sql=self.get_in_sql(lock_ids)),
+                list(lock_ids) + [token]
+            )
+            return cursor.rowcount
+
+    def delete_dead(self, lock_ids, connection=None):
+        """
+        Deletes the locks among ``lock_ids`` whose holders ran on this host and provably died, see
+        :func:`is_dead <db_mutex.holders.is_dead>`. Only the locks of this host are fetched, and every lock
+        is deleted together with its owner token, so a lock that was acquired again in the meantime is left
+        alone.
+
+        :rtype: int
+        :returns: the number of deleted locks
+        """
+        connection = self.get_lock_connection(connection)
+        hostname = get_holder()['hostname']
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.format_sql('SELECT {lock_id}, {token}, {pid}, {process_start} FROM {table} '
+                                'WHERE {lock_id} IN {in_sql} AND {hostname} = %s', connection,
+                                in_sql=self.get_in_sql(lock_ids)),
+                list(lock_ids) + [hostname]
+            )
+            dead_locks = [
+                (lock_id, token) for lock_id, token, pid, process_start in cursor.fetchall()
+                if is_dead(hostname, pid, process_start)
+            ]
+            deleted = 0
+            for lock_id, token in dead_locks:
+                cursor.execute(
+                    self.format_sql('DELETE FROM {table} WHERE {lock_id} = %s AND {token} = %s', connection),
+                    [lock_id, token]
+                )
+                deleted += cursor.rowcount
+            return deleted
+
+    def is_held(self, lock_id, prefix=False):
+        """
+        Returns whether a lock is held and has not expired according to the database clock.
+
+        :type prefix: bool
+        :param prefix: Check for any held lock whose lock id starts with ``lock_id`` instead
+
+        :rtype: bool
+        """
+        connection = self.get_lock_connection()
+        now_sql, now_params = self.compile(Now(), connection)
+        lookup_sql = '= %s'
+        if prefix:
+            lookup_sql = connection.operators['startswith']
+            lock_id = connection.ops.prep_for_like_query(lock_id) + '%'
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self.format_sql('SELECT 1 FROM {table} WHERE {lock_id} {lookup_sql} '
+                                'AND ({expires_at} IS NULL OR {expires_at} > {now_sql}) {limit_sql}',
+                                connection, lookup_sql=lookup_sql, now_sql=now_sql,
+                                limit_sql=connection.ops.limit_offset_sql(0, 1)),
+                [lock_id] + list(now_params)
+            )
+            return cursor.fetchone() is not None
+
+    def expired(self):
+        """
+        Returns the locks whose lease ended according to the database clock.
+        """
+        return self.filter(expires_at__lte=Now())
+
+    def delete_expired(self, batch_size=1000):
+        """
+        Deletes expired locks in batches of ``batch_size``, walking the index on ``expires_at`` so that
+        only the expired rows are scanned and locked.
+
+        :rtype: int
+        :returns: the number of deleted locks
+        """
+        deleted = 0
+        while True:
+            expired_lock_ids = list(
+                self.expired().order_by('expires_at').values_list('lock_id', flat=True)[:batch_size]
+            )
+            if not expired_lock_ids:
+                return deleted
+            # Locks that were taken over since they were selected keep their lock id, so the DELETE checks
+            # the expiration again
+            deleted += self.expired().filter(lock_id__in=expired_lock_ids).delete()[0]
 
 
 class DBMutex(models.Model):
     """
-    Models a mutex lock with a ``lock_id`` and a ``creation_time``.
+    Models a mutex lock with a ``lock_id``, a ``creation_time`` and an ``expires_at`` time.
 
     :type lock_id: str
-    :param lock_id: A unique CharField with a max length of 256
+    :param lock_id: The primary key, a CharField with a max length of 256
 
     :type creation_time: datetime
     :param creation_time: The creation time of the mutex lock
+
+    :type expires_at: datetime
+    :param expires_at: The database time at which the lock expires or None if it never expires
+
+    :type token: str
+    :param token: A random token identifying the acquisition of the lock
+
+    :type hostname: str
+    :param hostname: The hostname of the holder of the lock
+
+    :type pid: int
+    :param pid: The process id of the holder of the lock
+
+    :type process_start: str
+    :param process_start: A marker of when the process of the holder started, see :mod:`db_mutex.holders`
+
+    :type thread: str
+    :param thread: The name of the thread of the holder of the lock
     """
-    lock_id = models.CharField(max_length=256, unique=True)
+    lock_id = models.CharField(max_length=256, primary_key=True)
     creation_time = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(null=True, db_index=True)
+    token = models.CharField(max_length=32, default='')
+    hostname = models.CharField(max_length=255, default='')
+    pid = models.IntegerField(null=True)
+    process_start = models.CharField(max_length=128, default='')
+    thread = models.CharField(max_length=255, default='')
+
+    objects = DBMutexQuerySet.as_manager()
 
     class Meta:
         app_label = 'db_mutex'
@@ -0,0 +1,198 @@
+"""
+Helpers for PostgreSQL specific features used by db_mutex.
+"""
+import contextlib
+import hashlib
+import select
+import time
+
+
+# The prefix of the LISTEN/NOTIFY channels of locks
+NOTIFY_CHANNEL_PREFIX = 'db_mutex_'
+
+# The SQLSTATE of the error raised when a statement waited for a lock for longer than lock_timeout
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def get_notify_channel(lock_id):
+    """
+    Returns the LISTEN/NOTIFY channel on which releases of a lock are announced. The lock id is
+    hashed since channel names are limited to 63 characters.
+
+    :type lock_id: str
+    :param lock_id: The ID of the lock
+
+    :rtype: str
+    :returns: the channel name
+    """
+    return '{0}{1}'.format(NOTIFY_CHANNEL_PREFIX, hashlib.sha256(lock_id.encode('utf-8')).hexdigest()[:32])
+
+
+def get_advisory_lock_key(lock_id):
+    """
+    Hashes a lock id into the signed 64 bit key space of advisory locks.
+
+    :type lock_id: str
+    :param lock_id: The ID of the lock
+
+    :rtype: int
+    :returns: the advisory lock key for the lock id
+    """
+    digest = hashlib.sha256(lock_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], byteorder='big', signed=True)
+
+
+@contextlib.contextmanager
+def lock_timeout(connection, seconds):
+    """
+    Bounds how long the statements in the block wait for locks held by other transactions with
+    ``SET LOCAL lock_timeout``. This has to be used in a savepoint, since the previous lock timeout is
+    only restored when the block succeeds and otherwise by rolling back to the savepoint.
+
+    :type seconds: float
+    :param seconds: The maximum number of seconds to wait. A lock timeout of 0 disables it in
+        PostgreSQL, so waits are bounded by at least a millisecond.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT current_setting('lock_timeout'), set_config('lock_timeout', %s, true)",
+            ['{0}ms'.format(max(int(seconds * 1000), 1))]
+        )
+        previous = cursor.fetchone()[0]
+        yield
+        cursor.execute("SELECT set_config('lock_timeout', %s, true)", [previous])
+
+
+def is_lock_timeout(error):
+    """
+    Returns whether a database error was raised because a statement waited for longer than lock_timeout.
+    Supports both psycopg2 and psycopg 3.
+
+    :rtype: bool
+    """
+    cause = error.__cause__
+    return LOCK_NOT_AVAILABLE in (getattr(cause, 'pgcode', None), getattr(cause, 'sqlstate', None))
+
+
+def listen(connection, channel):
+    """
+    Starts listening for notifications on a channel. Note that the connection only starts
+    receiving notifications once the current transaction, if any, is committed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('LISTEN {0}'.format(connection.ops.quote_name(channel)))
+
+
+def unlisten(connection, channel):
+    """
+    Stops listening for notifications on a channel.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('UNLISTEN {0}'.format(connection.ops.quote_name(channel)))
+
+
+def notify(connection, channel):
+    """
+    Sends a notification on a channel.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [channel, ''])
+
+
+def wait_for_notify(connection, channel, timeout):
+    """
+    Blocks until a notification is received on a channel the connection is listening on or until
+    the timeout elapses. Supports both psycopg2 and psycopg 3.2+. Older versions of psycopg 3 cannot
+    wait for notifications with a timeout, so this simply sleeps for the timeout with them.
+
+    With psycopg2, only the notifications of lock channels are consumed, so that notifications on other
+    channels the connection listens on are left to the application.
+
+    :type timeout: float
+    :param timeout: The maximum number of seconds to wait
+
+    :rtype: bool
+    :returns: True if a notification was received on the channel
+    """
+    raw_connection = connection.connection
+
+    if hasattr(raw_connection, 'poll'):
+        # psycopg2 collects notifications on the connection when polling it
+        deadline = time.monotonic() + timeout
+        raw_connection.poll()
+        while channel not in pop_lock_notifies(raw_connection):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            select.select([raw_connection], [], [], remaining)
+            raw_connection.poll()
+        return True
+
+    try:
+        notifications = raw_connection.notifies(timeout=timeout, stop_after=1)
+    except TypeError:  # pragma: no cover
+        time.sleep(timeout)
+        return False
+    return any(notification.channel == channel for notification in notifications)
+
+
+def pop_lock_notifies(raw_connection):
+    """
+    Removes the notifications of lock channels that a psycopg2 connection collected and leaves the others.
+
+    :rtype: set
+    :returns: the channels of the removed notifications
+    """
+    channels = set()
+    other_notifies = []
+    for notification in raw_connection.notifies:
+        if notification.channel.startswith(NOTIFY_CHANNEL_PREFIX):
+            channels.add(notification.channel)
+        else:
+            other_notifies.append(notification)
+    raw_connection.notifies[:] = other_notifies
+    return channels
+
+
+def get_table_storage(connection, table):
+    """
+    Returns how a table is stored.
+
+    :type table: str
+    :param table: The name of the table
+
+    :rtype: tuple
+    :returns: True if the table is unlogged, and a dict of the storage parameters of the table
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT relpersistence, reloptions FROM pg_class WHERE oid = %s::regclass',
+            [connection.ops.quote_name(table)]
+        )
+        persistence, options = cursor.fetchone()
+    return persistence == 'u', dict(option.split('=', 1) for option in options or [])
+
+
+def get_alter_table_storage_sql(connection, table, unlogged, parameters):
+    """
+    Returns the statements that change how a table is stored. Switching between logged and unlogged
+    rewrites the table and locks it exclusively while doing so.
+
+    :type table: str
+    :param table: The name of the table
+    :type unlogged: bool
+    :param unlogged: Whether the table should be unlogged
+    :type parameters: dict
+    :param parameters: The storage parameters to set, or to reset to their defaults if their value is None
+
+    :rtype: list
+    """
+    table = connection.ops.quote_name(table)
+    statements = ['ALTER TABLE {0} SET {1}'.format(table, 'UNLOGGED' if unlogged else 'LOGGED')]
+    reset = [name for name, value in parameters.items() if value is None]
+    if reset:
+        statements.append('ALTER TABLE {0} RESET ({1})'.format(table, ', '.join(reset)))
+    values = ['{0} = {1}'.format(name, value) for name, value in parameters.items() if value is not None]
+    if values:
+        statements.append('ALTER TABLE {0} SET ({1})'.format(table, ', '.join(values)))
+    return statements
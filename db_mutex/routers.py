@@ -0,0 +1,30 @@
+from .databases import get_lock_databases
+
+
+class DBMutexRouter(object):
+    """
+    Routes the lock table to the databases configured with the ``DB_MUTEX_DATABASE`` setting. Add it to the
+    ``DATABASE_ROUTERS`` setting when locks live on their own database:
+
+    .. code-block:: python
+
+        DATABASE_ROUTERS = ['db_mutex.routers.DBMutexRouter']
+        DB_MUTEX_DATABASE = 'locks'
+
+    The lock table is only migrated on the lock databases. ORM queries on ``DBMutex`` go to the first lock
+    database. Locks that are sharded across several databases are always queried on their own database.
+    """
+    app_label = 'db_mutex'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return get_lock_databases()[0]
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == self.app_label:
+            return db in get_lock_databases()
+        return None
@@ -0,0 +1,50 @@
+"""
+Signals that report how locks behave, e.g. to feed metrics of acquisition latency, contention and hold
+times. Signals are sent with the class of the lock as the sender, and every signal provides the
+arguments ``lock``, the lock object, and ``lock_id``. Queries are only counted while a receiver is
+connected to one of the signals.
+"""
+from django.dispatch import Signal
+
+
+# Sent before every attempt at acquiring a lock. Provides ``attempt``, starting at 1.
+lock_acquire_attempted = Signal()
+
+# Sent when an attempt at acquiring a lock failed because the lock is held. Provides ``attempt`` and
+# ``wait_time``, the number of seconds spent on acquiring the lock so far.
+lock_contended = Signal()
+
+# Sent when a lock was acquired. Provides ``attempts``, ``wait_time`` and ``queries``, the number of
+# queries it took to acquire the lock.
+lock_acquired = Signal()
+
+# Sent after ``lock_acquired`` when acquiring a lock took over expired locks that their holders had not
+# released. Provides ``reclaimed``, the number of expired locks taken over. Takeovers are reported on
+# PostgreSQL and on databases without ``INSERT ... ON CONFLICT``, but not on SQLite 3.35+.
+lock_reclaimed = Signal()
+
+# Sent when acquiring a lock failed, either right away or once the timeout elapsed. Provides ``attempts``,
+# ``wait_time`` and ``queries``.
+lock_acquire_failed = Signal()
+
+# Sent when a lock was released. Provides ``hold_time``, the number of seconds the lock was held, and
+# ``queries``, the number of queries it took to release the lock.
+lock_released = Signal()
+
+# Sent when a lock expired and was taken over by someone else before its holder released it. Provides
+# ``hold_time`` and ``queries``.
+lock_expired = Signal()
+
+all_signals = [
+    lock_acquire_attempted, lock_contended, lock_acquired, lock_reclaimed, lock_acquire_failed, lock_released,
+    lock_expired
+]
+
+
+def has_listeners(sender):
+    """
+    Returns whether any receivers are connected to the signals of a lock class.
+
+    :rtype: bool
+    """
+    return any(signal.has_listeners(sender) for signal in all_signals)
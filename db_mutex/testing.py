@@ -0,0 +1,44 @@
+"""
+Helpers for using locks in test suites without querying the database.
+
+.. code-block:: python
+
+    from db_mutex.testing import FakeClock, override_memory_backend
+
+    class ReportTestCase(TestCase):
+        @override_memory_backend()
+        def test_report(self):
+            generate_report()
+"""
+from django.test.utils import override_settings
+
+
+class FakeClock(object):
+    """
+    A clock for the memory backend that only moves forward when it is told to.
+    """
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward, expiring the locks whose lease ends in the meantime.
+        """
+        self.now += seconds
+
+
+def override_memory_backend(clock=None):
+    """
+    Returns an ``override_settings`` that stores locks with the memory backend. Like ``override_settings``,
+    this can be used as a class or function decorator and as a context manager. Every use starts with a
+    new backend without any locks.
+
+    :type clock: callable
+    :param clock: The clock of the backend, e.g. a :class:`FakeClock`. Defaults to :func:`time.monotonic`.
+    """
+    return override_settings(
+        DB_MUTEX_BACKEND='db_mutex.backends.MemoryBackend', DB_MUTEX_BACKEND_OPTIONS={'clock': clock}
+    )
@@ -0,0 +1,286 @@
+from threading import Thread
+from unittest import mock
+import tempfile
+import time
+
+from db_mutex import backends
+from db_mutex.backends import BaseLockBackend, FileLockBackend, MemoryBackend, TableBackend, get_backend
+from db_mutex.db_mutex import db_mutex, db_mutex_many, db_semaphore
+from db_mutex.exceptions import DBMutexError, DBMutexTimeoutError
+from db_mutex.models import DBMutex, get_expiration_time, reclaimed_locks
+from db_mutex.testing import FakeClock, override_memory_backend
+
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+
+
+class GetBackendTestCase(SimpleTestCase):
+    """
+    Tests choosing the backend with the DB_MUTEX_BACKEND setting.
+    """
+    def test_default_backend(self):
+        self.assertIsInstance(get_backend(), TableBackend)
+        self.assertIs(get_backend(), get_backend())
+
+    @override_settings(DB_MUTEX_BACKEND='db_mutex.backends.FileLockBackend')
+    def test_backend_setting(self):
+        self.assertIsInstance(get_backend(), FileLockBackend)
+        self.assertIsInstance(db_mutex('lock_id').get_backend(), FileLockBackend)
+
+    def test_backend_options(self):
+        clock = FakeClock()
+        with override_settings(
+            DB_MUTEX_BACKEND='db_mutex.backends.MemoryBackend', DB_MUTEX_BACKEND_OPTIONS={'clock': clock}
+        ):
+            self.assertIs(get_backend().clock, clock)
+        with override_settings(
+            DB_MUTEX_BACKEND='db_mutex.backends.MemoryBackend', DB_MUTEX_BACKEND_OPTIONS={'clock': 'time.time'}
+        ):
+            self.assertIs(get_backend().clock, time.time)
+        self.assertIsInstance(get_backend(), TableBackend)
+
+    @override_settings(DB_MUTEX_BACKEND='db_mutex.backends.MemoryBackend')
+    def test_concurrent_first_calls(self):
+        """
+        Tests that threads that get the backend at the same time share one instance.
+        """
+        load_backend = backends.load_backend
+
+        def slow_load_backend(*args):
+            time.sleep(0.05)
+            return load_backend(*args)
+
+        instances = []
+        with mock.patch('db_mutex.backends.load_backend', side_effect=slow_load_backend):
+            threads = [Thread(target=lambda: instances.append(get_backend())) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(instances), 4)
+        self.assertTrue(all(instance is instances[0] for instance in instances))
+
+
+class TableBackendTestCase(TestCase):
+    """
+    Tests storing locks in the lock table.
+    """
+    def setUp(self):
+        self.backend = TableBackend()
+
+    def test_acquire_release(self):
+        self.assertTrue(self.backend.acquire('lock_id', 'token', 60, 'default'))
+        self.assertEqual(DBMutex.objects.get().token, 'token')
+        self.assertFalse(self.backend.acquire('lock_id', 'token2', 60, 'default'))
+        self.assertFalse(self.backend.release('lock_id', 'token2', 'default'))
+        self.assertTrue(self.backend.release('lock_id', 'token', 'default'))
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_extend(self):
+        self.backend.acquire('lock_id', 'token', 60, 'default')
+        self.assertTrue(self.backend.extend('lock_id', 'token', 60, 'default'))
+        self.assertFalse(self.backend.extend('lock_id', 'token2', 60, 'default'))
+
+    def test_is_held(self):
+        self.assertFalse(self.backend.is_held('lock_id', 'default'))
+        self.backend.acquire('lock_id', 'token', None, 'default')
+        self.assertTrue(self.backend.is_held('lock_id', 'default'))
+        DBMutex.objects.create(lock_id='expired', expires_at=get_expiration_time(-1))
+        self.assertFalse(self.backend.is_held('expired', 'default'))
+
+
+class FileLockBackendTestCase(SimpleTestCase):
+    """
+    Tests storing locks as file locks. Every backend opens lock files of its own, so a second backend
+    contends for the locks like another process would.
+    """
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.backend = FileLockBackend(directory.name)
+        self.other_backend = FileLockBackend(directory.name)
+
+    def test_acquire_release(self):
+        self.assertTrue(self.backend.acquire('lock_id', 'token', 60, 'default'))
+        self.assertFalse(self.backend.acquire('lock_id', 'token2', 60, 'default'))
+        self.assertFalse(self.other_backend.acquire('lock_id', 'token2', 60, 'default'))
+        self.assertTrue(self.other_backend.acquire('lock_id', 'token2', 60, 'other'))
+        self.assertFalse(self.backend.release('lock_id', 'token2', 'default'))
+        self.assertTrue(self.backend.release('lock_id', 'token', 'default'))
+        self.assertFalse(self.backend.release('lock_id', 'token', 'default'))
+        self.assertTrue(self.other_backend.acquire('lock_id', 'token2', 60, 'default'))
+
+    def test_extend(self):
+        self.backend.acquire('lock_id', 'token', 60, 'default')
+        self.assertTrue(self.backend.extend('lock_id', 'token', 60, 'default'))
+        self.assertFalse(self.backend.extend('lock_id', 'token2', 60, 'default'))
+        self.assertFalse(self.other_backend.extend('lock_id', 'token', 60, 'default'))
+
+    def test_is_held(self):
+        self.assertFalse(self.backend.is_held('lock_id', 'default'))
+        self.backend.acquire('lock_id', 'token', 60, 'default')
+        self.assertTrue(self.backend.is_held('lock_id', 'default'))
+        self.assertTrue(self.other_backend.is_held('lock_id', 'default'))
+        self.backend.release('lock_id', 'token', 'default')
+        self.assertFalse(self.other_backend.is_held('lock_id', 'default'))
+
+    def test_acquire_many(self):
+        """
+        Tests that the fallback for several locks acquires all of them or none.
+        """
+        self.other_backend.acquire('lock_b', 'token', 60, 'default')
+        self.assertFalse(self.backend.acquire_many(['lock_a', 'lock_b'], 'token2', 60, 'default'))
+        self.assertFalse(self.backend.is_held('lock_a', 'default'))
+        self.assertTrue(self.backend.acquire_many(['lock_a', 'lock_c'], 'token2', 60, 'default'))
+        self.assertEqual(self.backend.extend_many(['lock_a', 'lock_c'], 'token2', 60, 'default'), 2)
+        self.assertEqual(self.backend.release_many(['lock_a', 'lock_b', 'lock_c'], 'token2', 'default'), 2)
+
+    def test_acquire_slot(self):
+        self.assertTrue(self.backend.acquire_slot(['slot_0', 'slot_1'], 'token', 60, 'default'))
+        self.assertTrue(self.other_backend.acquire_slot(['slot_0', 'slot_1'], 'token2', 60, 'default'))
+        self.assertFalse(self.other_backend.acquire_slot(['slot_0', 'slot_1'], 'token3', 60, 'default'))
+
+
+class BaseLockBackendTestCase(SimpleTestCase):
+    def test_not_implemented(self):
+        backend = BaseLockBackend()
+        with self.assertRaises(NotImplementedError):
+            backend.acquire('lock_id', 'token', 60, 'default')
+        with self.assertRaises(NotImplementedError):
+            backend.is_held('lock_id', 'default')
+
+
+@override_settings(DB_MUTEX_BACKEND='db_mutex.backends.FileLockBackend')
+class FileLockMutexTestCase(TestCase):
+    """
+    Tests locks that are stored with the file lock backend.
+    """
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            with db_mutex('file_lock_id') as lock:
+                self.assertTrue(get_backend().is_held('file_lock_id', 'default'))
+                with self.assertRaises(DBMutexError):
+                    with db_mutex('file_lock_id'):
+                        raise NotImplementedError
+                self.assertTrue(lock.extend())
+        self.assertFalse(get_backend().is_held('file_lock_id', 'default'))
+
+    def test_lock_timeout_error(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex('file_lock_id') as lock:
+                get_backend().release('file_lock_id', lock.token, 'default')
+
+    def test_many(self):
+        with self.assertNumQueries(0):
+            with db_mutex_many(['file_lock_a', 'file_lock_b']):
+                with self.assertRaises(DBMutexError):
+                    with db_mutex_many(['file_lock_b', 'file_lock_c']):
+                        raise NotImplementedError
+                self.assertFalse(get_backend().is_held('file_lock_c', 'default'))
+
+    def test_semaphore(self):
+        with self.assertNumQueries(0):
+            with db_semaphore('file_lock_id', limit=2):
+                with db_semaphore('file_lock_id', limit=2):
+                    with self.assertRaises(DBMutexError):
+                        with db_semaphore('file_lock_id', limit=2):
+                            raise NotImplementedError
+
+
+class MemoryBackendTestCase(SimpleTestCase):
+    """
+    Tests storing locks in memory.
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = MemoryBackend(self.clock)
+
+    def test_acquire_release(self):
+        self.assertTrue(self.backend.acquire('lock_id', 'token', 60, 'default'))
+        self.assertFalse(self.backend.acquire('lock_id', 'token2', 60, 'default'))
+        self.assertTrue(self.backend.acquire('lock_id', 'token2', 60, 'other'))
+        self.assertEqual(self.backend.get_locks(), {'lock_id': 'token'})
+        self.assertFalse(self.backend.release('lock_id', 'token2', 'default'))
+        self.assertTrue(self.backend.release('lock_id', 'token', 'default'))
+        self.assertFalse(self.backend.release('lock_id', 'token', 'default'))
+        self.assertEqual(self.backend.get_locks(), {})
+        self.assertEqual(self.backend.get_locks('other'), {'lock_id': 'token2'})
+
+    def test_expiration(self):
+        self.backend.acquire('lock_id', 'token', 60, 'default')
+        self.backend.acquire('no_ttl', 'token', None, 'default')
+        self.clock.advance(59)
+        self.assertTrue(self.backend.is_held('lock_id', 'default'))
+        self.clock.advance(1)
+        self.assertFalse(self.backend.is_held('lock_id', 'default'))
+        self.assertEqual(self.backend.get_locks(), {'no_ttl': 'token'})
+
+        # Like the table backend, an expired lock can still be released and extended until it is taken over
+        self.assertTrue(self.backend.extend('lock_id', 'token', 60, 'default'))
+        self.assertTrue(self.backend.is_held('lock_id', 'default'))
+        self.clock.advance(60)
+        self.assertTrue(self.backend.acquire('lock_id', 'token2', 60, 'default'))
+        self.assertFalse(self.backend.extend('lock_id', 'token', 60, 'default'))
+        self.assertFalse(self.backend.release('lock_id', 'token', 'default'))
+
+    def test_acquire_many(self):
+        self.backend.acquire('lock_b', 'token', 60, 'default')
+        self.assertFalse(self.backend.acquire_many(['lock_a', 'lock_b'], 'token2', 60, 'default'))
+        self.assertEqual(self.backend.get_locks(), {'lock_b': 'token'})
+        self.clock.advance(60)
+        self.assertTrue(self.backend.acquire_many(['lock_a', 'lock_b'], 'token2', 60, 'default'))
+        self.assertEqual(self.backend.get_locks(), {'lock_a': 'token2', 'lock_b': 'token2'})
+
+    def test_reclaimed(self):
+        """
+        Tests that acquiring counts the expired locks that it takes over.
+        """
+        self.backend.acquire('lock_a', 'token', 60, 'default')
+        self.clock.advance(60)
+        self.addCleanup(reclaimed_locks.reset, reclaimed_locks.set(0))
+        self.assertTrue(self.backend.acquire_many(['lock_a', 'lock_b'], 'token2', 60, 'default'))
+        self.assertEqual(reclaimed_locks.get(), 1)
+
+    def test_clear(self):
+        self.backend.acquire('lock_id', 'token', 60, 'default')
+        self.backend.clear()
+        self.assertFalse(self.backend.is_held('lock_id', 'default'))
+
+
+class MemoryMutexTestCase(SimpleTestCase):
+    """
+    Tests locks that are stored with the memory backend in tests without a database.
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        override = override_memory_backend(self.clock)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_lock(self):
+        with db_mutex('lock_id') as lock:
+            self.assertEqual(get_backend().get_locks(), {'lock_id': lock.token})
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id'):
+                    raise NotImplementedError
+        self.assertEqual(get_backend().get_locks(), {})
+
+    def test_lock_expired(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex('lock_id', ttl=60):
+                self.clock.advance(60)
+                with db_mutex('lock_id') as other_lock:
+                    pass
+        self.assertIsNotNone(other_lock.token)
+
+    def test_decorator(self):
+        @db_mutex('lock_id')
+        def run_get_lock():
+            return get_backend().is_held('lock_id', 'default')
+
+        self.assertTrue(run_get_lock())
+
+    def test_new_backend_per_override(self):
+        get_backend().acquire('lock_id', 'token', 60, 'default')
+        with override_memory_backend():
+            self.assertEqual(get_backend().get_locks(), {})
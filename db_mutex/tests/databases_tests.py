@@ -0,0 +1,244 @@
+from threading import Thread
+from unittest import mock
+
+from io import StringIO
+
+from db_mutex.databases import (
+    close_lock_connections, get_lock_connection, get_lock_database, get_lock_databases, lock_connections
+)
+from db_mutex.db_mutex import db_mutex, db_mutex_many
+from db_mutex.exceptions import DBMutexError
+from db_mutex.models import DBMutex, get_expiration_time
+from db_mutex.routers import DBMutexRouter
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+
+
+class LockDatabaseTestCase(TestCase):
+    """
+    Tests routing locks to their own databases.
+    """
+    databases = {'default', 'other'}
+
+    def get_lock_ids(self, using):
+        return list(DBMutex.objects.using(using).order_by('lock_id').values_list('lock_id', flat=True))
+
+    def test_default_database(self):
+        self.assertEqual(get_lock_databases(), ['default'])
+        self.assertEqual(get_lock_database('lock_id'), 'default')
+        self.assertEqual(get_lock_database('lock_id', using='other'), 'other')
+
+    @override_settings(DB_MUTEX_DATABASE='other')
+    def test_lock_database_setting(self):
+        self.assertEqual(get_lock_databases(), ['other'])
+        with db_mutex('lock_id') as lock:
+            self.assertEqual(lock.get_database(), 'other')
+            self.assertEqual(self.get_lock_ids('other'), ['lock_id'])
+            self.assertEqual(self.get_lock_ids('default'), [])
+        self.assertEqual(self.get_lock_ids('other'), [])
+
+    def test_using(self):
+        """
+        Tests that the same lock id can be held independently on different databases.
+        """
+        with db_mutex('lock_id', using='other'):
+            with db_mutex('lock_id'):
+                self.assertEqual(self.get_lock_ids('other'), ['lock_id'])
+                self.assertEqual(self.get_lock_ids('default'), ['lock_id'])
+        self.assertEqual(self.get_lock_ids('other'), [])
+        self.assertEqual(self.get_lock_ids('default'), [])
+
+    @override_settings(DB_MUTEX_DATABASE=['default', 'other'])
+    def test_sharding(self):
+        """
+        Tests that locks are sharded across the lock databases by their lock id.
+        """
+        lock_ids = ['lock_id_{0}'.format(i) for i in range(20)]
+        databases = [get_lock_database(lock_id) for lock_id in lock_ids]
+        self.assertEqual(set(databases), {'default', 'other'})
+        self.assertEqual(databases, [get_lock_database(lock_id) for lock_id in lock_ids])
+
+        locks = [db_mutex(lock_id) for lock_id in lock_ids]
+        for lock in locks:
+            lock.start()
+        self.assertEqual(
+            sorted(self.get_lock_ids('default') + self.get_lock_ids('other')), sorted(lock_ids)
+        )
+        self.assertEqual(len(self.get_lock_ids('default')), databases.count('default'))
+        for lock in locks:
+            lock.stop()
+        self.assertEqual(self.get_lock_ids('default') + self.get_lock_ids('other'), [])
+
+    @override_settings(DB_MUTEX_DATABASE=['default', 'other'])
+    def test_many_sharded(self):
+        """
+        Tests that locks on several databases are acquired all or nothing.
+        """
+        lock_ids = ['lock_id_{0}'.format(i) for i in range(10)]
+        with db_mutex_many(lock_ids):
+            self.assertEqual(sorted(self.get_lock_ids('default') + self.get_lock_ids('other')), lock_ids)
+        self.assertEqual(self.get_lock_ids('default') + self.get_lock_ids('other'), [])
+
+        # A held lock on the second database releases the locks already acquired on the first one
+        held_lock_id = next(lock_id for lock_id in lock_ids if get_lock_database(lock_id) == 'other')
+        DBMutex.objects.using('other').create(lock_id=held_lock_id)
+        with self.assertRaises(DBMutexError):
+            with db_mutex_many(lock_ids):
+                raise NotImplementedError
+        self.assertEqual(self.get_lock_ids('default') + self.get_lock_ids('other'), [held_lock_id])
+
+    @override_settings(DB_MUTEX_DATABASE=['default', 'other'])
+    def test_delete_expired_locks(self):
+        for using in ['default', 'other']:
+            DBMutex.objects.using(using).create(lock_id='expired', expires_at=get_expiration_time(-1))
+            DBMutex.objects.using(using).create(lock_id='lock_id', expires_at=get_expiration_time(60))
+
+        self.assertEqual(db_mutex('lock_id', using='other').delete_expired_locks(), 1)
+        self.assertEqual(self.get_lock_ids('other'), ['lock_id'])
+        self.assertEqual(db_mutex('lock_id').delete_expired_locks(), 1)
+        self.assertEqual(self.get_lock_ids('default'), ['lock_id'])
+
+    @override_settings(DB_MUTEX_DATABASE=['default', 'other'])
+    def test_delete_expired_locks_command(self):
+        for using in ['default', 'other']:
+            DBMutex.objects.using(using).create(lock_id='expired', expires_at=get_expiration_time(-1))
+
+        stdout = StringIO()
+        call_command('delete_expired_locks', '--database', 'other', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Deleted 1 expired locks\n')
+        self.assertEqual(self.get_lock_ids('default'), ['expired'])
+
+        stdout = StringIO()
+        call_command('delete_expired_locks', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Deleted 1 expired locks\n')
+        self.assertEqual(self.get_lock_ids('default'), [])
+
+
+class DBMutexRouterTestCase(TestCase):
+    """
+    Tests routing the lock table with the DBMutexRouter.
+    """
+    def setUp(self):
+        self.router = DBMutexRouter()
+
+    def test_default_database(self):
+        self.assertEqual(self.router.db_for_read(DBMutex), 'default')
+        self.assertEqual(self.router.db_for_write(DBMutex), 'default')
+        self.assertTrue(self.router.allow_migrate('default', 'db_mutex'))
+        self.assertFalse(self.router.allow_migrate('other', 'db_mutex'))
+
+    @override_settings(DB_MUTEX_DATABASE=['other', 'default'])
+    def test_lock_databases(self):
+        self.assertEqual(self.router.db_for_read(DBMutex), 'other')
+        self.assertEqual(self.router.db_for_write(DBMutex), 'other')
+        self.assertTrue(self.router.allow_migrate('default', 'db_mutex', model_name='dbmutex'))
+        self.assertTrue(self.router.allow_migrate('other', 'db_mutex', model_name='dbmutex'))
+
+    def test_other_apps(self):
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_write(User))
+        self.assertIsNone(self.router.allow_migrate('other', 'auth'))
+
+
+class LockConnectionTestCase(TransactionTestCase):
+    """
+    Tests the connections that lock queries run on. Separate lock connections cannot see uncommitted
+    data, so these tests do not run inside of a transaction.
+    """
+    def tearDown(self):
+        close_lock_connections()
+
+    def lock_exists(self, lock_id):
+        other_connection = connections.create_connection('default')
+        try:
+            with other_connection.cursor() as cursor:
+                cursor.execute(
+                    'SELECT COUNT(*) FROM {0} WHERE lock_id = %s'.format(DBMutex._meta.db_table), [lock_id]
+                )
+                return cursor.fetchone()[0] == 1
+        finally:
+            other_connection.close()
+
+    def test_shared_connection_by_default(self):
+        self.assertIs(get_lock_connection('default'), connections['default'])
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    def test_separate_connection(self):
+        """
+        Tests that every thread has its own separate lock connection.
+        """
+        lock_connection = get_lock_connection('default')
+        self.assertIsNot(lock_connection, connections['default'])
+        self.assertIs(get_lock_connection('default'), lock_connection)
+
+        other_lock_connections = []
+        thread = Thread(target=lambda: other_lock_connections.append(get_lock_connection('default')))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other_lock_connections[0], lock_connection)
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    def test_lock_visible_inside_transaction(self):
+        """
+        Tests that a lock acquired inside of a transaction is visible to others right away.
+        """
+        with transaction.atomic():
+            with db_mutex('lock_id'):
+                self.assertTrue(self.lock_exists('lock_id'))
+            self.assertFalse(self.lock_exists('lock_id'))
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    def test_lock_survives_rollback(self):
+        """
+        Tests that a lock is not rolled back with the transaction it was acquired in.
+        """
+        lock = db_mutex('lock_id')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                lock.start()
+                raise ValueError
+        self.assertTrue(self.lock_exists('lock_id'))
+        lock.stop()
+        self.assertFalse(self.lock_exists('lock_id'))
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    def test_reconnect_unusable_connection(self):
+        lock_connection = get_lock_connection('default')
+        lock_connection.ensure_connection()
+        lock_connection.errors_occurred = True
+        with mock.patch.object(lock_connection, 'is_usable', return_value=False):
+            with mock.patch.object(lock_connection, 'close') as close:
+                self.assertIs(get_lock_connection('default'), lock_connection)
+        close.assert_called_once_with()
+        self.assertFalse(lock_connection.errors_occurred)
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    def test_close_lock_connections(self):
+        lock_connection = get_lock_connection('default')
+        with mock.patch.object(lock_connection, 'close') as close:
+            close_lock_connections()
+        close.assert_called_once_with()
+        self.assertFalse(hasattr(lock_connections, 'default'))
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    def test_close_lock_connections_keeps_other_connections(self):
+        get_lock_connection('default')
+        with mock.patch.object(connections['default'], 'close') as close:
+            close_lock_connections()
+        close.assert_not_called()
+
+    @override_settings(DB_MUTEX_SEPARATE_CONNECTION=True)
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_acquire_without_upsert(self, supports_upsert):
+        """
+        Tests that locks are acquired without a savepoint on a separate lock connection when the database
+        does not support INSERT ... ON CONFLICT.
+        """
+        with transaction.atomic():
+            self.assertTrue(DBMutex.objects.acquire('lock_id', 'token', 60))
+            self.assertFalse(DBMutex.objects.acquire('lock_id', 'token2', 60))
+        self.assertTrue(self.lock_exists('lock_id'))
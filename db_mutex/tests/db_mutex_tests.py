@@ -1,14 +1,53 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
+import os
+import subprocess
+import sys
+from itertools import chain, repeat
+import time
+from threading import Event, Thread, Timer
+from unittest import mock, skipIf, skipUnless
 
 from db_mutex.exceptions import DBMutexError, DBMutexTimeoutError
-from db_mutex.models import DBMutex
-from db_mutex.db_mutex import db_mutex
+from db_mutex.models import DBMutex, DBMutexQuerySet, get_expiration_time, supports_upsert
+from db_mutex import holders, postgres
+from db_mutex.db_mutex import db_advisory_mutex, db_mutex, db_mutex_many, db_rw_mutex, db_semaphore
 
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, connections, DatabaseError, transaction
+from django.db.transaction import TransactionManagementError
+from django.db.models import DurationField, ExpressionWrapper, F
+from django.db.models.functions import Now
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from freezegun import freeze_time
 
 
+def create_lock(lock_id, expires_in=None, token=''):
+    """
+    Creates a lock that expires ``expires_in`` seconds from now according to the database clock, or
+    never if ``expires_in`` is None.
+    """
+    return DBMutex.objects.create(lock_id=lock_id, expires_at=get_expiration_time(expires_in), token=token)
+
+
+def expire_lock(lock_id):
+    """
+    Ends the lease of a lock according to the database clock.
+    """
+    DBMutex.objects.filter(lock_id=lock_id).update(expires_at=get_expiration_time(-1))
+
+
+def get_remaining_seconds(lock_id):
+    """
+    Returns the number of seconds until a lock expires according to the database clock.
+    """
+    return DBMutex.objects.filter(lock_id=lock_id).annotate(
+        remaining=ExpressionWrapper(F('expires_at') - Now(), output_field=DurationField())
+    ).values_list('remaining', flat=True).get().total_seconds()
+
+
 class ContextManagerTestCase(TestCase):
     """
     Tests db_mutex as a context manager.
@@ -38,7 +77,7 @@ class ContextManagerTestCase(TestCase):
             with db_mutex('lock_id'):
                 raise NotImplementedError
         # The lock should still exist
-        self.assertTrue(DBMutex.objects.filter(id=m.id).exists())
+        self.assertTrue(DBMutex.objects.filter(pk=m.pk).exists())
 
     @freeze_time('2014-02-01')
     def test_lock_before_suppress_acquisition_errors(self):
@@ -54,7 +93,20 @@ class ContextManagerTestCase(TestCase):
             with db_mutex('lock_id', suppress_acquisition_exceptions=True):
                 raise NotImplementedError
         # The lock should still exist
-        self.assertTrue(DBMutex.objects.filter(id=m.id).exists())
+        self.assertTrue(DBMutex.objects.filter(pk=m.pk).exists())
+
+    def test_failed_start_keeps_holder(self):
+        """
+        Tests that failing to acquire a lock that the same object holds does not affect the holder.
+        """
+        lock = db_mutex('lock_id')
+        lock.start()
+        token = lock.token
+        with self.assertRaises(DBMutexError):
+            lock.start()
+        self.assertEqual(lock.token, token)
+        lock.stop()
+        self.assertEqual(DBMutex.objects.count(), 0)
 
     @freeze_time('2014-02-01')
     def test_lock_different_id(self):
@@ -69,98 +121,85 @@ class ContextManagerTestCase(TestCase):
             m2 = DBMutex.objects.get(lock_id='lock_id2')
             self.assertEqual(m2.creation_time, datetime(2014, 2, 1))
         # The original lock should still exist but the other one should be gone
-        self.assertTrue(DBMutex.objects.filter(id=m.id).exists())
+        self.assertTrue(DBMutex.objects.filter(pk=m.pk).exists())
         self.assertEqual(DBMutex.objects.count(), 1)
 
     def test_lock_timeout_default(self):
         """
         Tests that the lock timeout works with the default value of 30 minutes.
         """
-        with freeze_time('2014-02-01'):
-            # Create a lock
-            orig_lock = DBMutex.objects.create(lock_id='lock_id')
+        with db_mutex('lock_id'):
+            self.assertTrue(29 * 60 < get_remaining_seconds('lock_id') <= 30 * 60)
 
-        # Try to acquire the lock one minute in the future. It should fail
-        with freeze_time('2014-02-01 00:01:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
+        # Try to acquire a lock that expires in a minute. It should fail
+        orig_lock = create_lock('lock_id', 60, token='orig_token')
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id'):
+                raise NotImplementedError
 
-        # Try to acquire the lock 9 minutes in the future. It should fail
-        with freeze_time('2014-02-01 00:09:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
+        # Try to acquire the lock after it expired. It should pass since the lock timed out
+        expire_lock('lock_id')
+        with db_mutex('lock_id'):
+            self.assertNotEqual(DBMutex.objects.get(lock_id='lock_id').token, orig_lock.token)
+            self.assertEqual(DBMutex.objects.count(), 1)
+            self.assertTrue(get_remaining_seconds('lock_id') > 29 * 60)
 
-        # Try to acquire the lock 30 minutes in the future. It should pass since the lock timed out
-        with freeze_time('2014-02-01 00:30:00'):
-            with db_mutex('lock_id'):
-                self.assertFalse(DBMutex.objects.filter(id=orig_lock.id).exists())
-                self.assertEqual(DBMutex.objects.count(), 1)
-                m = DBMutex.objects.get(lock_id='lock_id')
-                self.assertEqual(m.creation_time, datetime(2014, 2, 1, 0, 30))
+    def test_other_expired_locks_not_deleted(self):
+        """
+        Tests that acquiring a lock only deletes its own expired lock and leaves other expired locks
+        to the delete_expired_locks command.
+        """
+        create_lock('lock_id', -1)
+        create_lock('lock_id2', -1)
+
+        with db_mutex('lock_id'):
+            self.assertEqual(DBMutex.objects.count(), 2)
+        self.assertTrue(DBMutex.objects.filter(lock_id='lock_id2').exists())
 
     @override_settings(DB_MUTEX_TTL_SECONDS=None)
     def test_no_lock_timeout(self):
         """
         Tests that the lock timeout works when None is configured as the timeout.
         """
-        with freeze_time('2014-02-01'):
-            # Create a lock
-            DBMutex.objects.create(lock_id='lock_id')
-
-        # Try to acquire the lock one minute in the future. It should fail
-        with freeze_time('2014-02-01 00:01:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
-
-        # Try to acquire the lock 9 minutes in the future. It should fail
-        with freeze_time('2014-02-01 00:09:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
-
-        # Try to acquire the lock 30 minutes in the future. It should fail
-        with freeze_time('2014-02-01 00:30:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
+        with db_mutex('lock_id'):
+            self.assertIsNone(DBMutex.objects.get(lock_id='lock_id').expires_at)
 
-        # Try to acquire the lock years in the future. It should fail
-        with freeze_time('2016-02-01 00:30:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
+        # Try to acquire a lock that never expires. It should fail
+        create_lock('lock_id')
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id'):
+                raise NotImplementedError
 
     @override_settings(DB_MUTEX_TTL_SECONDS=60 * 60)
     def test_custom_lock_timeout(self):
         """
         Tests that the custom lock timeout works when an hour is configured as the timeout.
         """
-        with freeze_time('2014-02-01'):
-            # Create a lock
-            orig_lock = DBMutex.objects.create(lock_id='lock_id')
+        with db_mutex('lock_id'):
+            self.assertTrue(59 * 60 < get_remaining_seconds('lock_id') <= 60 * 60)
 
-        # Try to acquire the lock one minute in the future. It should fail
-        with freeze_time('2014-02-01 00:01:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
+        # Try to acquire a lock that expires in 29 minutes. It should fail
+        create_lock('lock_id', 29 * 60)
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id'):
+                raise NotImplementedError
 
-        # Try to acquire the lock 31 minutes in the future. It should fail
-        with freeze_time('2014-02-01 00:31:00'):
-            with self.assertRaises(DBMutexError):
-                with db_mutex('lock_id'):
-                    raise NotImplementedError
+    @override_settings(DB_MUTEX_TTL_SECONDS=None)
+    def test_lock_ttl(self):
+        """
+        Tests that the ttl of a lock overrides the configured timeout.
+        """
+        with db_mutex('lock_id', ttl=60):
+            self.assertTrue(50 < get_remaining_seconds('lock_id') <= 60)
 
-        # Try to acquire the lock 60 minutes in the future. It should pass
-        with freeze_time('2014-02-01 01:00:00'):
-            with db_mutex('lock_id'):
-                self.assertFalse(DBMutex.objects.filter(id=orig_lock.id).exists())
-                self.assertEqual(DBMutex.objects.count(), 1)
-                m = DBMutex.objects.get(lock_id='lock_id')
-                self.assertEqual(m.creation_time, datetime(2014, 2, 1, 1))
+        with db_mutex('lock_id', ttl=timedelta(minutes=2)):
+            self.assertTrue(110 < get_remaining_seconds('lock_id') <= 120)
+
+        # A lock with a short ttl can be reclaimed as soon as its own lease ends
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex('lock_id', ttl=-1):
+                with db_mutex('lock_id'):
+                    self.assertIsNone(DBMutex.objects.get(lock_id='lock_id').expires_at)
 
     def test_lock_timeout_error(self):
         """
@@ -178,6 +217,122 @@ class ContextManagerTestCase(TestCase):
                     # Release the lock before the context manager finishes
                     m.delete()
 
+    def test_owner_token(self):
+        """
+        Tests that every acquisition of a lock has its own owner token.
+        """
+        lock = db_mutex('lock_id')
+        with lock:
+            token = DBMutex.objects.get(lock_id='lock_id').token
+            self.assertEqual(token, lock.token)
+            self.assertEqual(len(token), 32)
+        with lock:
+            self.assertNotEqual(DBMutex.objects.get(lock_id='lock_id').token, token)
+
+    def test_release_single_query(self):
+        lock = db_mutex('lock_id')
+        lock.start()
+        with self.assertNumQueries(1):
+            lock.stop()
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_late_holder_does_not_release_reacquired_lock(self):
+        """
+        Tests that a holder whose lock expired and was acquired by someone else does not release the
+        new lock.
+        """
+        late_lock = db_mutex('lock_id', ttl=-1)
+        late_lock.start()
+        new_lock = db_mutex('lock_id')
+        new_lock.start()
+
+        with self.assertRaises(DBMutexTimeoutError):
+            late_lock.stop()
+        self.assertEqual(DBMutex.objects.get(lock_id='lock_id').token, new_lock.token)
+
+        new_lock.stop()
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+
+class AcquireTestCase(TestCase):
+    """
+    Tests the queries used to acquire a lock.
+    """
+    @skipUnless(supports_upsert(connection), 'INSERT ... ON CONFLICT is not supported')
+    def test_acquire_single_query(self):
+        """
+        Tests that acquiring a free, an expired or a held lock each take a single query.
+        """
+        with self.assertNumQueries(1):
+            self.assertTrue(DBMutex.objects.acquire('lock_id', 'token', 60))
+        with self.assertNumQueries(1):
+            self.assertFalse(DBMutex.objects.acquire('lock_id', 'token2', 60))
+        self.assertEqual(DBMutex.objects.get(lock_id='lock_id').token, 'token')
+
+        expire_lock('lock_id')
+        with self.assertNumQueries(1):
+            self.assertTrue(DBMutex.objects.acquire('lock_id', 'token2', None))
+        lock = DBMutex.objects.get(lock_id='lock_id')
+        self.assertEqual(lock.token, 'token2')
+        self.assertIsNone(lock.expires_at)
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_acquire_without_upsert(self, supports_upsert):
+        """
+        Tests acquiring locks on databases that do not support INSERT ... ON CONFLICT.
+        """
+        self.assertTrue(DBMutex.objects.acquire('lock_id', 'token', 60))
+        self.assertFalse(DBMutex.objects.acquire('lock_id', 'token2', 60))
+        self.assertEqual(DBMutex.objects.get(lock_id='lock_id').token, 'token')
+
+        expire_lock('lock_id')
+        self.assertTrue(DBMutex.objects.acquire('lock_id', 'token2', None))
+        self.assertEqual(DBMutex.objects.get(lock_id='lock_id').token, 'token2')
+
+    def test_supports_upsert(self):
+        self.assertEqual(supports_upsert(connection), connection.features.can_return_columns_from_insert)
+
+    def test_lock_id_primary_key(self):
+        """
+        Tests that locks are keyed by their lock id without a surrogate id.
+        """
+        self.assertEqual(DBMutex._meta.pk.name, 'lock_id')
+        self.assertEqual([field.name for field in DBMutex._meta.concrete_fields if field.unique], ['lock_id'])
+        DBMutex.objects.acquire('lock_id', 'token', 60)
+        self.assertEqual(DBMutex.objects.get(pk='lock_id').token, 'token')
+
+
+class DeleteExpiredLocksTestCase(TestCase):
+    """
+    Tests deleting all expired locks.
+    """
+    def test_delete_expired_locks(self):
+        create_lock('lock_id', -60)
+        create_lock('lock_id2', -1)
+        create_lock('lock_id3', 60)
+        create_lock('lock_id4')
+
+        self.assertEqual(db_mutex('lock_id').delete_expired_locks(), 2)
+        self.assertEqual(
+            list(DBMutex.objects.order_by('lock_id').values_list('lock_id', flat=True)), ['lock_id3', 'lock_id4']
+        )
+
+    def test_reclaimed_lock_not_deleted(self):
+        """
+        Tests that an expired lock that is taken over after it was selected for deletion is not deleted.
+        """
+        create_lock('lock_id', -60)
+        values_list = DBMutexQuerySet.values_list
+
+        def reclaim(queryset, *args, **kwargs):
+            lock_ids = list(values_list(queryset, *args, **kwargs))
+            DBMutex.objects.acquire('lock_id', 'token', 60)
+            return lock_ids
+
+        with mock.patch.object(DBMutexQuerySet, 'values_list', autospec=True, side_effect=reclaim):
+            self.assertEqual(DBMutex.objects.delete_expired(), 0)
+        self.assertEqual(DBMutex.objects.get(lock_id='lock_id').token, 'token')
+
 
 class FunctionDecoratorTestCase(TestCase):
     """
@@ -217,7 +372,7 @@ class FunctionDecoratorTestCase(TestCase):
             run_get_lock()
 
         # The lock should still exist
-        self.assertTrue(DBMutex.objects.filter(id=m.id).exists())
+        self.assertTrue(DBMutex.objects.filter(pk=m.pk).exists())
 
     @freeze_time('2014-02-01')
     def test_lock_before_suppress_acquisition_exceptions(self):
@@ -236,7 +391,22 @@ class FunctionDecoratorTestCase(TestCase):
         run_get_lock()
 
         # The lock should still exist
-        self.assertTrue(DBMutex.objects.filter(id=m.id).exists())
+        self.assertTrue(DBMutex.objects.filter(pk=m.pk).exists())
+
+    def test_nested_call(self):
+        """
+        Tests that a call of a decorated function that fails to acquire the lock does not affect a call
+        that holds it.
+        """
+        @db_mutex('lock_id')
+        def run_get_lock(nested):
+            if nested:
+                with self.assertRaises(DBMutexError):
+                    run_get_lock(False)
+            return DBMutex.objects.count()
+
+        self.assertEqual(run_get_lock(True), 1)
+        self.assertEqual(DBMutex.objects.count(), 0)
 
     @freeze_time('2014-02-01')
     def test_lock_different_id(self):
@@ -255,28 +425,22 @@ class FunctionDecoratorTestCase(TestCase):
         # Try to acquire the lock with a different ID
         run_get_lock2()
         # The original lock should still exist but the other one should be gone
-        self.assertTrue(DBMutex.objects.filter(id=m.id).exists())
+        self.assertTrue(DBMutex.objects.filter(pk=m.pk).exists())
         self.assertEqual(DBMutex.objects.count(), 1)
 
     def test_lock_timeout_default(self):
         """
         Tests that the lock timeout works with the default value of 30 minutes.
         """
-        with freeze_time('2014-02-01'):
-            # Create a lock
-            orig_lock = DBMutex.objects.create(lock_id='lock_id')
-
-        # Try to acquire the lock one minute in the future. It should fail
-        @freeze_time('2014-02-01 00:01:00')
         @db_mutex('lock_id')
         def run_get_lock1():
-            raise NotImplementedError
+            self.assertTrue(29 * 60 < get_remaining_seconds('lock_id') <= 30 * 60)
 
-        with self.assertRaises(DBMutexError):
-            run_get_lock1()
+        run_get_lock1()
+
+        # Try to acquire a lock that expires in a minute. It should fail
+        orig_lock = create_lock('lock_id', 60, token='orig_token')
 
-        # Try to acquire the lock 9 minutes in the future. It should fail
-        @freeze_time('2014-02-01 00:09:00')
         @db_mutex('lock_id')
         def run_get_lock2():
             raise NotImplementedError
@@ -284,15 +448,13 @@ class FunctionDecoratorTestCase(TestCase):
         with self.assertRaises(DBMutexError):
             run_get_lock2()
 
-        @freeze_time('2014-02-01 00:30:00')
         @db_mutex('lock_id')
         def run_get_lock3():
-            self.assertFalse(DBMutex.objects.filter(id=orig_lock.id).exists())
+            self.assertNotEqual(DBMutex.objects.get(lock_id='lock_id').token, orig_lock.token)
             self.assertEqual(DBMutex.objects.count(), 1)
-            m = DBMutex.objects.get(lock_id='lock_id')
-            self.assertEqual(m.creation_time, datetime(2014, 2, 1, 0, 30))
 
-        # Try to acquire the lock 30 minutes in the future. It should pass since the lock timed out
+        # Try to acquire the lock after it expired. It should pass since the lock timed out
+        expire_lock('lock_id')
         run_get_lock3()
 
     @override_settings(DB_MUTEX_TTL_SECONDS=None)
@@ -300,21 +462,15 @@ class FunctionDecoratorTestCase(TestCase):
         """
         Tests that the lock timeout works when None is configured as the timeout.
         """
-        with freeze_time('2014-02-01'):
-            # Create a lock
-            DBMutex.objects.create(lock_id='lock_id')
-
-        # Try to acquire the lock one minute in the future. It should fail
-        @freeze_time('2014-02-01 00:01:00')
         @db_mutex('lock_id')
         def run_get_lock1():
-            raise NotImplementedError
+            self.assertIsNone(DBMutex.objects.get(lock_id='lock_id').expires_at)
 
-        with self.assertRaises(DBMutexError):
-            run_get_lock1()
+        run_get_lock1()
+
+        # Try to acquire a lock that never expires. It should fail
+        create_lock('lock_id')
 
-        # Try to acquire the lock 9 minutes in the future. It should fail
-        @freeze_time('2014-02-01 00:09:00')
         @db_mutex('lock_id')
         def run_get_lock2():
             raise NotImplementedError
@@ -322,61 +478,22 @@ class FunctionDecoratorTestCase(TestCase):
         with self.assertRaises(DBMutexError):
             run_get_lock2()
 
-        # Try to acquire the lock 30 minutes in the future. It should fail
-        @freeze_time('2014-02-01 00:30:00')
-        @db_mutex('lock_id')
-        def run_get_lock3():
-            raise NotImplementedError
-
-        with self.assertRaises(DBMutexError):
-            run_get_lock3()
-
-        # Try to acquire the lock years in the future. It should fail
-        @freeze_time('2016-02-01 00:30:00')
-        @db_mutex('lock_id')
-        def run_get_lock4():
-            raise NotImplementedError
-
-        with self.assertRaises(DBMutexError):
-            run_get_lock4()
-
     @override_settings(DB_MUTEX_TTL_SECONDS=60 * 60)
     def test_custom_lock_timeout(self):
         """
         Tests that the custom lock timeout works when an hour is configured as the timeout.
         """
-        with freeze_time('2014-02-01'):
-            # Create a lock
-            orig_lock = DBMutex.objects.create(lock_id='lock_id')
-
-        # Try to acquire the lock one minute in the future. It should fail
-        @freeze_time('2014-02-01 00:01:00')
         @db_mutex('lock_id')
         def run_get_lock1():
-            raise NotImplementedError
+            self.assertTrue(59 * 60 < get_remaining_seconds('lock_id') <= 60 * 60)
 
-        with self.assertRaises(DBMutexError):
-            run_get_lock1()
+        run_get_lock1()
 
-        # Try to acquire the lock 31 minutes in the future. It should fail
-        @freeze_time('2014-02-01 00:31:00')
-        @db_mutex('lock_id')
+        @db_mutex('lock_id', ttl=5 * 60)
         def run_get_lock2():
-            raise NotImplementedError
-
-        with self.assertRaises(DBMutexError):
-            run_get_lock2()
-
-        # Try to acquire the lock 60 minutes in the future. It should pass
-        @freeze_time('2014-02-01 01:00:00')
-        @db_mutex('lock_id')
-        def run_get_lock3():
-            self.assertFalse(DBMutex.objects.filter(id=orig_lock.id).exists())
-            self.assertEqual(DBMutex.objects.count(), 1)
-            m = DBMutex.objects.get(lock_id='lock_id')
-            self.assertEqual(m.creation_time, datetime(2014, 2, 1, 1))
+            self.assertTrue(4 * 60 < get_remaining_seconds('lock_id') <= 5 * 60)
 
-        run_get_lock3()
+        run_get_lock2()
 
     def test_lock_timeout_error(self):
         """
@@ -396,3 +513,1111 @@ class FunctionDecoratorTestCase(TestCase):
 
         with self.assertRaises(DBMutexTimeoutError):
             run_get_lock1()
+
+
+class WaitTestCase(TestCase):
+    """
+    Tests waiting for a lock with a timeout and backoff.
+    """
+    def test_no_wait_by_default(self):
+        """
+        Tests that the lock fails right away without sleeping when waiting is not enabled.
+        """
+        DBMutex.objects.create(lock_id='lock_id')
+        with mock.patch('db_mutex.db_mutex.time.sleep') as sleep:
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id'):
+                    raise NotImplementedError
+        self.assertFalse(sleep.called)
+
+    def test_timeout_implies_wait(self):
+        self.assertFalse(db_mutex('lock_id').wait)
+        self.assertTrue(db_mutex('lock_id', timeout=1).wait)
+
+    def test_wait_until_released(self):
+        """
+        Tests that a waiting lock is acquired once the holder releases it.
+        """
+        DBMutex.objects.create(lock_id='lock_id')
+
+        # Release the held lock while the waiter sleeps for the second time
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                DBMutex.objects.filter(lock_id='lock_id').delete()
+
+        with mock.patch('db_mutex.db_mutex.time.sleep', side_effect=sleep):
+            with db_mutex('lock_id', wait=True) as lock:
+                self.assertEqual(DBMutex.objects.count(), 1)
+
+        self.assertEqual(len(sleeps), 2)
+        self.assertIsNotNone(lock.acquire_time)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_wait_timeout(self):
+        """
+        Tests that a DBMutexError is raised when the lock is not released before the timeout.
+        """
+        DBMutex.objects.create(lock_id='lock_id')
+        start_time = datetime.now()
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id', timeout=0.2, poll_interval=0.01, max_poll_interval=0.05):
+                raise NotImplementedError
+        self.assertGreaterEqual((datetime.now() - start_time).total_seconds(), 0.2)
+        self.assertEqual(DBMutex.objects.count(), 1)
+
+    def test_acquire_time_without_contention(self):
+        with db_mutex('lock_id') as lock:
+            self.assertGreaterEqual(lock.acquire_time, 0)
+
+    @mock.patch('db_mutex.db_mutex.random.uniform', side_effect=lambda low, high: high)
+    def test_retry_delay_backoff(self, uniform):
+        """
+        Tests that the retry delay grows exponentially and is capped.
+        """
+        lock = db_mutex('lock_id', wait=True, poll_interval=0.1, max_poll_interval=0.5)
+        self.assertEqual(
+            [lock.get_retry_delay(attempt, 0) for attempt in range(1, 6)],
+            [0.1, 0.2, 0.4, 0.5, 0.5],
+        )
+        uniform.assert_called_with(0.25, 0.5)
+
+    @mock.patch('db_mutex.db_mutex.random.uniform', side_effect=lambda low, high: high)
+    def test_retry_delay_deadline(self, uniform):
+        """
+        Tests that the retry delay never sleeps past the timeout.
+        """
+        lock = db_mutex('lock_id', timeout=1, poll_interval=0.5)
+        self.assertEqual(lock.get_retry_delay(1, 0.25), 0.5)
+        self.assertEqual(lock.get_retry_delay(2, 0.75), 0.25)
+        self.assertIsNone(lock.get_retry_delay(3, 1))
+
+    def test_retry_delay_jitter(self):
+        lock = db_mutex('lock_id', wait=True, poll_interval=0.1)
+        for _ in range(10):
+            self.assertTrue(0.05 <= lock.get_retry_delay(1, 0) <= 0.1)
+
+
+class ManyTestCase(TestCase):
+    """
+    Tests acquiring several locks at once with db_mutex_many.
+    """
+    def get_locks(self):
+        return list(DBMutex.objects.order_by('lock_id').values_list('lock_id', 'token'))
+
+    def test_no_locks_before(self):
+        with db_mutex_many(['lock_b', 'lock_a', 'lock_b']) as lock:
+            self.assertEqual(lock.lock_ids, ['lock_a', 'lock_b'])
+            self.assertEqual(self.get_locks(), [('lock_a', lock.token), ('lock_b', lock.token)])
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    @skipUnless(supports_upsert(connection), 'INSERT ... ON CONFLICT is not supported')
+    def test_single_queries(self):
+        """
+        Tests that acquiring and releasing all of the locks each take a single query.
+        """
+        lock = db_mutex_many(['lock_a', 'lock_b', 'lock_c'])
+        with self.assertNumQueries(1):
+            lock.start()
+        with self.assertNumQueries(1):
+            lock.stop()
+
+    def test_lock_before(self):
+        """
+        Tests that none of the locks are acquired if one of them is held.
+        """
+        create_lock('lock_b', token='token')
+        with self.assertRaises(DBMutexError):
+            with db_mutex_many(['lock_a', 'lock_b', 'lock_c']):
+                raise NotImplementedError
+        self.assertEqual(self.get_locks(), [('lock_b', 'token')])
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_lock_before_without_upsert(self, supports_upsert):
+        create_lock('lock_b', token='token')
+        with self.assertRaises(DBMutexError):
+            with db_mutex_many(['lock_a', 'lock_b', 'lock_c']):
+                raise NotImplementedError
+        self.assertEqual(self.get_locks(), [('lock_b', 'token')])
+
+        with db_mutex_many(['lock_a', 'lock_c']) as lock:
+            self.assertEqual(self.get_locks(), [('lock_a', lock.token), ('lock_b', 'token'), ('lock_c', lock.token)])
+
+    def test_expired_lock_before(self):
+        create_lock('lock_b', expires_in=-1, token='token')
+        with db_mutex_many(['lock_a', 'lock_b']) as lock:
+            self.assertEqual(self.get_locks(), [('lock_a', lock.token), ('lock_b', lock.token)])
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_expired_lock_before_without_upsert(self, supports_upsert):
+        create_lock('lock_b', expires_in=-1, token='token')
+        with db_mutex_many(['lock_a', 'lock_b']) as lock:
+            self.assertEqual(self.get_locks(), [('lock_a', lock.token), ('lock_b', lock.token)])
+
+    def test_wait_until_released(self):
+        create_lock('lock_b')
+
+        def sleep(seconds):
+            DBMutex.objects.filter(lock_id='lock_b').delete()
+
+        with mock.patch('db_mutex.db_mutex.time.sleep', side_effect=sleep) as time_sleep:
+            with db_mutex_many(['lock_a', 'lock_b'], wait=True):
+                self.assertEqual(DBMutex.objects.count(), 2)
+        self.assertEqual(time_sleep.call_count, 1)
+
+    def test_lock_timeout_error(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex_many(['lock_a', 'lock_b']):
+                DBMutex.objects.filter(lock_id='lock_a').delete()
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_extend(self):
+        with db_mutex_many(['lock_a', 'lock_b'], ttl=60) as lock:
+            expire_lock('lock_a')
+            self.assertTrue(lock.extend())
+            self.assertGreater(get_remaining_seconds('lock_a'), 50)
+            DBMutex.objects.filter(lock_id='lock_b').delete()
+            self.assertFalse(lock.extend())
+            create_lock('lock_b', token=lock.token)
+
+    def test_decorator(self):
+        @db_mutex_many(['lock_a', 'lock_b'])
+        def run_get_locks():
+            return DBMutex.objects.count()
+
+        self.assertEqual(run_get_locks(), 2)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+
+class SemaphoreTestCase(TestCase):
+    """
+    Tests allowing several concurrent holders of a lock id with db_semaphore.
+    """
+    def get_locks(self):
+        return list(DBMutex.objects.order_by('lock_id').values_list('lock_id', 'token'))
+
+    def test_invalid_limit(self):
+        with self.assertRaises(ValueError):
+            db_semaphore('lock_id', limit=0)
+
+    def test_get_slot_ids(self):
+        self.assertEqual(db_semaphore('lock_id', limit=3).get_slot_ids(), ['lock_id:0', 'lock_id:1', 'lock_id:2'])
+
+    def test_limit(self):
+        """
+        Tests that the semaphore can be held by up to ``limit`` holders at the same time.
+        """
+        with db_semaphore('lock_id', limit=2) as first:
+            with db_semaphore('lock_id', limit=2) as second:
+                locks = self.get_locks()
+                self.assertEqual([lock_id for lock_id, token in locks], ['lock_id:0', 'lock_id:1'])
+                self.assertEqual({token for lock_id, token in locks}, {first.token, second.token})
+                with self.assertRaises(DBMutexError):
+                    with db_semaphore('lock_id', limit=2):
+                        raise NotImplementedError
+            with db_semaphore('lock_id', limit=2) as third:
+                self.assertEqual({token for lock_id, token in self.get_locks()}, {first.token, third.token})
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_limit_without_upsert(self, supports_upsert):
+        with db_semaphore('lock_id', limit=2):
+            with db_semaphore('lock_id', limit=2):
+                self.assertEqual(DBMutex.objects.count(), 2)
+                with self.assertRaises(DBMutexError):
+                    with db_semaphore('lock_id', limit=2):
+                        raise NotImplementedError
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    @skipUnless(supports_upsert(connection), 'INSERT ... ON CONFLICT is not supported')
+    def test_single_queries(self):
+        """
+        Tests that claiming a free slot, failing to claim a slot and releasing a slot each take a single query.
+        """
+        lock = db_semaphore('lock_id', limit=8)
+        with self.assertNumQueries(1):
+            lock.start()
+        for slot in range(7):
+            db_semaphore('lock_id', limit=8).start()
+        with self.assertNumQueries(1):
+            self.assertFalse(db_semaphore('lock_id', limit=8).try_acquire())
+        with self.assertNumQueries(1):
+            lock.stop()
+
+    def test_expired_slot(self):
+        create_lock('lock_id:0', expires_in=-1, token='token')
+        create_lock('lock_id:1', expires_in=60, token='token')
+        with db_semaphore('lock_id', limit=2) as lock:
+            self.assertEqual(self.get_locks(), [('lock_id:0', lock.token), ('lock_id:1', 'token')])
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_expired_slot_without_upsert(self, supports_upsert):
+        create_lock('lock_id:0', expires_in=-1, token='token')
+        create_lock('lock_id:1', expires_in=60, token='token')
+        with db_semaphore('lock_id', limit=2) as lock:
+            self.assertEqual(self.get_locks(), [('lock_id:0', lock.token), ('lock_id:1', 'token')])
+
+    def test_extend(self):
+        with db_semaphore('lock_id', limit=2, ttl=60) as lock:
+            slot_id = DBMutex.objects.get(token=lock.token).lock_id
+            expire_lock(slot_id)
+            self.assertTrue(lock.extend())
+            self.assertGreater(get_remaining_seconds(slot_id), 50)
+
+    def test_lock_timeout_error(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_semaphore('lock_id', limit=2):
+                DBMutex.objects.all().delete()
+
+
+class ReaderWriterTestCase(TestCase):
+    """
+    Tests shared and exclusive locking with db_rw_mutex.
+    """
+    def get_lock_ids(self):
+        return list(DBMutex.objects.order_by('lock_id').values_list('lock_id', flat=True))
+
+    def test_shared(self):
+        """
+        Tests that several readers can hold the lock at the same time.
+        """
+        with db_rw_mutex('lock_id', shared=True) as first:
+            with db_rw_mutex('lock_id', shared=True) as second:
+                self.assertEqual(
+                    self.get_lock_ids(), sorted(['lock_id:r:' + first.token, 'lock_id:r:' + second.token])
+                )
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_lock_id_too_long(self):
+        """
+        Tests that lock ids are short enough for the lock ids of readers to fit into the lock table.
+        """
+        with db_rw_mutex('a' * 221, shared=True):
+            self.assertEqual(len(self.get_lock_ids()[0]), 256)
+        with self.assertRaisesRegex(ValueError, 'at most 221 characters'):
+            db_rw_mutex('a' * 222)
+
+    def test_exclusive(self):
+        with db_rw_mutex('lock_id'):
+            self.assertEqual(self.get_lock_ids(), ['lock_id'])
+            with self.assertRaises(DBMutexError):
+                with db_rw_mutex('lock_id'):
+                    raise NotImplementedError
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_writer_excludes_readers(self):
+        with db_rw_mutex('lock_id'):
+            with self.assertRaises(DBMutexError):
+                with db_rw_mutex('lock_id', shared=True):
+                    raise NotImplementedError
+            self.assertEqual(self.get_lock_ids(), ['lock_id'])
+
+    def test_reader_excludes_writers(self):
+        """
+        Tests that a writer that does not wait releases its claim when readers hold the lock.
+        """
+        with db_rw_mutex('lock_id', shared=True) as reader:
+            with self.assertRaises(DBMutexError):
+                with db_rw_mutex('lock_id'):
+                    raise NotImplementedError
+            self.assertEqual(self.get_lock_ids(), ['lock_id:r:' + reader.token])
+
+    def test_expired_readers_ignored(self):
+        create_lock('lock_id:r:token', expires_in=-1)
+        with db_rw_mutex('lock_id'):
+            self.assertIn('lock_id', self.get_lock_ids())
+
+    def test_like_characters_in_lock_id(self):
+        """
+        Tests that wildcards of LIKE in lock ids do not match the readers of other lock ids.
+        """
+        create_lock('lockX:r:token')
+        with db_rw_mutex('lock_'):
+            pass
+        with db_rw_mutex('lock%'):
+            pass
+
+    def test_writer_preference(self):
+        """
+        Tests that a waiting writer keeps new readers out until it acquired and released the lock.
+        """
+        reader = db_rw_mutex('lock_id', shared=True)
+        reader.start()
+
+        def sleep(seconds):
+            # New readers back off while the writer waits for the current reader
+            with self.assertRaises(DBMutexError):
+                with db_rw_mutex('lock_id', shared=True):
+                    raise NotImplementedError
+            reader.stop()
+
+        with mock.patch('db_mutex.db_mutex.time.sleep', side_effect=sleep) as time_sleep:
+            with db_rw_mutex('lock_id', wait=True):
+                self.assertEqual(self.get_lock_ids(), ['lock_id'])
+        self.assertEqual(time_sleep.call_count, 1)
+
+        with db_rw_mutex('lock_id', shared=True):
+            pass
+
+    def test_writer_timeout_releases_claim(self):
+        create_lock('lock_id:r:token')
+        with self.assertRaises(DBMutexError):
+            with db_rw_mutex('lock_id', timeout=0.1, poll_interval=0.01):
+                raise NotImplementedError
+        self.assertEqual(self.get_lock_ids(), ['lock_id:r:token'])
+
+    def test_writer_claim_lease_renewed(self):
+        """
+        Tests that the lease of the claim of a waiting writer is renewed on every attempt.
+        """
+        create_lock('lock_id:r:token')
+        lock = db_rw_mutex('lock_id', wait=True, ttl=60)
+        self.assertFalse(lock.try_acquire())
+        expire_lock('lock_id')
+        self.assertFalse(lock.try_acquire())
+        self.assertGreater(get_remaining_seconds('lock_id'), 50)
+        lock.abandon()
+        self.assertEqual(self.get_lock_ids(), ['lock_id:r:token'])
+
+    def test_extend(self):
+        with db_rw_mutex('lock_id', shared=True, ttl=60) as lock:
+            expire_lock(lock.get_held_lock_id())
+            self.assertTrue(lock.extend())
+            self.assertGreater(get_remaining_seconds(lock.get_held_lock_id()), 50)
+
+    def test_lock_timeout_error(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_rw_mutex('lock_id', shared=True):
+                DBMutex.objects.all().delete()
+
+
+@skipUnless(os.path.exists('/proc/self/stat'), 'Process start markers require /proc')
+class ReclaimDeadTestCase(TestCase):
+    """
+    Tests recording the holders of locks and reclaiming the locks of dead holders.
+    """
+    def create_dead_lock(self, lock_id, **kwargs):
+        """
+        Creates a lock that does not expire and is held by a process of this host that exited.
+        """
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        hostname, process_start = holders.get_process()
+        return DBMutex.objects.create(
+            lock_id=lock_id, token='dead', hostname=hostname, pid=process.pid,
+            process_start='{0}:1'.format(process_start.rpartition(':')[0]), **kwargs
+        )
+
+    def test_holder_recorded(self):
+        holder = holders.get_holder()
+        with db_mutex('lock_id'):
+            lock = DBMutex.objects.get()
+            self.assertEqual(
+                (lock.hostname, lock.pid, lock.process_start, lock.thread),
+                (holder['hostname'], holder['pid'], holder['process_start'], holder['thread'])
+            )
+
+        # The holder is replaced when an expired lock is taken over
+        create_lock('lock_id', -60)
+        DBMutex.objects.update(hostname='other-host', pid=1)
+        with db_mutex('lock_id'):
+            self.assertEqual(DBMutex.objects.values_list('hostname', 'pid').get(), (holder['hostname'], holder['pid']))
+
+        with db_semaphore('lock_id', limit=2):
+            self.assertEqual(DBMutex.objects.get().hostname, holder['hostname'])
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_holder_recorded_without_upsert(self, supports_upsert):
+        with db_mutex('lock_id'):
+            self.assertEqual(DBMutex.objects.get().pid, os.getpid())
+        with db_semaphore('lock_id', limit=2):
+            self.assertEqual(DBMutex.objects.get().pid, os.getpid())
+
+    def test_reclaim_dead(self):
+        self.create_dead_lock('lock_id')
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id'):
+                raise NotImplementedError
+
+        with self.assertLogs('db_mutex.db_mutex', 'WARNING'):
+            with db_mutex('lock_id', reclaim_dead=True) as lock:
+                self.assertEqual(DBMutex.objects.get().token, lock.token)
+
+    def test_reclaim_dead_live_holder(self):
+        """
+        Tests that locks of live holders and of holders on other hosts are left alone.
+        """
+        with db_mutex('lock_id'):
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id', reclaim_dead=True):
+                    raise NotImplementedError
+
+        self.create_dead_lock('lock_id')
+        DBMutex.objects.update(hostname='other-host')
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id', reclaim_dead=True):
+                raise NotImplementedError
+        self.assertEqual(DBMutex.objects.get().token, 'dead')
+
+    def test_reclaim_dead_many(self):
+        self.create_dead_lock('lock_b')
+        with db_mutex_many(['lock_a', 'lock_b'], reclaim_dead=True):
+            self.assertEqual(DBMutex.objects.count(), 2)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_reclaim_dead_semaphore(self):
+        self.create_dead_lock('lock_id:0')
+        with db_semaphore('lock_id', limit=1, reclaim_dead=True) as lock:
+            self.assertEqual(DBMutex.objects.get().token, lock.token)
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            db_rw_mutex('lock_id', reclaim_dead=True)
+        with self.assertRaises(ValueError):
+            db_advisory_mutex('lock_id', reclaim_dead=True)
+
+
+class ReentrantTestCase(TestCase):
+    """
+    Tests acquiring a reentrant lock again from the thread or task that holds it.
+    """
+    def test_not_reentrant_by_default(self):
+        with db_mutex('lock_id'):
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id'):
+                    raise NotImplementedError
+
+    def test_nested(self):
+        """
+        Tests that nested acquisitions do not query the database and only the outermost exit releases the lock.
+        """
+        with db_mutex('lock_id', reentrant=True) as outer:
+            with self.assertNumQueries(0):
+                with db_mutex('lock_id', reentrant=True) as inner:
+                    with db_mutex('lock_id', reentrant=True):
+                        self.assertEqual(inner.acquire_time, 0)
+            self.assertEqual(DBMutex.objects.get().token, outer.token)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_different_lock_ids(self):
+        with db_mutex('lock_id', reentrant=True):
+            with db_mutex('lock_id2', reentrant=True):
+                self.assertEqual(DBMutex.objects.count(), 2)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_recursive_decorator(self):
+        @db_mutex('lock_id', reentrant=True)
+        def countdown(n):
+            if n:
+                countdown(n - 1)
+            return DBMutex.objects.count()
+
+        self.assertEqual(countdown(3), 1)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_other_thread(self):
+        """
+        Tests that the lock is not reentrant for other threads.
+        """
+        reentered = []
+        with db_mutex('lock_id', reentrant=True):
+            thread = Thread(target=lambda: reentered.append(db_mutex('lock_id', reentrant=True).reenter()))
+            thread.start()
+            thread.join()
+        self.assertEqual(reentered, [False])
+
+    def test_reader_writer(self):
+        """
+        Tests that readers and writers of a reader-writer lock reenter separately.
+        """
+        with db_rw_mutex('lock_id', shared=True, reentrant=True):
+            with self.assertNumQueries(0):
+                with db_rw_mutex('lock_id', shared=True, reentrant=True):
+                    pass
+            with self.assertRaises(DBMutexError):
+                with db_rw_mutex('lock_id', reentrant=True):
+                    raise NotImplementedError
+
+    async def test_async(self):
+        async with db_mutex('lock_id', reentrant=True):
+            async with db_mutex('lock_id', reentrant=True):
+                self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 1)
+            self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 1)
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+
+    async def test_spawned_task(self):
+        """
+        Tests that a task spawned by the holder of the lock does not hold the lock.
+        """
+        async def run_get_lock():
+            async with db_mutex('lock_id', reentrant=True):
+                raise NotImplementedError
+
+        async with db_mutex('lock_id', reentrant=True):
+            task = asyncio.ensure_future(run_get_lock())
+            with self.assertRaises(DBMutexError):
+                await task
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+
+
+class TransactionScopeTestCase(TransactionTestCase):
+    """
+    Tests locks that are held until the current transaction ends.
+    """
+    def is_held(self, lock_id):
+        return DBMutex.objects.filter(lock_id=lock_id).exists()
+
+    def test_invalid_scope(self):
+        with self.assertRaises(ValueError):
+            db_mutex('lock_id', scope='session')
+        with self.assertRaises(ValueError):
+            db_mutex_many(['lock_id'], scope='transaction')
+
+    def test_requires_atomic_block(self):
+        with self.assertRaises(TransactionManagementError):
+            with db_mutex('lock_id', scope='transaction'):
+                raise NotImplementedError
+
+    def test_released_on_commit(self):
+        with transaction.atomic():
+            lock = db_mutex('lock_id', scope='transaction', heartbeat=True, ttl=60)
+            with lock:
+                self.assertTrue(self.is_held('lock_id'))
+                self.assertIsNone(lock.heartbeat_thread)
+            self.assertTrue(self.is_held('lock_id'))
+        self.assertFalse(self.is_held('lock_id'))
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_released_on_rollback(self):
+        with self.assertRaises(NotImplementedError):
+            with transaction.atomic():
+                with db_mutex('lock_id', scope='transaction'):
+                    raise NotImplementedError
+        self.assertFalse(self.is_held('lock_id'))
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_no_release_query(self):
+        with transaction.atomic():
+            lock = db_mutex('lock_id', scope='transaction')
+            lock.start()
+            with self.assertNumQueries(0):
+                lock.stop()
+
+    def test_lock_before(self):
+        """
+        Tests that a lock held by another connection cannot be acquired.
+        """
+        create_lock('lock_id')
+        with transaction.atomic():
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id', scope='transaction'):
+                    raise NotImplementedError
+
+    def test_excludes_locks_without_scope(self):
+        """
+        Tests that a lock with the transaction scope excludes a lock of the same lock id without it.
+        """
+        with transaction.atomic():
+            with db_mutex('lock_id', scope='transaction'):
+                with self.assertRaises(DBMutexError):
+                    with db_mutex('lock_id'):
+                        raise NotImplementedError
+        self.assertFalse(self.is_held('lock_id'))
+
+    def test_decorator(self):
+        @transaction.atomic
+        @db_mutex('lock_id', scope='transaction')
+        def run_get_lock():
+            return self.is_held('lock_id')
+
+        self.assertTrue(run_get_lock())
+        self.assertFalse(self.is_held('lock_id'))
+
+    def hold_in_other_transaction(self, lock_id):
+        """
+        Acquires a lock in an open transaction of another connection.
+        """
+        other_connection = connections.create_connection('default')
+        other_connection.set_autocommit(False)
+        self.addCleanup(other_connection.close)
+        self.addCleanup(other_connection.rollback)
+        self.assertTrue(DBMutex.objects.acquire(lock_id, 'token', 60, connection=other_connection))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+    def test_held_in_other_transaction(self):
+        """
+        Tests that a lock held by another open transaction fails right away and leaves the transaction usable.
+        """
+        self.hold_in_other_transaction('lock_id')
+        with transaction.atomic():
+            start_time = time.monotonic()
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id', scope='transaction'):
+                    raise NotImplementedError
+            self.assertLess(time.monotonic() - start_time, 1)
+            self.assertFalse(self.is_held('lock_id'))
+            with db_mutex('lock_id2', scope='transaction'):
+                self.assertTrue(self.is_held('lock_id2'))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+    def test_held_in_other_transaction_timeout(self):
+        self.hold_in_other_transaction('lock_id')
+        with transaction.atomic():
+            start_time = time.monotonic()
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id', scope='transaction', timeout=0.2, poll_interval=0.05):
+                    raise NotImplementedError
+            self.assertLess(time.monotonic() - start_time, 1)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT current_setting('lock_timeout')")
+                self.assertEqual(cursor.fetchone()[0], '0')
+
+
+class HeartbeatTestCase(TransactionTestCase):
+    """
+    Tests renewing the lease of a lock with a heartbeat. The heartbeat uses its own database connection,
+    so these tests do not run inside of a transaction.
+    """
+    def test_extend(self):
+        with db_mutex('lock_id', ttl=60) as lock:
+            expire_lock('lock_id')
+            self.assertTrue(lock.extend())
+            self.assertTrue(50 < get_remaining_seconds('lock_id') <= 60)
+
+    def test_extend_lost_lock(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex('lock_id') as lock:
+                DBMutex.objects.all().delete()
+                self.assertFalse(lock.extend())
+
+    def test_heartbeat(self):
+        """
+        Tests that the lease of the lock is renewed while the lock is held.
+        """
+        with db_mutex('lock_id', ttl=0.3, heartbeat=True) as lock:
+            self.assertTrue(lock.heartbeat_thread.is_alive())
+            time.sleep(1)
+            self.assertGreater(get_remaining_seconds('lock_id'), 0)
+        self.assertIsNone(lock.heartbeat_thread)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_heartbeat_closes_connections(self):
+        """
+        Tests that the heartbeat thread closes its connections when it finishes.
+        """
+        with mock.patch('db_mutex.db_mutex.connections') as heartbeat_connections:
+            with db_mutex('lock_id', ttl=60, heartbeat=True):
+                pass
+        heartbeat_connections.close_all.assert_called_once_with()
+
+    def test_no_heartbeat_by_default(self):
+        with db_mutex('lock_id') as lock:
+            self.assertIsNone(lock.heartbeat_thread)
+
+    @override_settings(DB_MUTEX_TTL_SECONDS=None)
+    def test_no_heartbeat_without_ttl(self):
+        with db_mutex('lock_id', heartbeat=True) as lock:
+            self.assertIsNone(lock.heartbeat_thread)
+
+    def test_heartbeat_lost_lock(self):
+        """
+        Tests that the heartbeat stops when the lock is lost.
+        """
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex('lock_id', ttl=0.3, heartbeat=True) as lock:
+                DBMutex.objects.all().delete()
+                with mock.patch('db_mutex.db_mutex.LOG') as log:
+                    lock.heartbeat_thread.join(5)
+                self.assertFalse(lock.heartbeat_thread.is_alive())
+                log.error.assert_called_once_with('Lock lock_id expired before its lease could be renewed')
+
+    def test_heartbeat_database_error(self):
+        """
+        Tests that the heartbeat keeps renewing the lease after a database error.
+        """
+        with db_mutex('lock_id', ttl=0.15, heartbeat=True) as lock:
+            with mock.patch.object(lock, 'extend', side_effect=chain([DatabaseError], repeat(True))) as extend:
+                with mock.patch('db_mutex.db_mutex.LOG') as log:
+                    time.sleep(0.4)
+            self.assertGreaterEqual(extend.call_count, 2)
+            log.exception.assert_called_once_with('Could not renew the lease of lock lock_id')
+
+
+class AsyncTestCase(TestCase):
+    """
+    Tests db_mutex as an async context manager and a coroutine function decorator.
+    """
+    async def test_no_lock_before(self):
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+        async with db_mutex('lock_id') as lock:
+            self.assertEqual((await sync_to_async(DBMutex.objects.get)(lock_id='lock_id')).token, lock.token)
+            self.assertIsNotNone(lock.acquire_time)
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+
+    async def test_lock_before(self):
+        await sync_to_async(DBMutex.objects.create)(lock_id='lock_id')
+        with self.assertRaises(DBMutexError):
+            async with db_mutex('lock_id'):
+                raise NotImplementedError
+        self.assertTrue(await sync_to_async(DBMutex.objects.filter(lock_id='lock_id').exists)())
+
+    async def test_lock_timeout_error(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            async with db_mutex('lock_id'):
+                await sync_to_async(DBMutex.objects.all().delete)()
+
+    async def test_decorator(self):
+        @db_mutex('lock_id')
+        async def run_get_lock():
+            return await sync_to_async(DBMutex.objects.count)()
+
+        self.assertTrue(asyncio.iscoroutinefunction(run_get_lock))
+        self.assertEqual(await run_get_lock(), 1)
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+
+    async def test_decorator_lock_before(self):
+        await sync_to_async(DBMutex.objects.create)(lock_id='lock_id')
+
+        @db_mutex('lock_id')
+        async def run_get_lock():
+            raise NotImplementedError
+
+        with self.assertRaises(DBMutexError):
+            await run_get_lock()
+
+    async def test_decorator_suppress_acquisition_exceptions(self):
+        await sync_to_async(DBMutex.objects.create)(lock_id='lock_id')
+
+        @db_mutex('lock_id', suppress_acquisition_exceptions=True)
+        async def run_get_lock():
+            raise NotImplementedError
+
+        self.assertIsNone(await run_get_lock())
+
+    async def test_decorator_concurrent_calls(self):
+        """
+        Tests that concurrent calls of a decorated coroutine function acquire the lock separately.
+        """
+        @db_mutex('lock_id')
+        async def run_get_lock(seconds):
+            await asyncio.sleep(seconds)
+
+        results = await asyncio.gather(run_get_lock(0.2), run_get_lock(0), return_exceptions=True)
+        self.assertEqual(sorted(type(result).__name__ for result in results), ['DBMutexError', 'NoneType'])
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+
+    async def test_wait_until_released(self):
+        """
+        Tests that waiting for a lock sleeps with asyncio and acquires the lock once it is released.
+        """
+        await sync_to_async(DBMutex.objects.create)(lock_id='lock_id')
+
+        async def sleep(seconds):
+            await sync_to_async(DBMutex.objects.filter(lock_id='lock_id').delete)()
+
+        with mock.patch('db_mutex.db_mutex.asyncio.sleep', side_effect=sleep) as asyncio_sleep:
+            async with db_mutex('lock_id', wait=True):
+                self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 1)
+        self.assertEqual(asyncio_sleep.call_count, 1)
+
+    async def test_wait_timeout(self):
+        await sync_to_async(DBMutex.objects.create)(lock_id='lock_id')
+        with self.assertRaises(DBMutexError):
+            async with db_mutex('lock_id', timeout=0.1, poll_interval=0.01):
+                raise NotImplementedError
+
+    async def test_cancel_while_acquiring(self):
+        """
+        Tests that a lock acquired by an attempt that was running when the task was cancelled is released.
+        """
+        attempting = Event()
+        try_acquire = db_mutex.try_acquire
+
+        def slow_try_acquire(lock):
+            attempting.set()
+            time.sleep(0.2)
+            return try_acquire(lock)
+
+        lock = db_mutex('lock_id')
+        with mock.patch.object(db_mutex, 'try_acquire', autospec=True, side_effect=slow_try_acquire):
+            task = asyncio.ensure_future(lock.astart())
+            await sync_to_async(attempting.wait, thread_sensitive=False)()
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 0)
+        async with db_mutex('lock_id'):
+            pass
+
+    async def test_advisory_mutex_unsupported(self):
+        """
+        Tests that concurrent tasks cannot both take an advisory lock on the connection that they share.
+        """
+        @db_advisory_mutex('lock_id')
+        async def run_get_lock():
+            await asyncio.sleep(0.1)
+
+        results = await asyncio.gather(run_get_lock(), run_get_lock(), return_exceptions=True)
+        self.assertEqual([type(result) for result in results], [NotImplementedError, NotImplementedError])
+
+    async def test_heartbeat(self):
+        """
+        Tests that the lease of a lock acquired from async code is renewed by a task.
+        """
+        async with db_mutex('lock_id', ttl=0.3, heartbeat=True) as lock:
+            self.assertIsNone(lock.heartbeat_thread)
+            self.assertFalse(lock.heartbeat_task.done())
+            await asyncio.sleep(1)
+            self.assertGreater(await sync_to_async(get_remaining_seconds)('lock_id'), 0)
+        self.assertIsNone(lock.heartbeat_task)
+
+    async def test_heartbeat_lost_lock(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            async with db_mutex('lock_id', ttl=0.3, heartbeat=True) as lock:
+                await sync_to_async(DBMutex.objects.all().delete)()
+                with mock.patch('db_mutex.db_mutex.LOG') as log:
+                    await asyncio.wait_for(lock.heartbeat_task, 5)
+                log.error.assert_called_once_with('Lock lock_id expired before its lease could be renewed')
+
+    async def test_heartbeat_database_error(self):
+        async with db_mutex('lock_id', ttl=0.15, heartbeat=True) as lock:
+            with mock.patch.object(lock, 'extend', side_effect=chain([DatabaseError], repeat(True))) as extend:
+                with mock.patch('db_mutex.db_mutex.LOG') as log:
+                    await asyncio.sleep(0.4)
+            self.assertGreaterEqual(extend.call_count, 2)
+            log.exception.assert_called_once_with('Could not renew the lease of lock lock_id')
+
+
+class NotifyTestCase(TestCase):
+    """
+    Tests the database independent parts of waking up waiters with LISTEN/NOTIFY.
+    """
+    def test_get_notify_channel(self):
+        channel = postgres.get_notify_channel('lock_id' * 100)
+        self.assertTrue(channel.startswith('db_mutex_'))
+        self.assertLessEqual(len(channel), 63)
+        self.assertEqual(channel, postgres.get_notify_channel('lock_id' * 100))
+        self.assertNotEqual(channel, postgres.get_notify_channel('lock_id'))
+
+    def test_notify_disabled_by_default(self):
+        self.assertFalse(db_mutex('lock_id').get_notify_enabled())
+
+    @override_settings(DB_MUTEX_NOTIFY=True)
+    def test_notify_enabled(self):
+        self.assertEqual(db_mutex('lock_id').get_notify_enabled(), connection.vendor == 'postgresql')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'LISTEN/NOTIFY requires PostgreSQL')
+@override_settings(DB_MUTEX_NOTIFY=True)
+class PostgresNotifyTestCase(TransactionTestCase):
+    """
+    Tests waking up waiters with LISTEN/NOTIFY. Notifications are only delivered when transactions
+    commit, so these tests do not run inside of a transaction.
+    """
+    def release_later(self, lock, seconds):
+        def release():
+            lock.stop()
+            connection.close()
+
+        timer = Timer(seconds, release)
+        timer.start()
+        return timer
+
+    def test_wait_for_notify_timeout(self):
+        channel = postgres.get_notify_channel('lock_id')
+        postgres.listen(connection, channel)
+        self.assertFalse(postgres.wait_for_notify(connection, channel, 0.01))
+        postgres.unlisten(connection, channel)
+
+    def test_wait_for_notify(self):
+        channel = postgres.get_notify_channel('lock_id')
+        postgres.listen(connection, channel)
+        postgres.notify(connection, channel)
+        self.assertTrue(postgres.wait_for_notify(connection, channel, 5))
+        postgres.unlisten(connection, channel)
+
+    @skipUnless(connection.Database.__name__ == 'psycopg2', 'Notifications are only kept apart with psycopg2')
+    def test_other_notifications_kept(self):
+        """
+        Tests that waiting for the release of a lock leaves the notifications of the application alone.
+        """
+        channel = postgres.get_notify_channel('lock_id')
+        postgres.listen(connection, channel)
+        postgres.listen(connection, 'app_channel')
+        postgres.notify(connection, 'app_channel')
+        postgres.notify(connection, postgres.get_notify_channel('lock_id2'))
+        self.assertFalse(postgres.wait_for_notify(connection, channel, 0.05))
+        self.assertEqual([notification.channel for notification in connection.connection.notifies], ['app_channel'])
+        postgres.unlisten(connection, 'app_channel')
+        postgres.unlisten(connection, channel)
+
+    def test_waiter_notified_on_release(self):
+        """
+        Tests that a waiter acquires the lock as soon as it is released instead of after its poll interval.
+        """
+        holder = db_mutex('lock_id')
+        holder.start()
+        timer = self.release_later(holder, 0.2)
+
+        start_time = datetime.now()
+        with db_mutex('lock_id', timeout=30, poll_interval=20, max_poll_interval=20) as lock:
+            self.assertEqual(DBMutex.objects.count(), 1)
+            self.assertFalse(lock.listening)
+        timer.join()
+
+        self.assertLess((datetime.now() - start_time).total_seconds(), 10)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_advisory_waiter_notified_on_release(self):
+        """
+        Tests that waiters for advisory locks are notified when the lock is released. Advisory locks
+        are held by a connection, so the holder acquires and releases the lock in its own thread.
+        """
+        acquired = Event()
+
+        def hold():
+            with db_advisory_mutex('lock_id'):
+                acquired.set()
+                time.sleep(0.2)
+            connection.close()
+
+        holder = Thread(target=hold)
+        holder.start()
+        acquired.wait()
+
+        start_time = datetime.now()
+        with db_advisory_mutex('lock_id', timeout=30, poll_interval=20, max_poll_interval=20):
+            pass
+        holder.join()
+
+        self.assertLess((datetime.now() - start_time).total_seconds(), 10)
+
+    def test_fallback_poll(self):
+        """
+        Tests that waiters still poll for the lock when the release is not announced.
+        """
+        DBMutex.objects.create(lock_id='lock_id')
+        timer = Timer(0.1, lambda: (DBMutex.objects.all().delete(), connection.close()))
+        timer.start()
+        with db_mutex('lock_id', timeout=30, poll_interval=0.2, max_poll_interval=0.2):
+            pass
+        timer.join()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Advisory locks require PostgreSQL')
+class AdvisoryMutexTestCase(TestCase):
+    """
+    Tests db_advisory_mutex as a context manager and a function decorator.
+    """
+    def setUp(self):
+        # Advisory locks are reentrant for the connection holding them, so contention is tested
+        # with a second connection
+        self.other_connection = connections.create_connection('default')
+
+    def tearDown(self):
+        self.other_connection.close()
+
+    def run_from_other_connection(self, function, lock_id):
+        with self.other_connection.cursor() as cursor:
+            cursor.execute('SELECT {0}(%s)'.format(function), [db_advisory_mutex(lock_id).get_advisory_lock_key()])
+            return cursor.fetchone()[0]
+
+    def lock_from_other_connection(self, lock_id):
+        self.run_from_other_connection('pg_advisory_lock', lock_id)
+
+    def is_locked_from_other_connection(self, lock_id):
+        acquired = self.run_from_other_connection('pg_try_advisory_lock', lock_id)
+        if acquired:
+            self.run_from_other_connection('pg_advisory_unlock', lock_id)
+        return not acquired
+
+    def test_get_advisory_lock_key(self):
+        """
+        Tests that lock ids hash to stable and distinct signed 64 bit keys.
+        """
+        key = db_advisory_mutex('lock_id').get_advisory_lock_key()
+        self.assertEqual(key, db_advisory_mutex('lock_id').get_advisory_lock_key())
+        self.assertNotEqual(key, db_advisory_mutex('lock_id2').get_advisory_lock_key())
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
+
+    def test_no_lock_before(self):
+        """
+        Tests that a lock is succesfully acquired and released without touching the lock table.
+        """
+        with db_advisory_mutex('lock_id'):
+            self.assertTrue(self.is_locked_from_other_connection('lock_id'))
+            self.assertEqual(DBMutex.objects.count(), 0)
+        self.assertFalse(self.is_locked_from_other_connection('lock_id'))
+
+    def test_lock_before(self):
+        """
+        Tests when the lock is already held by another connection.
+        """
+        self.lock_from_other_connection('lock_id')
+        with self.assertRaises(DBMutexError):
+            with db_advisory_mutex('lock_id'):
+                raise NotImplementedError
+        # The other connection should still hold the lock
+        self.assertTrue(self.run_from_other_connection('pg_advisory_unlock', 'lock_id'))
+
+    def test_lock_different_id(self):
+        """
+        Tests that the lock still works even when another lock with a different id is held.
+        """
+        self.lock_from_other_connection('lock_id')
+
+        @db_advisory_mutex('lock_id2')
+        def run_get_lock():
+            return True
+
+        self.assertTrue(run_get_lock())
+
+    def test_lock_before_suppress_acquisition_exceptions(self):
+        """
+        Tests that acquisition errors are suppressed when decorating a function.
+        """
+        self.lock_from_other_connection('lock_id')
+
+        @db_advisory_mutex('lock_id', suppress_acquisition_exceptions=True)
+        def run_get_lock():
+            raise NotImplementedError
+
+        run_get_lock()
+
+    def test_shared(self):
+        """
+        Tests that shared locks can be held by several connections and exclude the exclusive lock.
+        """
+        self.run_from_other_connection('pg_advisory_lock_shared', 'lock_id')
+        with self.assertRaises(DBMutexError):
+            with db_advisory_mutex('lock_id'):
+                raise NotImplementedError
+        with db_advisory_mutex('lock_id', shared=True):
+            self.assertTrue(self.run_from_other_connection('pg_advisory_unlock_shared', 'lock_id'))
+            self.assertTrue(self.is_locked_from_other_connection('lock_id'))
+        self.assertFalse(self.is_locked_from_other_connection('lock_id'))
+
+    def test_lock_timeout_error(self):
+        """
+        Tests the case when the lock is released while the context manager is executing.
+        """
+        with self.assertRaises(DBMutexTimeoutError):
+            lock = db_advisory_mutex('lock_id')
+            with lock:
+                # Release the lock before the context manager finishes
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_unlock(%s)', [lock.get_advisory_lock_key()])
+
+
+@skipIf(connection.vendor == 'postgresql', 'Advisory locks are supported on PostgreSQL')
+class AdvisoryMutexUnsupportedTestCase(TestCase):
+    """
+    Tests db_advisory_mutex on databases other than PostgreSQL.
+    """
+    def test_improperly_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            with db_advisory_mutex('lock_id'):
+                raise NotImplementedError
@@ -0,0 +1,72 @@
+import os
+import subprocess
+import sys
+import threading
+from unittest import mock, skipUnless
+
+from db_mutex import holders
+
+from django.test import SimpleTestCase
+
+
+def get_dead_pid():
+    """
+    Returns the pid of a process that exited.
+    """
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    return process.pid
+
+
+@skipUnless(os.path.exists('/proc/self/stat'), 'Process start markers require /proc')
+class HoldersTestCase(SimpleTestCase):
+    """
+    Tests identifying the holders of locks and telling whether they died.
+    """
+    def test_get_holder(self):
+        holder = holders.get_holder()
+        self.assertEqual(holder['pid'], os.getpid())
+        self.assertEqual(holder['thread'], threading.current_thread().name)
+        self.assertEqual(holder['process_start'].count(':'), 3)
+        self.assertEqual(holder['process_start'].rpartition(':')[0], holders.get_host_marker())
+        self.assertIs(holders.get_process(), holders.get_process())
+
+    def test_is_dead(self):
+        hostname, process_start = holders.get_process()
+        host_marker = process_start.rpartition(':')[0]
+        self.assertFalse(holders.is_dead(hostname, os.getpid(), process_start))
+        self.assertTrue(holders.is_dead(hostname, get_dead_pid(), '{0}:1'.format(host_marker)))
+        # The pid was reused by a process that started later
+        self.assertTrue(holders.is_dead(hostname, os.getpid(), '{0}:1'.format(host_marker)))
+
+    def test_is_dead_not_provable(self):
+        hostname, process_start = holders.get_process()
+        dead_pid = get_dead_pid()
+        host_marker = process_start.rpartition(':')[0]
+        self.assertFalse(holders.is_dead('other-host', dead_pid, '{0}:1'.format(host_marker)))
+        self.assertFalse(holders.is_dead(hostname, None, ''))
+        self.assertFalse(holders.is_dead(hostname, dead_pid, ''))
+        # The holder ran in another pid namespace or before a reboot
+        self.assertFalse(holders.is_dead(hostname, dead_pid, 'other-boot:pid:[1]:1'))
+        with mock.patch('db_mutex.holders.get_start_time', side_effect=PermissionError):
+            self.assertFalse(holders.is_dead(hostname, dead_pid, '{0}:1'.format(host_marker)))
+
+
+class NoProcTestCase(SimpleTestCase):
+    """
+    Tests that holders are never considered dead without /proc.
+    """
+    def setUp(self):
+        patcher = mock.patch.dict(holders.process_cache, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('db_mutex.holders.read_file', side_effect=FileNotFoundError)
+    def test_no_proc(self, read_file):
+        hostname, process_start = holders.get_process()
+        self.assertEqual(process_start, '')
+        self.assertFalse(holders.is_dead(hostname, 1, 'boot:pid:[1]:1'))
+
+    @mock.patch('db_mutex.holders.get_start_time', side_effect=PermissionError)
+    def test_unreadable_start_time(self, get_start_time):
+        self.assertEqual(holders.get_process()[1], '')
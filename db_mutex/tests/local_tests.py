@@ -0,0 +1,177 @@
+from threading import Event, Thread, Timer
+import asyncio
+import time
+
+from db_mutex.db_mutex import db_mutex, db_rw_mutex, db_semaphore
+from db_mutex.exceptions import DBMutexError
+from db_mutex.local import LocalLocks, local_locks
+from db_mutex.models import DBMutex
+
+from asgiref.sync import sync_to_async
+from django.test import SimpleTestCase, TestCase
+
+
+class LocalLocksTestCase(SimpleTestCase):
+    """
+    Tests the process local registry of held locks.
+    """
+    def setUp(self):
+        self.local_locks = LocalLocks()
+
+    def test_acquire_release(self):
+        self.assertTrue(self.local_locks.acquire('key', timeout=0))
+        self.assertEqual(self.local_locks.get_holders('key'), 1)
+        self.assertFalse(self.local_locks.acquire('key', timeout=0))
+        self.assertTrue(self.local_locks.acquire('key2', timeout=0))
+        self.local_locks.release('key')
+        self.assertEqual(self.local_locks.get_holders('key'), 0)
+        self.assertTrue(self.local_locks.acquire('key', timeout=0))
+
+    def test_limit(self):
+        self.assertTrue(self.local_locks.acquire('key', limit=2, timeout=0))
+        self.assertTrue(self.local_locks.acquire('key', limit=2, timeout=0))
+        self.assertFalse(self.local_locks.acquire('key', limit=2, timeout=0))
+
+    def test_timeout(self):
+        self.local_locks.acquire('key')
+        start_time = time.monotonic()
+        self.assertFalse(self.local_locks.acquire('key', timeout=0.1))
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.1)
+
+    def test_release_wakes_up_waiter(self):
+        """
+        Tests that a thread waiting for a lock acquires it as soon as the holder releases it.
+        """
+        self.local_locks.acquire('key')
+        acquired = []
+        thread = Thread(target=lambda: acquired.append(self.local_locks.acquire('key', timeout=5)))
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(acquired, [])
+        self.local_locks.release('key')
+        thread.join()
+        self.assertEqual(acquired, [True])
+        self.assertEqual(self.local_locks.get_holders('key'), 1)
+
+    def test_cancel(self):
+        """
+        Tests that cancelling a waiting thread wakes it up without registering it.
+        """
+        self.local_locks.acquire('key')
+        cancelled = Event()
+        acquired = []
+        thread = Thread(target=lambda: acquired.append(self.local_locks.acquire('key', cancelled=cancelled)))
+        thread.start()
+        time.sleep(0.05)
+        self.local_locks.cancel('key', cancelled)
+        thread.join(5)
+        self.assertEqual(acquired, [False])
+        self.assertEqual(self.local_locks.get_holders('key'), 1)
+
+    def test_entries_discarded(self):
+        self.local_locks.acquire('key')
+        self.local_locks.acquire('key2', timeout=0.01)
+        self.local_locks.release('key')
+        self.local_locks.release('key2')
+        self.assertEqual(self.local_locks.entries, {})
+
+
+class LocalMutexTestCase(TestCase):
+    """
+    Tests contending for a lock with threads of the same process through the local registry.
+    """
+    def hold_locally(self, lock):
+        """
+        Registers a lock as if another thread of the process held it.
+        """
+        local_locks.acquire(lock.get_local_key(), lock.get_local_limit())
+        self.addCleanup(self.release_locally, lock.get_local_key())
+
+    def release_locally(self, key):
+        if local_locks.get_holders(key):
+            local_locks.release(key)
+
+    def test_local_disabled_by_default(self):
+        lock = db_mutex('lock_id')
+        with lock:
+            self.assertEqual(local_locks.get_holders(lock.get_local_key()), 0)
+
+    def test_local(self):
+        lock = db_mutex('lock_id', local=True)
+        with lock:
+            self.assertEqual(local_locks.get_holders(lock.get_local_key()), 1)
+            self.assertEqual(DBMutex.objects.count(), 1)
+        self.assertEqual(local_locks.get_holders(lock.get_local_key()), 0)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_held_locally(self):
+        """
+        Tests that a lock held by another thread of the process fails without querying the database.
+        """
+        self.hold_locally(db_mutex('lock_id'))
+        with self.assertNumQueries(0):
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id', local=True):
+                    raise NotImplementedError
+
+    def test_held_locally_timeout(self):
+        self.hold_locally(db_mutex('lock_id'))
+        with self.assertNumQueries(0):
+            with self.assertRaises(DBMutexError):
+                with db_mutex('lock_id', local=True, timeout=0.1):
+                    raise NotImplementedError
+
+    def test_wait_until_released_locally(self):
+        """
+        Tests that a waiting thread queries the database only once the other thread released the lock.
+        """
+        lock = db_mutex('lock_id', local=True, wait=True)
+        self.hold_locally(lock)
+        Timer(0.1, local_locks.release, [lock.get_local_key()]).start()
+        with lock:
+            self.assertGreaterEqual(lock.acquire_time, 0.1)
+        self.assertEqual(local_locks.get_holders(lock.get_local_key()), 0)
+
+    def test_released_locally_when_held_in_database(self):
+        DBMutex.objects.create(lock_id='lock_id')
+        lock = db_mutex('lock_id', local=True)
+        with self.assertRaises(DBMutexError):
+            with lock:
+                raise NotImplementedError
+        self.assertEqual(local_locks.get_holders(lock.get_local_key()), 0)
+
+    def test_semaphore_limit(self):
+        self.hold_locally(db_semaphore('lock_id', limit=2))
+        with db_semaphore('lock_id', limit=2, local=True):
+            with self.assertRaises(DBMutexError):
+                with db_semaphore('lock_id', limit=2, local=True):
+                    raise NotImplementedError
+
+    def test_shared_readers(self):
+        with db_rw_mutex('lock_id', shared=True, local=True):
+            with db_rw_mutex('lock_id', shared=True, local=True):
+                self.assertEqual(DBMutex.objects.count(), 2)
+
+    async def test_async_held_locally(self):
+        lock = db_mutex('lock_id', local=True, wait=True)
+        self.hold_locally(lock)
+        Timer(0.1, local_locks.release, [lock.get_local_key()]).start()
+        async with lock:
+            self.assertEqual(await sync_to_async(DBMutex.objects.count)(), 1)
+        self.assertEqual(local_locks.get_holders(lock.get_local_key()), 0)
+
+    async def test_async_cancel_waiter(self):
+        """
+        Tests that cancelling a task that waits for another thread of the process does not keep the lock
+        registered.
+        """
+        lock = db_mutex('lock_id', local=True, wait=True)
+        self.hold_locally(lock)
+        task = asyncio.ensure_future(lock.astart())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(task, 5)
+        local_locks.release(lock.get_local_key())
+        self.assertEqual(local_locks.get_holders(lock.get_local_key()), 0)
+        self.assertEqual(local_locks.entries, {})
@@ -0,0 +1,257 @@
+import csv
+import tempfile
+from io import StringIO
+from unittest import mock, skipIf, skipUnless
+
+from db_mutex import postgres, signals
+from db_mutex.db_mutex import db_mutex
+from db_mutex.management.commands.benchmark_locks import get_hand_off_times, get_percentile
+from db_mutex.management.commands.stress_locks import find_early_expirations, find_overlaps
+from db_mutex.models import DBMutex, get_expiration_time
+
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase
+
+
+class DeleteExpiredLocksTestCase(TestCase):
+    """
+    Tests the delete_expired_locks management command.
+    """
+    def setUp(self):
+        for i in range(5):
+            DBMutex.objects.create(lock_id='expired_{0}'.format(i), expires_at=get_expiration_time(-60))
+        DBMutex.objects.create(lock_id='lock_id', expires_at=get_expiration_time(60))
+        DBMutex.objects.create(lock_id='lock_id2')
+
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command('delete_expired_locks', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_delete_expired_locks(self):
+        self.assertEqual(self.call_command(), 'Deleted 5 expired locks\n')
+        self.assertEqual(
+            list(DBMutex.objects.order_by('lock_id').values_list('lock_id', flat=True)), ['lock_id', 'lock_id2']
+        )
+
+    def test_delete_expired_locks_in_batches(self):
+        self.assertEqual(self.call_command('--batch-size', '2'), 'Deleted 5 expired locks\n')
+        self.assertEqual(DBMutex.objects.count(), 2)
+
+
+def skip_in_memory_db(test_case):
+    """
+    Skips a test whose worker threads write to the database if it is a shared in-memory SQLite database,
+    which reports a locked table to concurrent writers instead of waiting for them.
+    """
+    if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+        test_case.skipTest('Threads cannot write to a shared in-memory SQLite database at the same time')
+
+
+class BenchmarkLocksTestCase(TransactionTestCase):
+    """
+    Tests the benchmark_locks management command. The worker threads commit their locks, so these tests
+    do not run inside of a transaction.
+    """
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command('benchmark_locks', '--threads', '2', '--iterations', '5', '--poll-interval', '0.001', *args,
+                     stdout=stdout)
+        return stdout.getvalue()
+
+    def test_benchmark_locks(self):
+        skip_in_memory_db(self)
+        output = self.call_command()
+        self.assertIn('Single lock, 1 processes x 2 threads x 5 iterations\n', output)
+        self.assertIn('Distinct locks, 1 processes x 2 threads x 5 iterations\n', output)
+        self.assertEqual(output.count('Failed acquisitions: 0\n'), 2)
+        self.assertIn('Queries per acquire: ', output)
+        self.assertEqual(DBMutex.objects.count(), 0)
+        self.assertFalse(signals.lock_acquired.has_listeners(db_mutex))
+
+    def test_backend(self):
+        output = self.call_command('--scenario', 'single', '--backend', 'db_mutex.backends.MemoryBackend')
+        self.assertIn('Queries per acquire: 0.00\n', output)
+        self.assertNotIn('Distinct', output)
+
+    def test_database_errors(self):
+        stdout = StringIO()
+        with mock.patch.object(db_mutex, 'start', side_effect=DatabaseError):
+            with self.assertRaisesRegex(CommandError, 'incomplete because of 10 database errors'):
+                call_command('benchmark_locks', '--scenario', 'single', '--threads', '2', '--iterations', '5',
+                             stdout=stdout)
+        self.assertIn('Failed acquisitions: 0\n  Database errors: 10\n', stdout.getvalue())
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            self.call_command('--threads', '0')
+
+    @skipUnless(connection.vendor == 'sqlite', 'Tests run on an in-memory SQLite database')
+    def test_processes_in_memory_db(self):
+        with self.assertRaises(CommandError):
+            self.call_command('--processes', '2')
+
+    @skipIf(connection.vendor == 'sqlite', 'Processes cannot share an in-memory SQLite database')
+    def test_processes(self):
+        output = self.call_command('--processes', '2')
+        self.assertIn('Single lock, 2 processes x 2 threads x 5 iterations\n', output)
+        self.assertEqual(output.count('Failed acquisitions: 0\n'), 2)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_get_percentile(self):
+        self.assertIsNone(get_percentile([], 50))
+        self.assertEqual(get_percentile([3, 1, 2, 4], 50), 2)
+        self.assertEqual(get_percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(get_percentile([5], 99), 5)
+
+    def test_get_hand_off_times(self):
+        samples = [
+            ('a', 0, 1, 2),
+            # Waited for the previous holder
+            ('a', 1.5, 3, 4),
+            # Did not wait
+            ('a', 5, 5, 6),
+            ('b', 0, 3.5, 4),
+        ]
+        self.assertEqual(get_hand_off_times(samples), [1])
+
+
+class StressLocksTestCase(TransactionTestCase):
+    """
+    Tests the stress_locks management command.
+    """
+    def call_command(self, *args, stdout=None):
+        stdout = stdout or StringIO()
+        call_command(
+            'stress_locks', '--processes', '1', '--threads', '3', '--locks', '2', '--iterations', '5', '--ttl', '0.05',
+            '--hold', '0', *args, stdout=stdout
+        )
+        return stdout.getvalue()
+
+    def test_stress_locks(self):
+        skip_in_memory_db(self)
+        with tempfile.NamedTemporaryFile(mode='r') as log_file:
+            output = self.call_command('--overrun', '0.5', '--log', log_file.name)
+            records = list(csv.DictReader(log_file))
+        self.assertIn('Held 15 locks of 2 lock ids in 1 processes x 3 threads\n', output)
+        self.assertIn('Database errors: 0\n', output)
+        self.assertIn('Overlapping holders: 0\n', output)
+        self.assertIn('Taken over before expiring: 0\n', output)
+        self.assertEqual(len(records), 15)
+        self.assertEqual({record['lock_id'] for record in records} - {'db_mutex_stress:0', 'db_mutex_stress:1'}, set())
+
+    def test_database_errors(self):
+        stdout = StringIO()
+        with mock.patch.object(db_mutex, 'stop', side_effect=DatabaseError):
+            with self.assertRaisesRegex(CommandError, 'incomplete because of 15 database errors'):
+                self.call_command(stdout=stdout)
+        self.assertIn('Held 0 locks', stdout.getvalue())
+        self.assertIn('Database errors: 15\n', stdout.getvalue())
+
+    def test_violation(self):
+        record = dict(lock_id='lock_id', token='token', entered=1, exited=2, requested=0, released=1, clean=False)
+        with mock.patch(
+            'db_mutex.management.commands.stress_locks.find_early_expirations', return_value=[(record, 0.5)]
+        ), mock.patch(
+            'db_mutex.management.commands.stress_locks.find_overlaps', return_value=[(record, record)]
+        ):
+            with self.assertRaisesRegex(CommandError, 'Mutual exclusion was violated'):
+                self.call_command()
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            self.call_command('--locks', '0')
+
+    @skipUnless(connection.vendor == 'sqlite', 'Tests run on an in-memory SQLite database')
+    def test_processes_in_memory_db(self):
+        with self.assertRaises(CommandError):
+            self.call_command('--processes', '2')
+
+    @skipIf(connection.vendor == 'sqlite', 'Processes cannot share an in-memory SQLite database')
+    def test_processes(self):
+        output = self.call_command('--processes', '2', '--overrun', '0.2')
+        self.assertIn('Held 30 locks of 2 lock ids in 2 processes x 3 threads\n', output)
+        self.assertEqual(DBMutex.objects.count(), 0)
+
+    def test_find_overlaps(self):
+        records = [
+            dict(lock_id='a', entered=0, exited=10, clean=True),
+            dict(lock_id='a', entered=1, exited=2, clean=True),
+            dict(lock_id='a', entered=3, exited=4, clean=True),
+            dict(lock_id='a', entered=11, exited=12, clean=True),
+            # Lost the lock, so overlapping with it is expected
+            dict(lock_id='a', entered=11, exited=20, clean=False),
+            dict(lock_id='b', entered=1, exited=2, clean=True),
+        ]
+        self.assertEqual(find_overlaps(records), [(records[0], records[1]), (records[0], records[2])])
+
+    def test_find_early_expirations(self):
+        records = [
+            dict(lock_id='a', requested=0, entered=0, released=2, clean=False),
+            dict(lock_id='b', requested=0, entered=0, released=0.5, clean=False),
+            dict(lock_id='c', requested=0, entered=0, released=0.5, clean=True),
+            # Waited for most of the TTL and then lost the lock right away
+            dict(lock_id='d', requested=0, entered=0.75, released=1, clean=False),
+            # Within the tolerance
+            dict(lock_id='e', requested=0, entered=0, released=0.995, clean=False),
+        ]
+        self.assertEqual(find_early_expirations(records, 1), [(records[1], 0.5), (records[3], 0.25)])
+
+    def test_find_early_expirations_taken_over(self):
+        """
+        Tests that a holder that released its lock after the TTL but was taken over before it is found.
+        """
+        records = [
+            dict(lock_id='a', requested=0, entered=0, released=1.5, clean=False),
+            dict(lock_id='a', requested=0, entered=0.2, released=0.3, clean=True),
+            # Taken over after the TTL
+            dict(lock_id='b', requested=0, entered=0, released=1.5, clean=False),
+            dict(lock_id='b', requested=0, entered=1.2, released=1.3, clean=True),
+            dict(lock_id='c', requested=0, entered=0.2, released=0.3, clean=True),
+        ]
+        self.assertEqual(find_early_expirations(records, 1), [(records[0], 0.2)])
+
+
+class TuneLockTableTestCase(TestCase):
+    """
+    Tests the tune_lock_table management command. Changes to the table are rolled back with the
+    transaction of every test.
+    """
+    def call_command(self, *args):
+        stdout = StringIO()
+        call_command('tune_lock_table', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    @skipUnless(connection.vendor == 'postgresql', 'UNLOGGED tables require PostgreSQL')
+    def test_tune_lock_table(self):
+        self.assertEqual(
+            self.call_command(),
+            'Lock table db_mutex_dbmutex on default is unlogged, autovacuum_analyze_scale_factor=0, '
+            'autovacuum_analyze_threshold=1000, autovacuum_vacuum_cost_delay=0, autovacuum_vacuum_scale_factor=0, '
+            'autovacuum_vacuum_threshold=1000, fillfactor=70\n'
+        )
+        with db_mutex('lock_id'):
+            self.assertEqual(DBMutex.objects.count(), 1)
+
+        self.assertEqual(
+            self.call_command('--logged', '--fillfactor', '50', '--autovacuum-threshold', '10'),
+            'Lock table db_mutex_dbmutex on default is logged, autovacuum_analyze_scale_factor=0, '
+            'autovacuum_analyze_threshold=10, autovacuum_vacuum_cost_delay=0, autovacuum_vacuum_scale_factor=0, '
+            'autovacuum_vacuum_threshold=10, fillfactor=50\n'
+        )
+        self.assertEqual(self.call_command('--reset'), 'Lock table db_mutex_dbmutex on default is logged\n')
+        self.assertEqual(postgres.get_table_storage(connection, 'db_mutex_dbmutex'), (False, {}))
+
+    @skipUnless(connection.vendor == 'postgresql', 'UNLOGGED tables require PostgreSQL')
+    def test_dry_run(self):
+        output = self.call_command('--dry-run', '--database', 'default')
+        self.assertTrue(output.startswith('ALTER TABLE "db_mutex_dbmutex" SET UNLOGGED;\n'))
+        self.assertEqual(postgres.get_table_storage(connection, 'db_mutex_dbmutex'), (False, {}))
+
+    @skipIf(connection.vendor == 'postgresql', 'Tests the error on other databases')
+    def test_requires_postgresql(self):
+        with self.assertRaises(CommandError):
+            self.call_command()
+        with self.assertRaises(CommandError):
+            self.call_command('--database', 'default')
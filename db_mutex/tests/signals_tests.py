@@ -0,0 +1,159 @@
+from unittest import mock
+
+from db_mutex import signals
+from db_mutex.db_mutex import db_mutex, db_mutex_many, db_semaphore
+from db_mutex.exceptions import DBMutexError, DBMutexTimeoutError
+from db_mutex.models import DBMutex, get_expiration_time, supports_upsert
+
+from django.db import connection
+from django.test import TestCase
+
+
+class SignalsTestCase(TestCase):
+    """
+    Tests the signals that report acquiring and releasing locks.
+    """
+    def setUp(self):
+        self.events = []
+        for name in ['lock_acquire_attempted', 'lock_contended', 'lock_acquired', 'lock_reclaimed',
+                     'lock_acquire_failed', 'lock_released', 'lock_expired']:
+            self.connect(name)
+
+    def connect(self, name, sender=None):
+        def receiver(signal, sender, lock, lock_id, **kwargs):
+            self.events.append((name, sender, lock_id, kwargs))
+
+        getattr(signals, name).connect(receiver, sender=sender, weak=False)
+        self.addCleanup(getattr(signals, name).disconnect, receiver, sender=sender)
+
+    def get_events(self, *keys):
+        """
+        Returns the names of the sent signals with the given arguments.
+        """
+        return [(name,) + tuple(kwargs[key] for key in keys if key in kwargs) for name, _, _, kwargs in self.events]
+
+    def test_acquire_release(self):
+        with db_mutex('lock_id') as lock:
+            self.assertTrue(lock.instrumented)
+        self.assertEqual(self.get_events('attempt', 'attempts'), [
+            ('lock_acquire_attempted', 1), ('lock_acquired', 1), ('lock_released',),
+        ])
+        self.assertEqual({(sender, lock_id) for _, sender, lock_id, _ in self.events}, {(db_mutex, 'lock_id')})
+
+        acquired, released = self.events[1][3], self.events[2][3]
+        self.assertEqual(acquired['wait_time'], lock.acquire_time)
+        self.assertGreaterEqual(released['hold_time'], 0)
+        if supports_upsert(connection):
+            self.assertEqual(acquired['queries'], 1)
+            self.assertEqual(released['queries'], 1)
+
+    def test_contention(self):
+        DBMutex.objects.create(lock_id='lock_id')
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                DBMutex.objects.filter(lock_id='lock_id').delete()
+
+        with mock.patch('db_mutex.db_mutex.time.sleep', side_effect=sleep):
+            with db_mutex('lock_id', wait=True):
+                pass
+        self.assertEqual(self.get_events('attempt', 'attempts'), [
+            ('lock_acquire_attempted', 1), ('lock_contended', 1),
+            ('lock_acquire_attempted', 2), ('lock_contended', 2),
+            ('lock_acquire_attempted', 3), ('lock_acquired', 3),
+            ('lock_released',),
+        ])
+
+    def test_acquire_failed(self):
+        DBMutex.objects.create(lock_id='lock_id')
+        with self.assertRaises(DBMutexError):
+            with db_mutex('lock_id'):
+                raise NotImplementedError
+        self.assertEqual(self.get_events('attempts'), [
+            ('lock_acquire_attempted',), ('lock_contended',), ('lock_acquire_failed', 1),
+        ])
+        self.assertGreaterEqual(self.events[2][3]['queries'], 1)
+
+    def test_expired(self):
+        with self.assertRaises(DBMutexTimeoutError):
+            with db_mutex('lock_id'):
+                DBMutex.objects.all().delete()
+        self.assertEqual(self.get_events(), [('lock_acquire_attempted',), ('lock_acquired',), ('lock_expired',)])
+        self.assertGreaterEqual(self.events[2][3]['hold_time'], 0)
+
+    def test_reclaimed(self):
+        """
+        Tests that taking over expired locks is reported.
+        """
+        if connection.vendor == 'sqlite' and supports_upsert(connection):
+            self.skipTest('SQLite does not tell whether INSERT ... ON CONFLICT took over a lock')
+        DBMutex.objects.create(lock_id='lock_a', expires_at=get_expiration_time(-1))
+        DBMutex.objects.create(lock_id='lock_b', expires_at=get_expiration_time(-1))
+        with db_mutex_many(['lock_a', 'lock_b', 'lock_c']):
+            pass
+        with db_mutex('lock_c'):
+            pass
+        self.assertEqual(self.get_events('reclaimed'), [
+            ('lock_acquire_attempted',), ('lock_acquired',), ('lock_reclaimed', 2), ('lock_released',),
+            ('lock_acquire_attempted',), ('lock_acquired',), ('lock_released',),
+        ])
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_reclaimed_without_upsert(self, supports_upsert):
+        DBMutex.objects.create(lock_id='lock_id', expires_at=get_expiration_time(-1))
+        with db_mutex('lock_id'):
+            pass
+        self.assertEqual(self.get_events('reclaimed'), [
+            ('lock_acquire_attempted',), ('lock_acquired',), ('lock_reclaimed', 1), ('lock_released',),
+        ])
+
+    def test_reclaimed_slot(self):
+        if connection.vendor == 'sqlite' and supports_upsert(connection):
+            self.skipTest('SQLite does not tell whether INSERT ... ON CONFLICT took over a lock')
+        lock = db_semaphore('lock_id', limit=1)
+        DBMutex.objects.create(lock_id=lock.get_slot_ids()[0], expires_at=get_expiration_time(-1))
+        with lock:
+            pass
+        self.assertIn(('lock_reclaimed', 1), self.get_events('reclaimed'))
+
+    @mock.patch('db_mutex.models.supports_upsert', return_value=False)
+    def test_reclaimed_slot_without_upsert(self, supports_upsert):
+        lock = db_semaphore('lock_id', limit=1)
+        DBMutex.objects.create(lock_id=lock.get_slot_ids()[0], expires_at=get_expiration_time(-1))
+        with lock:
+            pass
+        self.assertIn(('lock_reclaimed', 1), self.get_events('reclaimed'))
+
+    def test_reentrant(self):
+        """
+        Tests that nested acquisitions of a reentrant lock are not reported.
+        """
+        with db_mutex('lock_id', reentrant=True):
+            with db_mutex('lock_id', reentrant=True):
+                pass
+        self.assertEqual(self.get_events(), [('lock_acquire_attempted',), ('lock_acquired',), ('lock_released',)])
+
+    def test_sender(self):
+        self.connect('lock_acquired', sender=db_semaphore)
+        with db_mutex('lock_id'):
+            pass
+        with db_semaphore('lock_id', limit=2):
+            pass
+        self.assertEqual(
+            [sender for name, sender, _, _ in self.events if name == 'lock_acquired'],
+            [db_mutex, db_semaphore, db_semaphore],
+        )
+
+    async def test_async(self):
+        async with db_mutex('lock_id'):
+            pass
+        self.assertEqual(self.get_events(), [('lock_acquire_attempted',), ('lock_acquired',), ('lock_released',)])
+
+
+class NoReceiversTestCase(TestCase):
+    def test_not_instrumented(self):
+        with db_mutex('lock_id') as lock:
+            self.assertFalse(lock.instrumented)
+            self.assertEqual(lock.queries, 0)
@@ -40,6 +40,8 @@ def configure_settings():
             NOSE_ARGS=['--nocapture', '--nologcapture', '--verbosity=1'],
             DATABASES={
                 'default': db_config,
+                # A second database for testing locks that live on their own database
+                'other': dict(db_config, TEST={'NAME': 'test_db_mutex_other'}),
             },
             INSTALLED_APPS=(
                 'django.contrib.auth',